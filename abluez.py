@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+# asyncio variant of dbluez, built on the pure-asyncio dbus-next client.
+#
+# Scanner and Device expose the same operations as their dbluez counterparts,
+# but as coroutines: scan, connect, discover, start_notify, read, write. D-Bus
+# methods are called with plain messages, so no proxy objects and no
+# introspection round trips are needed.
+
+import os
+import asyncio
+import logging
+import time
+
+from dbus_next import BusType, Message, MessageType, Variant
+from dbus_next.aio import MessageBus
+from dbus_next.errors import DBusError
+
+from dbluez import DBUS_OBJ_MAN, DBUS_PROPS, BLUEZ, BLUEZ_ADAPTER, BLUEZ_DEVICE, BLUEZ_GATTCHAR, \
+                   EDDYSTONE_UUID, EDDYSTONE_TLM, BUS_ADDRESS_ENV, DecodeEddystone, IndexGattObjects, UpdateRssi
+
+def Unwrap(value):
+    if isinstance(value, Variant):
+        return Unwrap(value.value)
+    if isinstance(value, dict):
+        return {k: Unwrap(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [Unwrap(v) for v in value]
+    return value
+
+class Bus:
+    def __init__(self, bus):
+        self._bus = bus
+        self._handlers = {}
+        self._bus.add_message_handler(self._on_message)
+
+    @classmethod
+    async def connect(cls, address = None):
+        if address == None:
+            address = os.environ.get(BUS_ADDRESS_ENV)
+        if address != None:
+            bus = await MessageBus(bus_address=address).connect()
+        else:
+            bus = await MessageBus(bus_type=BusType.SYSTEM).connect()
+        return cls(bus)
+
+    async def call(self, path, interface, member, signature = '', body = [], timeout = None):
+        message = Message(destination=BLUEZ, path=path, interface=interface, member=member, signature=signature, body=body)
+        if timeout != None:
+            reply = await asyncio.wait_for(self._bus.call(message), timeout)
+        else:
+            reply = await self._bus.call(message)
+        if reply.message_type == MessageType.ERROR:
+            raise DBusError(reply.error_name, reply.body[0] if len(reply.body) > 0 else '', reply)
+        return reply.body
+
+    async def get_property(self, path, interface, name):
+        body = await self.call(path, DBUS_PROPS, 'Get', 'ss', [interface, name])
+        return Unwrap(body[0])
+
+    async def managed_objects(self):
+        body = await self.call('/', DBUS_OBJ_MAN, 'GetManagedObjects')
+        return Unwrap(body[0])
+
+    async def subscribe(self, interface, member, cb, path = None, arg0 = None):
+        rule = "type='signal',sender='{}',interface='{}',member='{}'".format(BLUEZ, interface, member)
+        if path != None:
+            rule = rule + ",path='{}'".format(path)
+        if arg0 != None:
+            rule = rule + ",arg0='{}'".format(arg0)
+
+        await self._bus.call(Message(destination='org.freedesktop.DBus', path='/org/freedesktop/DBus',
+                                     interface='org.freedesktop.DBus', member='AddMatch', signature='s', body=[rule]))
+        key = (path, interface, member)
+        self._handlers.setdefault(key, []).append(cb)
+        return (key, cb, rule)
+
+    async def unsubscribe(self, subscription):
+        key, cb, rule = subscription
+        if cb in self._handlers.get(key, []):
+            self._handlers[key].remove(cb)
+        await self._bus.call(Message(destination='org.freedesktop.DBus', path='/org/freedesktop/DBus',
+                                     interface='org.freedesktop.DBus', member='RemoveMatch', signature='s', body=[rule]))
+
+    def _on_message(self, message):
+        if message.message_type != MessageType.SIGNAL:
+            return None
+        for key in ((message.path, message.interface, message.member), (None, message.interface, message.member)):
+            for cb in list(self._handlers.get(key, [])):
+                try:
+                    cb(message.path, message.body)
+                except Exception as e:
+                    logging.getLogger(__name__).error('Error in signal handler for {}: {}'.format(key, e))
+        return None
+
+class Scanner:
+    def __init__(self, bus, adapter, new_device_cb):
+        self._bus = bus
+        self._adapter = adapter
+        self._path = '/org/bluez/{}'.format(adapter)
+        self._logger = logging.getLogger(__name__)
+        self._new_device_cb = new_device_cb
+
+        self.nodes = {}
+        self._reported = set()
+
+    def _on_new_device(self, path, interfaces):
+        if BLUEZ_DEVICE in interfaces and path.startswith(self._path + '/'):
+            props = interfaces[BLUEZ_DEVICE]
+            self.nodes[path] = {
+                'address': props['Address'],
+                'rssi': props.get('RSSI'),
+                'best_rssi': props.get('RSSI'),
+                'avg_rssi': float(props['RSSI']) if 'RSSI' in props else None,
+                'frames': {}
+                }
+            if EDDYSTONE_UUID in props.get('ServiceData', {}):
+                self._on_service_data(path, props['ServiceData'][EDDYSTONE_UUID])
+
+    def _on_interfaces_added(self, path, body):
+        self._on_new_device(body[0], Unwrap(body[1]))
+
+    def _on_prop_changed(self, path, body):
+        node = self.nodes.get(path)
+        if node == None:
+            return
+        changed_props = Unwrap(body[1])
+        if 'RSSI' in changed_props:
+            UpdateRssi(node, changed_props['RSSI'])
+        if EDDYSTONE_UUID in changed_props.get('ServiceData', {}):
+            self._on_service_data(path, changed_props['ServiceData'][EDDYSTONE_UUID])
+
+    def _on_service_data(self, path, data):
+        node = self.nodes[path]
+        try:
+            frame = DecodeEddystone(bytes(data))
+        except ValueError as e:
+            self._logger.debug('Ignoring advertisement of {}: {}'.format(node['address'], e))
+            return
+
+        node['frames'][frame.frametype] = frame
+        if frame.frametype == EDDYSTONE_TLM or (node['address'], frame.frametype) in self._reported:
+            return
+
+        self._reported.add((node['address'], frame.frametype))
+        self._new_device_cb(self._adapter, node['address'], frame.frametype, frame.power, frame.url)
+
+    def rssi(self, address):
+        node = self.nodes.get('{}/dev_{}'.format(self._path, address.replace(':', '_')))
+        if node == None:
+            return None
+        return node['rssi']
+
+    def bestRssi(self, address):
+        node = self.nodes.get('{}/dev_{}'.format(self._path, address.replace(':', '_')))
+        if node == None:
+            return None
+        return node['best_rssi']
+
+    def averageRssi(self, address):
+        node = self.nodes.get('{}/dev_{}'.format(self._path, address.replace(':', '_')))
+        if node == None:
+            return None
+        return node['avg_rssi']
+
+    async def scan(self, duration, stop = None):
+        self._reported = set()
+        subscriptions = [
+            await self._bus.subscribe(DBUS_OBJ_MAN, 'InterfacesAdded', self._on_interfaces_added),
+            await self._bus.subscribe(DBUS_PROPS, 'PropertiesChanged', self._on_prop_changed, arg0=BLUEZ_DEVICE)
+            ]
+        try:
+            await self._bus.call(self._path, BLUEZ_ADAPTER, 'SetDiscoveryFilter', 'a{sv}', [{
+                'Transport': Variant('s', 'le'),
+                'UUIDs': Variant('as', [EDDYSTONE_UUID])
+                }])
+            await self._bus.call(self._path, BLUEZ_ADAPTER, 'StartDiscovery')
+
+            for path, interfaces in (await self._bus.managed_objects()).items():
+                if BLUEZ_DEVICE in interfaces and 'RSSI' not in interfaces[BLUEZ_DEVICE]:
+                    interfaces[BLUEZ_DEVICE].pop('ServiceData', None)
+                self._on_new_device(path, interfaces)
+
+            if stop != None:
+                # ends early once the stop event is set
+                try:
+                    await asyncio.wait_for(stop.wait(), duration)
+                except asyncio.TimeoutError:
+                    None
+            else:
+                await asyncio.sleep(duration)
+        finally:
+            for subscription in subscriptions:
+                await self._bus.unsubscribe(subscription)
+            try:
+                await self._bus.call(self._path, BLUEZ_ADAPTER, 'StopDiscovery')
+            except DBusError as e:
+                self._logger.warning('Error stopping discovery: {}'.format(e))
+
+class Device:
+    def __init__(self, bus, adapter, address, frametype, power, url, connect_attempts = 3, connect_delay = 2, connect_timeout = 25):
+        self._logger  = logging.getLogger('{}[{}]'.format(__name__, address))
+        self._bus     = bus
+        self._adapter = adapter
+        self._address = address
+        self._frametype = frametype
+        self._power   = power
+        self._url     = url
+        self._connect_time = 0
+        self._attempt = 0
+        self.timing = {}
+
+        self._connect_attempts = connect_attempts
+        self._connect_delay = connect_delay
+        self._connect_timeout = connect_timeout
+
+        self._path = '/org/bluez/{}/dev_{}'.format(adapter, address.replace(':', '_'))
+        self._notifications = {}
+
+    async def connect(self):
+        self._logger.debug('Connecting')
+        self.timing = {}
+        for attempt in range(1, self._connect_attempts + 1):
+            self._attempt = attempt
+            try:
+                await self._bus.call(self._path, BLUEZ_DEVICE, 'Connect', timeout=self._connect_timeout)
+                self._connect_time = time.time()
+                self.timing['connected'] = self._connect_time
+                self._logger.debug('Connected after {} attempt(s)'.format(attempt))
+                return
+            except (DBusError, asyncio.TimeoutError) as e:
+                self._logger.error('Error while connecting: {}'.format(e))
+                if attempt < self._connect_attempts:
+                    await asyncio.sleep(self._connect_delay * 2 ** (attempt - 1))
+        raise ConnectionError('Error connecting {} consecutive times'.format(self._connect_attempts))
+
+    async def discover(self, timeout = 30):
+        resolved = asyncio.Event()
+
+        def on_prop_changed(path, body):
+            if Unwrap(body[1]).get('ServicesResolved') == True:
+                resolved.set()
+
+        subscription = await self._bus.subscribe(DBUS_PROPS, 'PropertiesChanged', on_prop_changed, path=self._path, arg0=BLUEZ_DEVICE)
+        try:
+            if not await self._bus.get_property(self._path, BLUEZ_DEVICE, 'ServicesResolved'):
+                await asyncio.wait_for(resolved.wait(), timeout)
+        finally:
+            await self._bus.unsubscribe(subscription)
+        self.timing['resolved'] = time.time()
+
+        self.characteristics, self.characteristic_flags, self.descriptor_uuids, self.layout_fingerprint = \
+            IndexGattObjects(self._path, await self._bus.managed_objects())
+
+    async def start_notify(self, path, value_cb):
+        def on_prop_changed(signal_path, body):
+            changed_props = Unwrap(body[1])
+            if 'Value' in changed_props:
+                value_cb(bytes(changed_props['Value']))
+
+        self._notifications[path] = await self._bus.subscribe(DBUS_PROPS, 'PropertiesChanged', on_prop_changed, path=path, arg0=BLUEZ_GATTCHAR)
+        await self._bus.call(path, BLUEZ_GATTCHAR, 'StartNotify')
+
+    async def stop_notify(self, path):
+        subscription = self._notifications.pop(path, None)
+        if subscription != None:
+            await self._bus.unsubscribe(subscription)
+            try:
+                await self._bus.call(path, BLUEZ_GATTCHAR, 'StopNotify')
+            except DBusError as e:
+                self._logger.debug('Error stopping notifications: {}'.format(e))
+
+    async def read(self, path):
+        body = await self._bus.call(path, BLUEZ_GATTCHAR, 'ReadValue', 'a{sv}', [{}])
+        return bytes(body[0])
+
+    async def write(self, path, data):
+        await self._bus.call(path, BLUEZ_GATTCHAR, 'WriteValue', 'aya{sv}', [bytes(data), {}])
+
+    async def disconnect(self):
+        self._logger.debug('Disconnecting')
+        for path in list(self._notifications.keys()):
+            await self.stop_notify(path)
+        await self._bus.call(self._path, BLUEZ_DEVICE, 'Disconnect')
+        self.timing['disconnected'] = time.time()
+        if self._connect_time > 0:
+            self._logger.info('Disconnected. Connected time: {} s'.format(time.time() - self._connect_time))
+
+    async def remove(self):
+        await self._bus.call('/org/bluez/{}'.format(self._adapter), BLUEZ_ADAPTER, 'RemoveDevice', 'o', [self._path])
+
+    def setAdapter(self, adapter):
+        self._adapter = adapter
+        self._path = '/org/bluez/{}/dev_{}'.format(adapter, self._address.replace(':', '_'))
+
+    def getAdapter(self):
+        return self._adapter
+
+    def attempts(self):
+        return self._attempt
+
+    def setConnectAttempts(self, attempts):
+        self._connect_attempts = attempts
+
+    def getAddress(self):
+        return self._address
@@ -0,0 +1,579 @@
+#!/usr/bin/env python3
+
+# Simulated BlueZ service with virtual AFC sensors.
+#
+# Exports the subset of the BlueZ D-Bus API used by dbluez (ObjectManager,
+# Adapter1, Device1, GattService1, GattCharacteristic1 and GattDescriptor1)
+# under the name org.bluez on a private bus. Every virtual sensor advertises
+# the AFC Eddystone-URL and serves the sync, CTS and node name
+# characteristics. With --sync_mode=notify the sync characteristic notifies
+# instead of indicating and supports AcquireNotify, the values are then sent
+# through a socket pair. With several adapters (-i hci0,hci1) a sensor is in range
+# of a subset of them and can only be connected through one at a time. The
+# gateway is pointed at the bus with DBLUEZ_BUS_ADDRESS:
+#
+#   dbus-daemon --session --print-address --fork
+#   python3 benchmarks/bluezsim.py -a <address> -n 50 --backlog 2000 &
+#   DBLUEZ_BUS_ADDRESS=<address> ./gateway.py -c 5
+#
+# Prints 'ready' to stdout as soon as the service owns its bus name.
+
+import os
+import sys
+import socket
+import signal
+import getopt
+import random
+import logging
+
+import dbus
+import dbus.service
+import dbus.mainloop.glib
+from gi.repository import GLib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import dbluez
+import parser
+
+from corpus import LAYOUTS, Payloads
+
+AFC_URL_FRAME = bytes([dbluez.EDDYSTONE_URL, 0xeb, 0x00]) + b'afarcloud.eu/'
+
+class Failed(dbus.DBusException):
+    _dbus_error_name = 'org.bluez.Error.Failed'
+
+class DoesNotExist(dbus.DBusException):
+    _dbus_error_name = 'org.bluez.Error.DoesNotExist'
+
+class NotSupported(dbus.DBusException):
+    _dbus_error_name = 'org.bluez.Error.NotSupported'
+
+class NotPermitted(dbus.DBusException):
+    _dbus_error_name = 'org.bluez.Error.NotPermitted'
+
+class InvalidArgs(dbus.DBusException):
+    _dbus_error_name = 'org.freedesktop.DBus.Error.InvalidArgs'
+
+class Object(dbus.service.Object):
+    # exported by ObjectManager.add, so removed devices can come back
+    def __init__(self, path, interface, props):
+        self.path = path
+        self.interface = interface
+        self.props = props
+        dbus.service.Object.__init__(self)
+
+    def interfaces(self):
+        return {self.interface: self.props}
+
+    def update(self, **changed):
+        self.props.update(changed)
+        self.PropertiesChanged(self.interface, changed, [])
+
+    @dbus.service.method(dbluez.DBUS_PROPS, in_signature='ss', out_signature='v')
+    def Get(self, interface, name):
+        if interface != self.interface or name not in self.props:
+            raise InvalidArgs('No such property {}.{}'.format(interface, name))
+        return self.props[name]
+
+    @dbus.service.method(dbluez.DBUS_PROPS, in_signature='s', out_signature='a{sv}')
+    def GetAll(self, interface):
+        if interface != self.interface:
+            return {}
+        return self.props
+
+    @dbus.service.signal(dbluez.DBUS_PROPS, signature='sa{sv}as')
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
+class ObjectManager(dbus.service.Object):
+    def __init__(self, bus):
+        dbus.service.Object.__init__(self, bus, '/')
+        self.bus = bus
+        self.objects = {}
+
+    def add(self, obj):
+        obj.add_to_connection(self.bus, obj.path)
+        self.objects[obj.path] = obj
+        self.InterfacesAdded(obj.path, obj.interfaces())
+
+    def remove(self, obj):
+        if self.objects.pop(obj.path, None) != None:
+            self.InterfacesRemoved(obj.path, list(obj.interfaces().keys()))
+            obj.remove_from_connection()
+
+    @dbus.service.method(dbluez.DBUS_OBJ_MAN, out_signature='a{oa{sa{sv}}}')
+    def GetManagedObjects(self):
+        return {path: obj.interfaces() for path, obj in self.objects.items()}
+
+    @dbus.service.signal(dbluez.DBUS_OBJ_MAN, signature='oa{sa{sv}}')
+    def InterfacesAdded(self, path, interfaces):
+        pass
+
+    @dbus.service.signal(dbluez.DBUS_OBJ_MAN, signature='oas')
+    def InterfacesRemoved(self, path, interfaces):
+        pass
+
+class Descriptor(Object):
+    def __init__(self, path, uuid, characteristic):
+        Object.__init__(self, path, dbluez.BLUEZ_GATTDESC, {
+            'UUID': uuid,
+            'Characteristic': dbus.ObjectPath(characteristic.path)
+            })
+
+class Characteristic(Object):
+    def __init__(self, path, uuid, service, flags, read_cb = None, write_cb = None, notify_cb = None, mtu = 23):
+        Object.__init__(self, path, dbluez.BLUEZ_GATTCHAR, {
+            'UUID': uuid,
+            'Service': dbus.ObjectPath(service.path),
+            'Flags': dbus.Array(flags, signature='s'),
+            'Notifying': False,
+            'Value': dbus.Array([], signature='y')
+            })
+        self._read_cb = read_cb
+        self._write_cb = write_cb
+        self._notify_cb = notify_cb
+        self._mtu = mtu
+        # our end of the socket pair handed out by AcquireNotify
+        self._socket = None
+        self._watch = None
+
+    def notify(self, data):
+        if self._socket != None:
+            self._socket.send(data)
+            return
+        self.update(Value=dbus.Array(data, signature='y'))
+
+    def release(self):
+        if self._socket == None:
+            return False
+        if self._watch != None:
+            GLib.source_remove(self._watch)
+            self._watch = None
+        self._socket.close()
+        self._socket = None
+        return True
+
+    def _on_released(self, fd, condition):
+        # the client closed its end
+        self._watch = None
+        if self.release():
+            self._notify_cb(False)
+        return False
+
+    @dbus.service.method(dbluez.BLUEZ_GATTCHAR, in_signature='a{sv}', out_signature='hq')
+    def AcquireNotify(self, options):
+        if self._notify_cb == None or 'notify' not in self.props['Flags']:
+            raise NotSupported('Operation is not supported')
+        if self._socket != None or self.props['Notifying']:
+            raise NotPermitted('Notify acquired')
+        self._socket, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self._watch = GLib.io_add_watch(self._socket.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_HUP | GLib.IO_ERR, self._on_released)
+        fd = dbus.types.UnixFd(theirs)
+        theirs.close()
+        self._notify_cb(True)
+        return (fd, dbus.UInt16(self._mtu))
+
+    @dbus.service.method(dbluez.BLUEZ_GATTCHAR, in_signature='a{sv}', out_signature='ay')
+    def ReadValue(self, options):
+        if self._read_cb == None:
+            raise Failed('Read not permitted')
+        return dbus.Array(self._read_cb(), signature='y')
+
+    @dbus.service.method(dbluez.BLUEZ_GATTCHAR, in_signature='aya{sv}')
+    def WriteValue(self, value, options):
+        if self._write_cb == None:
+            raise Failed('Write not permitted')
+        self._write_cb(bytes(value))
+
+    @dbus.service.method(dbluez.BLUEZ_GATTCHAR)
+    def StartNotify(self):
+        if self._notify_cb == None:
+            raise Failed('Notify not permitted')
+        if self._socket != None:
+            raise NotPermitted('Notify acquired')
+        if not self.props['Notifying']:
+            self.update(Notifying=True)
+            self._notify_cb(True)
+
+    @dbus.service.method(dbluez.BLUEZ_GATTCHAR)
+    def StopNotify(self):
+        if self.props['Notifying']:
+            self.update(Notifying=False)
+            self._notify_cb(False)
+
+class Service(Object):
+    def __init__(self, path, uuid, device):
+        Object.__init__(self, path, dbluez.BLUEZ_GATTSERV, {
+            'UUID': uuid,
+            'Device': dbus.ObjectPath(device.path),
+            'Primary': True
+            })
+
+class Node:
+    # the physical sensor, shared by its device objects on all adapters
+    def __init__(self, index, options):
+        self.address = 'AF:C0:00:00:{:02X}:{:02X}'.format(index >> 8, index & 0xff)
+        self.name = 'sim-{:04d}'.format(index)
+        self.layout = LAYOUTS[options['layout']]
+        self.backlog = Payloads(self.layout, options['backlog'], options['mtu'], seed=index)
+        self.records = options['backlog']
+        self.sessions = 0
+        self.completed = 0
+        self.time_writes = 0
+        # device object of the adapter that holds the connection
+        self.link = None
+
+class Sensor(Object):
+    def __init__(self, sim, adapter, node, rssi, options):
+        self._sim = sim
+        self._options = options
+        self._logger = logging.getLogger('{}[{}@{}]'.format(__name__, node.name, adapter.props['Name']))
+        self.adapter = adapter
+        self.node = node
+        self.address = node.address
+        self.name = node.name
+        self.layout = node.layout
+        self.rssi = rssi
+
+        self._gatt = []
+        self._sync_char = None
+        self._timer = None
+        self._pending = None
+        self._sent = 0
+        self._drop_at = None
+
+        Object.__init__(self, '{}/dev_{}'.format(adapter.path, self.address.replace(':', '_')), dbluez.BLUEZ_DEVICE, {
+            'Address': self.address,
+            'AddressType': 'random',
+            'Name': self.name,
+            'Adapter': dbus.ObjectPath(adapter.path),
+            'Connected': False,
+            'ServicesResolved': False,
+            'RSSI': dbus.Int16(rssi),
+            'TxPower': dbus.Int16(-21),
+            'UUIDs': dbus.Array([dbluez.EDDYSTONE_UUID], signature='s'),
+            'ServiceData': dbus.Dictionary({dbluez.EDDYSTONE_UUID: dbus.Array(AFC_URL_FRAME, signature='y')}, signature='sv')
+            })
+
+    def advertise(self):
+        rssi = dbus.Int16(self.rssi + random.randint(-5, 5))
+        if self.path not in self._sim.objects.objects:
+            self.props['RSSI'] = rssi
+            self._sim.objects.add(self)
+        else:
+            self.update(RSSI=rssi)
+
+    def forget(self):
+        self._disconnected()
+        for obj in reversed(self._gatt):
+            self._sim.objects.remove(obj)
+        self._gatt = []
+        self._sim.objects.remove(self)
+
+    def _export_gatt(self):
+        if len(self._gatt) > 0:
+            return
+        handle = [0]
+
+        def path(parent, kind):
+            handle[0] = handle[0] + 1
+            return '{}/{}{:04x}'.format(parent.path, kind, handle[0])
+
+        gss = Service(path(self, 'service'), parser.AFC_GSS_UUID, self)
+        self._sync_char = Characteristic(path(gss, 'char'), parser.AFC_GSC_UUID, gss, [self._options['sync_mode']],
+                                         notify_cb=self._on_notify, mtu=self._options['mtu'])
+        self._gatt.extend([gss, self._sync_char])
+        for uuid in self.layout:
+            self._gatt.append(Descriptor(path(self._sync_char, 'desc'), uuid, self._sync_char))
+        self._gatt.append(Descriptor(path(self._sync_char, 'desc'), dbluez.BLE_GATT_CCCD, self._sync_char))
+
+        ans = Service(path(self, 'service'), parser.AFC_ANS_UUID, self)
+        nnc = Characteristic(path(ans, 'char'), parser.AFC_ANS_NNC_UUID, ans, ['read'], read_cb=lambda: self.name.encode('utf-8'))
+        self._gatt.extend([ans, nnc])
+
+        cts = Service(path(self, 'service'), parser.GEN_CTS_UUID, self)
+        ct = Characteristic(path(cts, 'char'), parser.GEN_CTS_CT_UUID, cts, ['read', 'write'], write_cb=self._on_time_write)
+        self._gatt.extend([cts, ct])
+
+        for obj in self._gatt:
+            self._sim.objects.add(obj)
+
+    def _on_time_write(self, data):
+        self.node.time_writes = self.node.time_writes + 1
+
+    def _on_notify(self, enabled):
+        if self._timer != None:
+            GLib.source_remove(self._timer)
+            self._timer = None
+        if not enabled:
+            return
+
+        self.node.sessions = self.node.sessions + 1
+        self._sent = 0
+        self._drop_at = None
+        if random.random() < self._options['drop']:
+            self._drop_at = random.randint(0, len(self.node.backlog))
+
+        rate = self._options['rate']
+        if rate > 0:
+            self._timer = GLib.timeout_add(max(1, int(1000 / rate)), self._indicate)
+        else:
+            self._timer = GLib.idle_add(self._indicate)
+
+    def _indicate(self):
+        if self._drop_at != None and self._sent >= self._drop_at:
+            self._logger.info('Dropping connection after {} indications'.format(self._sent))
+            self._timer = None
+            self._disconnected()
+            return False
+
+        if self._sent < len(self.node.backlog):
+            self._sync_char.notify(self.node.backlog[self._sent])
+            self._sent = self._sent + 1
+            return True
+
+        # the firmware discards its backlog once the end marker went out
+        self._sync_char.notify(b'\x00')
+        self.node.backlog = []
+        self.node.completed = self.node.completed + 1
+        self._timer = None
+        return False
+
+    def _disconnected(self):
+        if self._timer != None:
+            GLib.source_remove(self._timer)
+            self._timer = None
+        if self._pending != None:
+            GLib.source_remove(self._pending)
+            self._pending = None
+        if self._sync_char != None and self._sync_char.props['Notifying']:
+            self._sync_char.props['Notifying'] = False
+        if self._sync_char != None:
+            self._sync_char.release()
+        if self.node.link == self:
+            self.node.link = None
+        if self.props['Connected']:
+            self.update(Connected=False, ServicesResolved=False)
+
+    @dbus.service.method(dbluez.BLUEZ_DEVICE, async_callbacks=('reply_cb', 'error_cb'))
+    def Connect(self, reply_cb, error_cb):
+        if self.props['Connected']:
+            reply_cb()
+            return
+        if self.node.link != None:
+            # connected or connecting through another adapter
+            error_cb(Failed('le-connection-abort-by-local'))
+            return
+        limit = self._options['max_connections']
+        if limit > 0 and self.adapter.connections() >= limit:
+            error_cb(Failed('le-connection-abort-by-local'))
+            return
+        self.node.link = self
+
+        def connected():
+            self._pending = None
+            if random.random() < self._options['connect_failures']:
+                self.node.link = None
+                error_cb(Failed('le-connection-abort-by-local'))
+                return False
+            self.update(Connected=True)
+            reply_cb()
+            self._pending = GLib.timeout_add(int(self._options['resolve_latency'] * 1000), resolved)
+            return False
+
+        def resolved():
+            self._pending = None
+            self._export_gatt()
+            self.update(ServicesResolved=True)
+            return False
+
+        self._pending = GLib.timeout_add(int(self._options['connect_latency'] * 1000), connected)
+
+    @dbus.service.method(dbluez.BLUEZ_DEVICE)
+    def Disconnect(self):
+        self._disconnected()
+
+class Adapter(Object):
+    def __init__(self, sim, index, name):
+        self._sim = sim
+        self.sensors = []
+        Object.__init__(self, '/org/bluez/{}'.format(name), dbluez.BLUEZ_ADAPTER, {
+            'Address': '00:00:5E:00:53:{:02X}'.format(index),
+            'Name': name,
+            'Powered': True,
+            'Discovering': False
+            })
+
+    @dbus.service.method(dbluez.BLUEZ_ADAPTER, in_signature='a{sv}')
+    def SetDiscoveryFilter(self, filter):
+        None
+
+    @dbus.service.method(dbluez.BLUEZ_ADAPTER)
+    def StartDiscovery(self):
+        self.update(Discovering=True)
+        interval = self._sim.options['adv_interval']
+        for sensor in self.sensors:
+            GLib.timeout_add(int(random.uniform(0, interval) * 1000), self._advertise, sensor)
+
+    def _advertise(self, sensor):
+        if self.props['Discovering']:
+            sensor.advertise()
+        return False
+
+    @dbus.service.method(dbluez.BLUEZ_ADAPTER)
+    def StopDiscovery(self):
+        self.update(Discovering=False)
+
+    def connections(self):
+        return sum(1 for sensor in self.sensors if sensor.node.link == sensor)
+
+    @dbus.service.method(dbluez.BLUEZ_ADAPTER, in_signature='o')
+    def RemoveDevice(self, path):
+        for sensor in self.sensors:
+            if sensor.path == path and path in self._sim.objects.objects:
+                sensor.forget()
+                return
+        raise DoesNotExist('Does Not Exist')
+
+class Simulator:
+    def __init__(self, bus, options):
+        self.bus = bus
+        self.options = options
+        self.objects = ObjectManager(bus)
+        self.adapters = [Adapter(self, index, name) for index, name in enumerate(options['adapters'])]
+        for adapter in self.adapters:
+            self.objects.add(adapter)
+
+        self.nodes = []
+        for index in range(0, options['nodes']):
+            node = Node(index, options)
+            self.nodes.append(node)
+            # every sensor is in range of one adapter, and of each other one
+            # with the probability --reach
+            rnd = random.Random(index)
+            home = index % len(self.adapters)
+            for number, adapter in enumerate(self.adapters):
+                if number == home or rnd.random() < options['reach']:
+                    adapter.sensors.append(Sensor(self, adapter, node, rnd.randint(-90, -45), options))
+
+    def summary(self):
+        return {
+            'nodes': len(self.nodes),
+            'sessions': sum(node.sessions for node in self.nodes),
+            'completed': sum(1 for node in self.nodes if node.completed > 0),
+            'records': sum(node.records for node in self.nodes if node.completed > 0),
+            'time_writes': sum(node.time_writes for node in self.nodes)
+        }
+
+OPTIONS = {
+    'address': None,
+    'adapters': ['hci0'],
+    'reach': 1.0,
+    'max_connections': 0,
+    'nodes': 10,
+    'backlog': 1000,
+    'layout': 'soil',
+    'mtu': 247,
+    'rate': 0,
+    'adv_interval': 1.0,
+    'connect_latency': 0.2,
+    'resolve_latency': 0.3,
+    'connect_failures': 0.0,
+    'drop': 0.0,
+    'sync_mode': 'indicate'
+}
+
+def usage():
+    print('Usage:')
+    print('  bluezsim.py [options]')
+    print('Options:')
+    print('  -h, --help                  Show help')
+    print('  -a, --address=<address>     D-Bus address of the private bus (default: session bus)')
+    print('  -i, --adapter=hciX[,hciY]   Names of the simulated adapters (default: {})'.format(','.join(OPTIONS['adapters'])))
+    print('      --reach=P               Probability that a sensor is in range of an additional adapter (default: {})'.format(OPTIONS['reach']))
+    print('      --max_connections=N     Concurrent connections per adapter, 0 for unlimited (default: {})'.format(OPTIONS['max_connections']))
+    print('  -n, --nodes=N               Number of virtual sensors (default: {})'.format(OPTIONS['nodes']))
+    print('      --backlog=N             Records stored on every sensor (default: {})'.format(OPTIONS['backlog']))
+    print('      --layout=<layout>       Record layout: {} (default: {})'.format(', '.join(sorted(LAYOUTS.keys())), OPTIONS['layout']))
+    print('      --mtu=N                 ATT MTU, limits the records per indication (default: {})'.format(OPTIONS['mtu']))
+    print('      --rate=N                Indications per second and sensor, 0 for unthrottled (default: {})'.format(OPTIONS['rate']))
+    print('      --adv_interval=SECONDS  Sensors are discovered within this time after StartDiscovery (default: {})'.format(OPTIONS['adv_interval']))
+    print('      --connect_latency=SECONDS  Delay of a Connect() reply (default: {})'.format(OPTIONS['connect_latency']))
+    print('      --resolve_latency=SECONDS  Delay between connection and resolved services (default: {})'.format(OPTIONS['resolve_latency']))
+    print('      --connect_failures=P    Probability that a Connect() attempt fails (default: {})'.format(OPTIONS['connect_failures']))
+    print('      --drop=P                Probability that a session is dropped during the transfer (default: {})'.format(OPTIONS['drop']))
+    print('      --sync_mode=<mode>      indicate, or notify with AcquireNotify support (default: {})'.format(OPTIONS['sync_mode']))
+    print('  -V, --verbose               Show debug log')
+
+def parse_options(argv):
+    options = dict(OPTIONS)
+    log_level = logging.INFO
+    try:
+        opts, args = getopt.getopt(argv, "ha:i:n:V", ["help", "address=", "adapter=", "nodes=", "backlog=", "layout=", "mtu=", "rate=",
+                                                     "adv_interval=", "connect_latency=", "resolve_latency=", "connect_failures=", "drop=",
+                                                     "reach=", "max_connections=", "sync_mode=", "verbose"])
+    except getopt.GetoptError as err:
+        print(err)
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif o in ('-a', '--address'):
+            options['address'] = a
+        elif o in ('-i', '--adapter'):
+            options['adapters'] = [name for name in a.split(',') if name != '']
+        elif o in ('-n', '--nodes'):
+            options['nodes'] = int(a)
+        elif o == '--layout':
+            if a not in LAYOUTS:
+                print('Unknown layout: {}'.format(a))
+                usage()
+                sys.exit(2)
+            options['layout'] = a
+        elif o == '--sync_mode':
+            if a not in ('indicate', 'notify'):
+                print('Unknown sync mode: {}'.format(a))
+                usage()
+                sys.exit(2)
+            options['sync_mode'] = a
+        elif o in ('--backlog', '--mtu', '--max_connections'):
+            options[o[2:]] = int(a)
+        elif o in ('--rate', '--adv_interval', '--connect_latency', '--resolve_latency', '--connect_failures', '--drop', '--reach'):
+            options[o[2:]] = float(a)
+        elif o in ('-V', '--verbose'):
+            log_level = logging.DEBUG
+        else:
+            assert False, "unhandled option"
+    return options, log_level
+
+def main():
+    options, log_level = parse_options(sys.argv[1:])
+    logging.basicConfig(stream=sys.stderr, level=log_level)
+    logger = logging.getLogger(__name__)
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    if options['address'] != None:
+        bus = dbus.bus.BusConnection(options['address'])
+    else:
+        bus = dbus.SessionBus()
+
+    sim = Simulator(bus, options)
+    name = dbus.service.BusName(dbluez.BLUEZ, bus)
+    logger.info('Simulating {} sensors on {}'.format(options['nodes'], ', '.join(adapter.path for adapter in sim.adapters)))
+    print('ready', flush=True)
+
+    loop = GLib.MainLoop()
+    GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGTERM, loop.quit)
+    try:
+        loop.run()
+    except KeyboardInterrupt:
+        None
+
+    logger.info('Summary: {}'.format(sim.summary()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+# Compares the scalar (per indication) and the bulk (NumPy) decode path of
+# parser.RecordDecoder on a synthetic soil sensor backlog.
+#
+#   python3 benchmarks/bulk_decode.py [records ...]
+
+import os
+import sys
+import random
+import struct
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import parser
+
+LAYOUT = (
+    parser.AFC_TIMESTAMP_UUID,
+    parser.AFC_BATTERY_VOLTAGE_UUID,
+    parser.AFC_SOIL_TEMPERATURE_UUID,
+    parser.AFC_SOIL_HUMIDITY_UUID
+)
+
+RECORDS_PER_INDICATION = 20
+
+def backlog(decoder, records):
+    rnd = random.Random(records)
+    payloads = []
+    timestamps = []
+    ts = 1600000000
+    while records > 0:
+        count = min(records, RECORDS_PER_INDICATION)
+        data = bytearray([count])
+        for x in range(0, count):
+            data += struct.pack('<IHhH', ts, rnd.randint(250, 330), rnd.randint(-2000, 4000), rnd.randint(0, 10000))
+            ts = ts + 900
+        payloads.append(bytes(data))
+        timestamps.append(ts * 1000)
+        records = records - count
+    return payloads, timestamps
+
+def scalar(decoder, payloads, timestamps):
+    records = []
+    for data, ts in zip(payloads, timestamps):
+        records.extend(decoder.decode(data, ts))
+    return records
+
+def bulk(decoder, payloads, timestamps):
+    return list(decoder.decode_bulk(payloads, timestamps))
+
+def measure(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [10000, 100000, 1000000]
+    decoder = parser.RecordDecoder.compile(LAYOUT)
+
+    if parser.numpy == None:
+        print('NumPy not available, bulk path falls back to the scalar decoder')
+
+    print('{:>10} {:>12} {:>12} {:>14} {:>14} {:>8}'.format('records', 'scalar [s]', 'bulk [s]', 'scalar [rec/s]', 'bulk [rec/s]', 'speedup'))
+    for size in sizes:
+        payloads, timestamps = backlog(decoder, size)
+        t_scalar, expected = measure(scalar, decoder, payloads, timestamps)
+        t_bulk, result = measure(bulk, decoder, payloads, timestamps)
+        if result != expected:
+            print('Mismatch between scalar and bulk output for {} records'.format(size))
+            sys.exit(1)
+        print('{:>10} {:>12.3f} {:>12.3f} {:>14.0f} {:>14.0f} {:>7.2f}x'.format(
+            size, t_scalar, t_bulk, size / t_scalar, size / t_bulk, t_scalar / t_bulk))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+# Indication payloads of virtual AFC sensors.
+#
+# A corpus file holds the descriptor layout of one sensor type followed by
+# its sync characteristic indications, exactly as they arrive from BlueZ:
+#
+#   header      <4sBB  magic 'AFCC', version, number of descriptors
+#   descriptor  16s    UUID of every record field in characteristic order
+#   indication  <H     length, followed by the payload (count + records)
+#
+# The files in benchmarks/corpus are written by 'corpus.py record' and are
+# the input of benchmarks/micro.py and the simulated sensors.
+
+import os
+import sys
+import uuid
+import random
+import struct
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import parser
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+CORPUS_MAGIC = b'AFCC'
+CORPUS_VERSION = 1
+
+HEADER = struct.Struct('<4sBB')
+LENGTH = struct.Struct('<H')
+
+LAYOUTS = {
+    'soil': (
+        parser.AFC_TIMESTAMP_UUID,
+        parser.AFC_BATTERY_VOLTAGE_UUID,
+        parser.AFC_SOIL_TEMPERATURE_UUID,
+        parser.AFC_SOIL_HUMIDITY_UUID
+    ),
+    'ambient': (
+        parser.AFC_TIMESTAMP_UUID,
+        parser.AFC_BATTERY_VOLTAGE_UUID,
+        parser.AFC_AMB_TEMPERATURE_UUID,
+        parser.AFC_AMB_HUMDITY_UUID,
+        parser.AFC_ATM_PRESSURE_UUID
+    ),
+    'imu': (
+        parser.AFC_TIMESTAMP_UUID,
+        parser.AFC_ACC_X_UUID,
+        parser.AFC_ACC_Y_UUID,
+        parser.AFC_ACC_Z_UUID,
+        parser.AFC_GYR_X_UUID,
+        parser.AFC_GYR_Y_UUID,
+        parser.AFC_GYR_Z_UUID,
+        parser.AFC_MAG_X_UUID,
+        parser.AFC_MAG_Y_UUID,
+        parser.AFC_MAG_Z_UUID
+    ),
+    'calibration': (
+        parser.AFC_TIMESTAMP_UUID,
+        parser.AFC_BATTERY_VOLTAGE_UUID,
+        parser.AFC_SOIL_TEMPERATURE_UUID,
+        parser.AFC_SOIL_HUMIDITY_L_UUID,
+        parser.AFC_SOIL_HUMIDITY_H_UUID
+    )
+}
+
+# raw value ranges as reported by the sensors
+RANGES = {
+    parser.AFC_BATTERY_VOLTAGE_UUID: (250, 330),
+    parser.AFC_SOIL_TEMPERATURE_UUID: (-2000, 4000),
+    parser.AFC_SOIL_HUMIDITY_UUID: (0, 10000),
+    parser.AFC_AMB_TEMPERATURE_UUID: (-2000, 4000),
+    parser.AFC_AMB_HUMDITY_UUID: (0, 10000),
+    parser.AFC_ATM_PRESSURE_UUID: (900000, 1100000),
+    parser.AFC_SOIL_HUMIDITY_L_UUID: (0, 4095),
+    parser.AFC_SOIL_HUMIDITY_H_UUID: (0, 4095)
+}
+
+RECORD_INTERVAL = 900
+DEFAULT_MTU = 247
+
+def RecordGenerator(layout, seed):
+    # every value performs a bounded random walk, like a slowly changing
+    # physical quantity, so the printed precision matches real data
+    rnd = random.Random(seed)
+    record = struct.Struct('<' + ''.join(parser.AFC_SYNC_DATA[descriptor]['type'].lstrip('<') for descriptor in layout))
+    state = []
+    for descriptor in layout:
+        low, high = RANGES.get(descriptor, (-2000, 2000))
+        state.append([low, high, max(1, (high - low) // 50), rnd.randint(low, high)])
+
+    def generate(ts):
+        values = []
+        for descriptor, field in zip(layout, state):
+            if descriptor == parser.AFC_TIMESTAMP_UUID:
+                values.append(ts)
+                continue
+            low, high, step, value = field
+            value = min(high, max(low, value + rnd.randint(-step, step)))
+            field[3] = value
+            values.append(value)
+        return record.pack(*values)
+
+    return record.size, generate
+
+def Payloads(layout, records, mtu = DEFAULT_MTU, seed = 0, ts = 1600000000):
+    size, generate = RecordGenerator(layout, seed)
+    # one byte of the ATT payload is the record count
+    per_indication = min(255, max(1, (mtu - 4) // size))
+    payloads = []
+    while records > 0:
+        count = min(records, per_indication)
+        data = bytearray([count])
+        for x in range(0, count):
+            data += generate(ts)
+            ts = ts + RECORD_INTERVAL
+        payloads.append(bytes(data))
+        records = records - count
+    return payloads
+
+def WriteCorpus(path, layout, payloads):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(CORPUS_MAGIC, CORPUS_VERSION, len(layout)))
+        for descriptor in layout:
+            f.write(uuid.UUID(descriptor).bytes)
+        for data in payloads:
+            f.write(LENGTH.pack(len(data)))
+            f.write(data)
+    os.replace(tmp, path)
+
+def ReadCorpus(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    magic, version, count = HEADER.unpack_from(data, 0)
+    if magic != CORPUS_MAGIC or version != CORPUS_VERSION:
+        raise ValueError('{} is not a version {} corpus file'.format(path, CORPUS_VERSION))
+    pos = HEADER.size
+    layout = []
+    for x in range(0, count):
+        layout.append(str(uuid.UUID(bytes=data[pos:pos + 16])))
+        pos = pos + 16
+
+    payloads = []
+    while pos < len(data):
+        length, = LENGTH.unpack_from(data, pos)
+        pos = pos + LENGTH.size
+        if pos + length > len(data):
+            raise ValueError('{} is truncated'.format(path))
+        payloads.append(data[pos:pos + length])
+        pos = pos + length
+    return tuple(layout), payloads
+
+def CorpusPath(name):
+    return os.path.join(CORPUS_DIR, '{}.bin'.format(name))
+
+def Load(name):
+    return ReadCorpus(CorpusPath(name))
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in ('record', 'show'):
+        print('Usage:')
+        print('  corpus.py record [records]   Write a corpus file for every layout to {}'.format(CORPUS_DIR))
+        print('  corpus.py show               Summarize the stored corpus files')
+        sys.exit(2)
+
+    if sys.argv[1] == 'record':
+        records = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+        if not os.path.isdir(CORPUS_DIR):
+            os.makedirs(CORPUS_DIR)
+        for name, layout in sorted(LAYOUTS.items()):
+            WriteCorpus(CorpusPath(name), layout, Payloads(layout, records, seed=name))
+
+    for name in sorted(LAYOUTS.keys()):
+        layout, payloads = Load(name)
+        print('{:<12} {:>3} fields {:>6} indications {:>8} records {:>8} bytes'.format(
+            name, len(layout), len(payloads), sum(data[0] for data in payloads), sum(len(data) for data in payloads)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+# End-to-end load test of gateway.py against the simulated BlueZ service.
+#
+# For every node count a private dbus-daemon and benchmarks/bluezsim.py are
+# started, then gateway.py runs one scan and synchronization cycle on that
+# bus. The records printed by the gateway are counted and compared to the
+# simulated backlog.
+#
+#   python3 benchmarks/load.py [options] [nodes ...]
+#
+# Options not listed below are passed on to bluezsim.py, options after '--'
+# to gateway.py. The gateway uses all simulated adapters (--adapter).
+
+import os
+import sys
+import json
+import time
+import getopt
+import subprocess
+import threading
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+import dbluez
+
+GATEWAY = os.path.join(HERE, '..', 'gateway.py')
+SIMULATOR = os.path.join(HERE, 'bluezsim.py')
+
+SIMULATOR_OPTIONS = ["adapter=", "backlog=", "layout=", "mtu=", "rate=", "adv_interval=", "connect_latency=", "resolve_latency=",
+                     "connect_failures=", "drop=", "reach=", "max_connections=", "sync_mode="]
+
+def usage():
+    print('Usage:')
+    print('  load.py [options] [nodes ...] [-- gateway options]')
+    print('Options:')
+    print('  -h, --help                Show help')
+    print('  -c, --connections=N       Concurrent connections of the gateway per adapter (default: 3)')
+    print('      --timeout=SECONDS     Abort a run after this time (default: 600)')
+    print('  -V, --verbose             Show the log output of the simulator and the gateway')
+    print('Simulator options (see bluezsim.py --help):')
+    for option in SIMULATOR_OPTIONS:
+        print('      --{}'.format(option))
+
+def start_bus():
+    daemon = subprocess.Popen(['dbus-daemon', '--session', '--nofork', '--print-address=1'],
+                              stdout=subprocess.PIPE, universal_newlines=True)
+    address = daemon.stdout.readline().strip()
+    if address == '':
+        daemon.kill()
+        raise RuntimeError('dbus-daemon did not report its address')
+    return daemon, address
+
+def start_simulator(address, nodes, options, log):
+    simulator = subprocess.Popen([sys.executable, SIMULATOR, '-a', address, '-n', str(nodes)] + options,
+                                 stdout=subprocess.PIPE, stderr=log, universal_newlines=True)
+    if simulator.stdout.readline().strip() != 'ready':
+        simulator.kill()
+        raise RuntimeError('Simulator failed to start')
+    return simulator
+
+def run_gateway(address, connections, options, timeout, log):
+    env = dict(os.environ)
+    env[dbluez.BUS_ADDRESS_ENV] = address
+
+    result = {'records': 0, 'nodes': set()}
+
+    def read(stream):
+        for line in stream:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            for node, records in message.items():
+                result['nodes'].add(node)
+                result['records'] = result['records'] + len(records)
+
+    started = time.time()
+    gateway = subprocess.Popen([sys.executable, GATEWAY, '-c', str(connections)] + options, env=env,
+                               stdout=subprocess.PIPE, stderr=log, universal_newlines=True)
+    reader = threading.Thread(target=read, args=(gateway.stdout,))
+    reader.start()
+    try:
+        gateway.wait(timeout)
+    except subprocess.TimeoutExpired:
+        gateway.kill()
+        gateway.wait()
+        result['timeout'] = True
+    reader.join()
+
+    result['elapsed'] = time.time() - started
+    result['returncode'] = gateway.returncode
+    return result
+
+def stop(process):
+    if process.poll() == None:
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+def main():
+    connections = 3
+    timeout = 600
+    verbose = False
+    simulator_options = []
+
+    argv = sys.argv[1:]
+    gateway_options = []
+    if '--' in argv:
+        gateway_options = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+
+    try:
+        opts, args = getopt.getopt(argv, "hc:V", ["help", "connections=", "timeout=", "verbose"] + SIMULATOR_OPTIONS)
+    except getopt.GetoptError as err:
+        print(err)
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif o in ('-c', '--connections'):
+            connections = int(a)
+        elif o == '--timeout':
+            timeout = float(a)
+        elif o in ('-V', '--verbose'):
+            verbose = True
+        elif o[2:] + '=' in SIMULATOR_OPTIONS:
+            simulator_options.extend([o, a])
+        else:
+            assert False, "unhandled option"
+
+    sizes = [int(x) for x in args] or [1, 10, 50, 100, 200]
+    if '--adapter' in simulator_options:
+        gateway_options = ['-i', simulator_options[simulator_options.index('--adapter') + 1]] + gateway_options
+
+    backlog = 1000
+    if '--backlog' in simulator_options:
+        backlog = int(simulator_options[simulator_options.index('--backlog') + 1])
+
+    log = None if verbose else subprocess.DEVNULL
+
+    # sessions already start while the gateway scans, the rate is over the whole run
+    print('{:>6} {:>10} {:>10} {:>7} {:>10} {:>12}'.format('nodes', 'records', 'expected', 'synced', 'total [s]', 'records/s'))
+    for nodes in sizes:
+        daemon, address = start_bus()
+        simulator = None
+        try:
+            simulator = start_simulator(address, nodes, simulator_options, log)
+            result = run_gateway(address, connections, gateway_options, timeout, log)
+        finally:
+            if simulator != None:
+                stop(simulator)
+            stop(daemon)
+
+        print('{:>6} {:>10} {:>10} {:>7} {:>10.2f} {:>12.0f}{}'.format(
+            nodes, result['records'], nodes * backlog, len(result['nodes']), result['elapsed'],
+            result['records'] / result['elapsed'], ' (timeout)' if result.get('timeout') else ''), flush=True)
+
+if __name__ == '__main__':
+    main()
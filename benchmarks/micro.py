@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+
+# Micro-benchmarks of the per-record hot paths of parser.Thingsboard on the
+# stored payload corpus (benchmarks/corpus/*.bin):
+#
+#   decode  RecordDecoder.decode per indication, as called from handleValue
+#   bulk    RecordDecoder.decode_bulk over a whole session (-b)
+#   emit    Thingsboard.emit per indication into a batching stdout sink
+#
+# For every stage and layout the throughput, the memory blocks allocated per
+# record, the blocks still retained once the output of the stage is dropped
+# (leaks) and the peak traced memory per record are reported and compared to
+# benchmarks/baseline.json. Allocations and the peak are divided by the
+# records a stage holds at once: all of them for decode/bulk, which return
+# every record, one output document for emit. Exits with 1 on a regression.
+# With --capture the sessions of gateway capture files (see capture.py) are
+# measured instead, grouped by layout.
+#
+#   python3 benchmarks/micro.py [options] [layouts ...]
+
+import os
+import sys
+import gc
+import json
+import time
+import getopt
+import platform
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+import parser
+import sink
+import corpus
+import capture
+
+BASELINE = os.path.join(HERE, 'baseline.json')
+
+STAGES = ['decode', 'bulk', 'emit']
+
+class CorpusDevice:
+    def getAddress(self):
+        return 'AF:C0:00:00:00:00'
+
+class Probe:
+    # allocated blocks at the batch boundaries of a stage, above the blocks
+    # in use when the stage started
+    def __init__(self, sampling = True):
+        self.sampling = sampling
+        self.held = 1
+        self.blocks = 0
+        if sampling:
+            gc.collect()
+            self._base = sys.getallocatedblocks()
+
+    def sample(self):
+        if self.sampling:
+            gc.collect()
+            self.blocks = max(self.blocks, sys.getallocatedblocks() - self._base)
+
+class NullOutput:
+    def __init__(self, probe):
+        self.bytes = 0
+        self._probe = probe
+
+    def write(self, data):
+        # a whole document of the sink is in memory here
+        self._probe.sample()
+        self.bytes = self.bytes + len(data)
+        return len(data)
+
+    def flush(self):
+        None
+
+def Timestamps(payloads):
+    return [1600000000000 + x * 1000 for x in range(0, len(payloads))]
+
+def DecodeStage(decoder, payloads, loops):
+    timestamps = Timestamps(payloads)
+
+    def run(probe):
+        records = []
+        for x in range(0, loops):
+            for data, ts in zip(payloads, timestamps):
+                records.extend(decoder.decode(data, ts))
+        probe.held = len(records)
+        probe.sample()
+        return records
+    return run
+
+def BulkStage(decoder, payloads, loops):
+    payloads = payloads * loops
+    timestamps = Timestamps(payloads)
+
+    def run(probe):
+        records = list(decoder.decode_bulk(payloads, timestamps))
+        probe.held = len(records)
+        probe.sample()
+        return records
+    return run
+
+def EmitStage(decoder, payloads, loops):
+    # handleValue emits the records of every indication
+    timestamps = Timestamps(payloads)
+    batches = [decoder.decode(data, ts) for data, ts in zip(payloads, timestamps)] * loops
+
+    def run(probe):
+        output = sink.StreamSink(NullOutput(probe), max_latency=0)
+        board = parser.Thingsboard(CorpusDevice(), output=output)
+        board._node_name = 'bench-node'
+        for batch in batches:
+            board._jdata = list(batch)
+            board.emit()
+        output.close()
+        probe.held = output.records / max(1, output.batches)
+        return None
+    return run
+
+def CaptureCases(paths):
+    cases = {}
+    for path in paths:
+        for session in capture.ReadCapture(path):
+            if len(session.payloads) > 0:
+                case = cases.setdefault(session.layout, ['capture/{}'.format(session.node_name), session.layout, []])
+                case[2].extend(session.payloads)
+    return sorted(cases.values())
+
+def Measure(run, records, repeat):
+    best = None
+    for x in range(0, repeat):
+        probe = Probe(False)
+        gc.collect()
+        start = time.perf_counter()
+        result = run(probe)
+        elapsed = time.perf_counter() - start
+        result = None
+        best = elapsed if best == None else min(best, elapsed)
+
+    probe = Probe()
+    result = run(probe)
+    result = None
+    gc.collect()
+    retained = sys.getallocatedblocks() - probe._base
+
+    gc.collect()
+    tracemalloc.start()
+    result = run(Probe(False))
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result = None
+
+    return {
+        'records_per_s': records / best,
+        'allocated_blocks_per_record': probe.blocks / probe.held,
+        'retained_blocks_per_record': max(0, retained) / records,
+        'peak_bytes_per_record': peak / probe.held
+    }
+
+def Regressions(result, baseline, tolerance):
+    problems = []
+    if result['records_per_s'] < baseline['records_per_s'] * (1 - tolerance):
+        problems.append('throughput {:.0f} < {:.0f} records/s'.format(result['records_per_s'], baseline['records_per_s']))
+    # compared at the precision of the baseline, so stages that retain
+    # nothing do not flap on a stray block; older baselines lack some metrics
+    for metric, unit in (('allocated_blocks_per_record', 'allocated blocks/record'),
+                         ('retained_blocks_per_record', 'retained blocks/record'),
+                         ('peak_bytes_per_record', 'peak bytes/record')):
+        if metric in baseline and round(result[metric], 2) > baseline[metric] * (1 + tolerance):
+            problems.append('{:.2f} > {:.2f} {}'.format(result[metric], baseline[metric], unit))
+    return problems
+
+def usage():
+    print('Usage:')
+    print('  micro.py [options] [layouts ...]')
+    print('Options:')
+    print('  -h, --help                Show help')
+    print('  -s, --stage=<stage>       Only run the given stage: {} (repeatable)'.format(', '.join(STAGES)))
+    print('  -n, --records=N           Records per measurement (default: 100000)')
+    print('  -r, --repeat=N            Timed runs per measurement, the fastest one counts (default: 5)')
+    print('  -t, --tolerance=FRACTION  Allowed deviation from the baseline (default: 0.25)')
+    print('  -c, --capture=<file>      Measure the sessions of a capture file instead of the corpus (repeatable)')
+    print('      --save                Store the results as new baseline in {}'.format(BASELINE))
+
+def main():
+    stages = []
+    records = 100000
+    repeat = 5
+    tolerance = 0.25
+    save = False
+    captures = []
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hs:n:r:t:c:", ["help", "stage=", "records=", "repeat=", "tolerance=", "capture=", "save"])
+    except getopt.GetoptError as err:
+        print(err)
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif o in ('-s', '--stage'):
+            if a not in STAGES:
+                print('Unknown stage: {}'.format(a))
+                usage()
+                sys.exit(2)
+            stages.append(a)
+        elif o in ('-n', '--records'):
+            records = int(a)
+        elif o in ('-r', '--repeat'):
+            repeat = int(a)
+        elif o in ('-t', '--tolerance'):
+            tolerance = float(a)
+        elif o in ('-c', '--capture'):
+            captures.append(a)
+        elif o == '--save':
+            save = True
+        else:
+            assert False, "unhandled option"
+
+    stages = stages or STAGES
+    if len(captures) > 0:
+        cases = CaptureCases(captures)
+    else:
+        cases = [[name] + list(corpus.Load(name)) for name in args or sorted(corpus.LAYOUTS.keys())]
+
+    baseline = {'stages': {}}
+    if os.path.exists(BASELINE):
+        with open(BASELINE, 'r') as f:
+            baseline = json.load(f)
+    if not save and baseline.get('python') not in (None, platform.python_version()):
+        print('Baseline was recorded with Python {}, running {}'.format(baseline['python'], platform.python_version()))
+    if parser.numpy == None and 'bulk' in stages:
+        print('NumPy not available, bulk falls back to the scalar decoder')
+
+    results = {}
+    failed = False
+    print('{:<20} {:>14} {:>12} {:>12} {:>14}  {}'.format('stage', 'records/s', 'alloc/rec', 'retained/rec', 'peak B/rec', 'baseline'))
+    for name, layout, payloads in cases:
+        try:
+            decoder = parser.RecordDecoder.compile(layout)
+        except KeyError as e:
+            print('{:<20} unknown descriptor {}'.format(name, e))
+            continue
+        per_loop = sum(data[0] for data in payloads)
+        loops = max(1, -(-records // per_loop))
+
+        for stage in stages:
+            run = {'decode': DecodeStage, 'bulk': BulkStage, 'emit': EmitStage}[stage](decoder, payloads, loops)
+            key = '{}/{}'.format(stage, name)
+            result = Measure(run, per_loop * loops, repeat)
+            results[key] = result
+
+            status = 'n/a'
+            if key in baseline['stages']:
+                problems = Regressions(result, baseline['stages'][key], tolerance)
+                status = 'ok' if len(problems) == 0 else 'REGRESSION: ' + ', '.join(problems)
+                failed = failed or len(problems) > 0
+            print('{:<20} {:>14.0f} {:>12.2f} {:>12.2f} {:>14.1f}  {}'.format(
+                key, result['records_per_s'], result['allocated_blocks_per_record'], result['retained_blocks_per_record'],
+                result['peak_bytes_per_record'], status), flush=True)
+
+    if save:
+        baseline['python'] = platform.python_version()
+        baseline['numpy'] = parser.numpy != None
+        for key, result in results.items():
+            baseline['stages'][key] = {metric: round(value, 2) for metric, value in result.items()}
+        tmp = BASELINE + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        os.replace(tmp, BASELINE)
+        print('Stored baseline in {}'.format(BASELINE))
+    elif failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
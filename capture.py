@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+# Raw capture of synchronization sessions.
+#
+# The gateway appends the indications of every session undecoded, so data
+# that could not be decoded, e.g. because of an unknown descriptor, is not
+# lost and can be decoded again later on:
+#
+#   header      <4sB   magic 'AFCR', version
+#   frame       <cHH   type, session id, body length, followed by the body
+#
+#   'S' start       <qB address length, address, <B node name length, node
+#                   name, <B number of descriptors, 16s UUID of every field
+#                   in characteristic order; the time is in ms
+#   'I' indication  <I ms since the start of the session, payload
+#   'E' end         <B 1 if the session succeeded
+#
+# Frames of concurrent sessions are interleaved. A torn frame at the end of
+# the file is cut off before the writer appends to it again.
+#
+#   capture.py show <file> ...
+#   capture.py replay [options] <file> ...
+
+import os
+import sys
+import time
+import uuid
+import struct
+import getopt
+import logging
+
+from threading import Lock
+
+import parser
+import sink
+
+CAPTURE_MAGIC = b'AFCR'
+CAPTURE_VERSION = 1
+
+HEADER = struct.Struct('<4sB')
+FRAME = struct.Struct('<cHH')
+START = struct.Struct('<qB')
+INDICATION = struct.Struct('<I')
+END = struct.Struct('<B')
+
+FRAME_START = b'S'
+FRAME_INDICATION = b'I'
+FRAME_END = b'E'
+
+def _string(value):
+    data = value.encode('utf-8')[:255]
+    return bytes([len(data)]) + data
+
+def Frames(data, path = ''):
+    magic, version = HEADER.unpack_from(data, 0) if len(data) >= HEADER.size else (None, None)
+    if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+        raise ValueError('{} is not a version {} capture file'.format(path, CAPTURE_VERSION))
+
+    pos = HEADER.size
+    while pos + FRAME.size <= len(data):
+        kind, session, length = FRAME.unpack_from(data, pos)
+        if pos + FRAME.size + length > len(data):
+            break
+        yield pos, kind, session, data[pos + FRAME.size:pos + FRAME.size + length]
+        pos = pos + FRAME.size + length
+
+class Session:
+
+    def __init__(self, body):
+        self.start, length = START.unpack_from(body, 0)
+        pos = START.size
+        self.address = body[pos:pos + length].decode('utf-8')
+        pos = pos + length
+        self.node_name = body[pos + 1:pos + 1 + body[pos]].decode('utf-8') or self.address
+        pos = pos + 1 + body[pos]
+        self.layout = tuple(str(uuid.UUID(bytes=body[pos + 1 + x * 16:pos + 17 + x * 16])) for x in range(0, body[pos]))
+        self.payloads = []
+        self.timestamps = []
+        self.success = None
+
+    def records(self):
+        return sum(data[0] for data in self.payloads)
+
+    def bytes(self):
+        return sum(len(data) for data in self.payloads)
+
+def ReadCapture(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    # payloads stay raw, they are only decoded when a session is replayed
+    sessions = []
+    active = {}
+    end = HEADER.size
+    for pos, kind, session, body in Frames(data, path):
+        end = pos + FRAME.size + len(body)
+        if kind == FRAME_START:
+            active[session] = Session(body)
+            sessions.append(active[session])
+        elif kind == FRAME_INDICATION and session in active:
+            offset, = INDICATION.unpack_from(body, 0)
+            active[session].timestamps.append(active[session].start + offset)
+            active[session].payloads.append(body[INDICATION.size:])
+        elif kind == FRAME_END and session in active:
+            active.pop(session).success = END.unpack(body)[0] == 1
+
+    if end < len(data):
+        logging.getLogger(__name__).warning('Ignoring {} bytes of a torn frame at the end of {}'.format(len(data) - end, path))
+    return sessions
+
+class CaptureWriter:
+
+    def __init__(self, path):
+        self._logger = logging.getLogger(__name__)
+        self._path = path
+        self._mutex = Lock()
+        self._sessions = {}
+        self._next = 0
+
+        self._file = open(path, 'ab')
+        size = self._file.tell()
+        if size == 0:
+            self._file.write(HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION))
+            self._file.flush()
+        else:
+            with open(path, 'rb') as f:
+                data = f.read()
+            end = HEADER.size
+            for pos, kind, session, body in Frames(data, path):
+                end = pos + FRAME.size + len(body)
+            if end < size:
+                self._logger.warning('Cutting off {} bytes of a torn frame at the end of {}'.format(size - end, path))
+                self._file.truncate(end)
+
+        self.sessions = 0
+        self.bytes = 0
+
+    def _append(self, kind, session, body):
+        if self._file == None:
+            return
+        try:
+            self._file.write(FRAME.pack(kind, session, len(body)) + body)
+        except Exception as e:
+            self._logger.error('Could not write capture {}, stopping capture: {}'.format(self._path, e))
+            self._file = None
+            return
+        self.bytes = self.bytes + FRAME.size + len(body)
+
+    def begin(self, address, node_name, layout):
+        start = int(round(time.time() * 1000))
+        body = START.pack(start, len(address)) + address.encode('utf-8') + _string(node_name or '') + \
+               bytes([len(layout)]) + b''.join(uuid.UUID(descriptor).bytes for descriptor in layout)
+        with self._mutex:
+            session = self._next
+            self._next = (self._next + 1) % 65536
+            self._sessions[session] = start
+            self._append(FRAME_START, session, body)
+            self.sessions = self.sessions + 1
+        return session
+
+    def indication(self, session, ts, data):
+        with self._mutex:
+            self._append(FRAME_INDICATION, session, INDICATION.pack(max(0, ts - self._sessions[session])) + data)
+
+    def end(self, session, success):
+        with self._mutex:
+            self._sessions.pop(session, None)
+            self._append(FRAME_END, session, END.pack(1 if success else 0))
+            if self._file != None:
+                self._file.flush()
+
+    def close(self):
+        with self._mutex:
+            if self._file != None:
+                self._file.close()
+                self._file = None
+        self._logger.debug('Captured {} sessions, {} bytes'.format(self.sessions, self.bytes))
+
+class ReplayDevice:
+    def __init__(self, address):
+        self._address = address
+
+    def getAddress(self):
+        return self._address
+
+def Replay(session, output, bulk = False):
+    # the same decode and emit path as a live session, without the BLE part
+    board = parser.Thingsboard(ReplayDevice(session.address), bulk, output)
+    board.setLayout(session.node_name, session.layout)
+    for data, ts in zip(session.payloads, session.timestamps):
+        board.processValue(data, ts)
+    board.flushValues()
+
+def usage():
+    print('Usage:')
+    print('  capture.py show <file> ...               Summarize the sessions of capture files')
+    print('  capture.py replay [options] <file> ...   Decode capture files into gateway telemetry')
+    print('Options:')
+    print('  -h, --help                Show help')
+    print('  -b, --bulk                Decode a session at once (uses NumPy if available)')
+    print('  -o, --output=<file>       Append the telemetry to a file instead of stdout')
+    print('  -n, --dry-run             Decode only, discard the telemetry')
+    print('  -a, --address=<address>   Only replay the sessions of a device (repeatable)')
+
+class NullStream:
+    def write(self, data):
+        return len(data)
+
+    def flush(self):
+        None
+
+def main():
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s', level=logging.INFO)
+
+    if len(sys.argv) < 2 or sys.argv[1] not in ('show', 'replay'):
+        usage()
+        sys.exit(2)
+
+    try:
+        opts, args = getopt.getopt(sys.argv[2:], "hbo:na:", ["help", "bulk", "output=", "dry-run", "address="])
+    except getopt.GetoptError as err:
+        print(err)
+        usage()
+        sys.exit(2)
+
+    bulk = False
+    output_path = None
+    dry_run = False
+    addresses = []
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif o in ('-b', '--bulk'):
+            bulk = True
+        elif o in ('-o', '--output'):
+            output_path = a
+        elif o in ('-n', '--dry-run'):
+            dry_run = True
+        elif o in ('-a', '--address'):
+            addresses.append(a.upper())
+        else:
+            assert False, "unhandled option"
+
+    if len(args) == 0:
+        usage()
+        sys.exit(2)
+
+    sessions = []
+    for path in args:
+        sessions.extend(session for session in ReadCapture(path) if len(addresses) == 0 or session.address in addresses)
+
+    if sys.argv[1] == 'show':
+        for session in sessions:
+            print('{} {:<17} {:<20} {:>2} fields {:>6} indications {:>8} records {:>8} bytes {}'.format(
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(session.start / 1000)), session.address, session.node_name,
+                len(session.layout), len(session.payloads), session.records(), session.bytes(),
+                {True: 'ok', False: 'failed', None: 'incomplete'}[session.success]))
+        return
+
+    if dry_run:
+        output = sink.StreamSink(NullStream(), max_latency=0)
+    elif output_path != None:
+        output = sink.FileSink(output_path, max_latency=0)
+    else:
+        output = sink.StreamSink(sys.stdout, max_latency=0)
+
+    logger = logging.getLogger(__name__)
+    failed = 0
+    started = time.time()
+    for session in sessions:
+        try:
+            Replay(session, output, bulk)
+        except (KeyError, struct.error) as e:
+            failed = failed + 1
+            logger.error('Could not decode session of {} started at {}: {} {}'.format(
+                session.address, session.start, type(e).__name__, e))
+    output.close()
+    elapsed = time.time() - started
+
+    records = sum(session.records() for session in sessions)
+    logger.info('Replayed {} sessions ({} failed) with {} records in {:.3f} s, {:.0f} records/s'.format(
+        len(sessions), failed, records, elapsed, records / elapsed if elapsed > 0 else 0))
+    if failed > 0:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -3,11 +3,19 @@
 # inspired by: https://github.com/aykevl/pynus
 # inspired by: https://github.com/michael-platzer/ble-data-hub
 
+import os
+import socket
 import dbus
 import dbus.service
 import dbus.mainloop.glib
 from gi.repository import GLib
 import logging
+import hashlib
+import struct
+import weakref
+import functools
+from threading import Lock
+from collections import namedtuple
 
 import time
 
@@ -23,8 +31,79 @@ BLUEZ_GATTDESC = 'org.bluez.GattDescriptor1'
 
 EDDYSTONE_UUID = '0000feaa-0000-1000-8000-00805f9b34fb'
 
+EDDYSTONE_UID  = 0x00
+EDDYSTONE_URL  = 0x10
+EDDYSTONE_TLM  = 0x20
+EDDYSTONE_EID  = 0x30
+
+EDDYSTONE_URL_SCHEMES = [b'http://www.', b'https://www.', b'http://', b'https://']
+EDDYSTONE_URL_CODES   = [b'.com/', b'.org/', b'.edu/', b'.net/', b'.info/', b'.biz/', b'.gov/',
+                         b'.com', b'.org', b'.edu', b'.net', b'.info', b'.biz', b'.gov']
+
 BLE_GATT_CCCD  = '00002902-0000-1000-8000-00805f9b34fb'
 
+# address of a private bus that replaces the system bus, e.g. the one of the
+# simulated BlueZ service in benchmarks/bluezsim.py
+BUS_ADDRESS_ENV = 'DBLUEZ_BUS_ADDRESS'
+
+_bus = None
+_proxies = None
+
+def SystemBus():
+    global _bus
+    if _bus == None:
+        address = os.environ.get(BUS_ADDRESS_ENV)
+        if address != None:
+            _bus = dbus.bus.BusConnection(address)
+        else:
+            _bus = dbus.SystemBus()
+    return _bus
+
+class ProxyRegistry:
+    # BlueZ proxies by object path and interface, shared by all scanners and
+    # devices. Creating a proxy introspects the remote object, so every path
+    # is only introspected once for as long as anybody holds its proxy
+    def __init__(self, bus):
+        self._bus = bus
+        self._mutex = Lock()
+        self._objects = weakref.WeakValueDictionary()
+        self._interfaces = weakref.WeakValueDictionary()
+        self.created = 0
+        self.reused = 0
+
+    def object(self, path):
+        with self._mutex:
+            return self._object(str(path))
+
+    def _object(self, path):
+        obj = self._objects.get(path)
+        if obj == None:
+            obj = self._bus.get_object(BLUEZ, path)
+            self._objects[path] = obj
+            self.created = self.created + 1
+        else:
+            self.reused = self.reused + 1
+        return obj
+
+    def interface(self, path, interface):
+        key = (str(path), interface)
+        with self._mutex:
+            proxy = self._interfaces.get(key)
+            if proxy == None:
+                # the interface keeps its object alive
+                proxy = dbus.Interface(self._object(key[0]), interface)
+                self._interfaces[key] = proxy
+            return proxy
+
+    def __len__(self):
+        return len(self._objects)
+
+def Proxies():
+    global _proxies
+    if _proxies == None:
+        _proxies = ProxyRegistry(SystemBus())
+    return _proxies
+
 def GetServiceProperty(device, property):
     properties = dbus.Interface(device, DBUS_PROPS)
     return properties.Get(BLUEZ_GATTSERV, property)
@@ -41,79 +120,380 @@ def GetPropertiesChangedCb(device, cb):
     char_props = dbus.Interface(device, DBUS_PROPS)
     return char_props.connect_to_signal('PropertiesChanged', lambda *args: cb(*args))
 
+class NotifySocket:
+    # values of a characteristic read from the socket handed out by
+    # AcquireNotify, instead of one PropertiesChanged signal per value. Every
+    # datagram is one value. Once the socket is readable all queued values
+    # are received into one reusable buffer and passed on as a view into it,
+    # which is only valid during the callback: whoever keeps a value copies
+    # it. remove() closes the socket, which stops the notifications
+    def __init__(self, fd, mtu, value_cb):
+        self._logger = logging.getLogger(__name__)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET, 0, fd)
+        self._socket.setblocking(False)
+        self._buffer = bytearray(max(mtu, 23))
+        self._view = memoryview(self._buffer)
+        self._value_cb = value_cb
+        self._watch = GLib.io_add_watch(self._socket.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self._on_io)
+
+        self.values = 0
+        self.reads = 0
+
+    def _on_io(self, fd, condition):
+        if condition & GLib.IO_IN:
+            self.reads = self.reads + 1
+            while self._socket != None:
+                try:
+                    length = self._socket.recv_into(self._buffer)
+                except BlockingIOError:
+                    return True
+                except OSError as e:
+                    self._logger.error('Error reading notifications: {}'.format(e))
+                    break
+                if length == 0:
+                    break
+                self.values = self.values + 1
+                self._value_cb(self._view[:length])
+            if self._socket == None:
+                # removed by the callback
+                return False
+        self._close()
+        return False
+
+    def _close(self):
+        self._watch = None
+        if self._socket != None:
+            self._socket.close()
+            self._socket = None
+            self._logger.debug('Received {} values in {} reads'.format(self.values, self.reads))
+
+    def remove(self):
+        if self._watch != None:
+            GLib.source_remove(self._watch)
+        self._close()
+
+def AcquireNotifyCb(characteristic, value_cb):
+    # BlueZ only hands out notifications, not indications, and only once
+    # per characteristic; None means the caller has to use StartNotify
+    try:
+        fd, mtu = characteristic.AcquireNotify(dbus.Dictionary({}, signature='sv'))
+    except dbus.DBusException as e:
+        logging.getLogger(__name__).debug('AcquireNotify not available: {}'.format(e))
+        return None
+    return NotifySocket(fd.take(), int(mtu), value_cb)
+
+# weight of a new RSSI sample in the moving average of a node
+RSSI_ALPHA = 0.25
+
+def AverageRssi(scanners, address):
+    # moving average of the adapter with the best signal
+    averages = [scanner.averageRssi(address) for scanner in scanners.values()]
+    averages = [rssi for rssi in averages if rssi != None]
+    return max(averages) if len(averages) > 0 else None
+
+def UpdateRssi(node, rssi):
+    node['rssi'] = rssi
+    if node['best_rssi'] == None or rssi > node['best_rssi']:
+        node['best_rssi'] = rssi
+    if node['avg_rssi'] == None:
+        node['avg_rssi'] = float(rssi)
+    else:
+        node['avg_rssi'] = node['avg_rssi'] + RSSI_ALPHA * (rssi - node['avg_rssi'])
+
+def Reach(scanners, address):
+    # adapters that received advertisements of a node, best signal first
+    reach = []
+    for adapter, scanner in scanners.items():
+        rssi = scanner.bestRssi(address)
+        if rssi != None:
+            reach.append((adapter, rssi))
+    return sorted(reach, key=lambda entry: -entry[1])
+
+EddystoneFrame = namedtuple('EddystoneFrame', ['frametype', 'power', 'url', 'namespace', 'instance', 'eid', 'tlm'])
+EddystoneTelemetry = namedtuple('EddystoneTelemetry', ['version', 'battery', 'temperature', 'adv_count', 'uptime', 'encrypted'])
+
+@functools.lru_cache(maxsize=256)
+def DecodeEddystone(data):
+    if len(data) < 2:
+        raise ValueError('Eddystone frame too short: {}'.format(data))
+
+    frametype = data[0]
+    if frametype == EDDYSTONE_URL:
+        if len(data) < 3 or data[2] >= len(EDDYSTONE_URL_SCHEMES):
+            raise ValueError('Invalid Eddystone-URL frame: {}'.format(data))
+        url = EDDYSTONE_URL_SCHEMES[data[2]]
+        for c in data[3:]:
+            if c < len(EDDYSTONE_URL_CODES):
+                url = url + EDDYSTONE_URL_CODES[c]
+            else:
+                url = url + bytes([c])
+        return EddystoneFrame(frametype, struct.unpack('b', data[1:2])[0], url.decode(), None, None, None, None)
+
+    if frametype == EDDYSTONE_UID:
+        if len(data) < 18:
+            raise ValueError('Invalid Eddystone-UID frame: {}'.format(data))
+        return EddystoneFrame(frametype, struct.unpack('b', data[1:2])[0], None, data[2:12].hex(), data[12:18].hex(), None, None)
+
+    if frametype == EDDYSTONE_EID:
+        if len(data) < 10:
+            raise ValueError('Invalid Eddystone-EID frame: {}'.format(data))
+        return EddystoneFrame(frametype, struct.unpack('b', data[1:2])[0], None, None, None, data[2:10].hex(), None)
+
+    if frametype == EDDYSTONE_TLM:
+        version = data[1]
+        if version == 0x01:
+            tlm = EddystoneTelemetry(version, None, None, None, None, data[2:].hex())
+        elif version == 0x00 and len(data) >= 14:
+            battery, temperature, adv_count, uptime = struct.unpack('>HhII', data[2:14])
+            tlm = EddystoneTelemetry(version,
+                                     battery if battery != 0 else None,
+                                     temperature / 256 if temperature != -0x8000 else None,
+                                     adv_count, uptime / 10, None)
+        else:
+            raise ValueError('Invalid Eddystone-TLM frame: {}'.format(data))
+        return EddystoneFrame(frametype, None, None, None, None, None, tlm)
+
+    raise ValueError('Unknown Eddystone frame type 0x{:02x}'.format(frametype))
+
+def IndexGattObjects(device_path, objects):
+    prefix = device_path + '/'
+    characteristics = {}
+    flags = {}
+    descriptors = {}
+    layout = []
+    for path, interfaces in objects.items():
+        if not path.startswith(prefix):
+            continue
+        if BLUEZ_GATTSERV in interfaces:
+            layout.append((path[len(prefix):], str(interfaces[BLUEZ_GATTSERV]['UUID'])))
+        elif BLUEZ_GATTCHAR in interfaces:
+            c_props = interfaces[BLUEZ_GATTCHAR]
+            uuid = str(c_props['UUID'])
+            characteristics[uuid] = str(path)
+            flags[uuid] = [str(flag) for flag in c_props.get('Flags', [])]
+            layout.append((path[len(prefix):], uuid))
+        elif BLUEZ_GATTDESC in interfaces:
+            uuid = str(interfaces[BLUEZ_GATTDESC]['UUID'])
+            descriptors[str(path)] = uuid
+            layout.append((path[len(prefix):], uuid))
+
+    # BlueZ object paths follow the attribute handles, so paths and UUIDs
+    # together identify the GATT layout of a firmware version
+    fingerprint = hashlib.sha1(repr(sorted(layout)).encode()).hexdigest()
+    return characteristics, flags, descriptors, fingerprint
+
 #yes, you should get properties changed signals eg with rssi for those devices
 
+class ProxyMap:
+    # maps a key (UUID or object path) to a GATT object, the D-Bus proxy is
+    # only created when the object is actually used
+    def __init__(self, proxies, interface):
+        self._registry = proxies
+        self._interface = interface
+        self._paths = {}
+        self._proxies = {}
+
+    def add(self, key, path):
+        if self._paths.get(key) != path:
+            self._proxies.pop(key, None)
+        self._paths[key] = path
+
+    def update(self, paths):
+        # proxies of objects that kept their path survive a rediscovery
+        for key in list(self._paths.keys()):
+            if paths.get(key) != self._paths[key]:
+                del self._paths[key]
+                self._proxies.pop(key, None)
+        for key, path in paths.items():
+            self.add(key, path)
+
+    def path(self, key):
+        return self._paths[key]
+
+    def keys(self):
+        return self._paths.keys()
+
+    def __contains__(self, key):
+        return key in self._paths
+
+    def __iter__(self):
+        return iter(self._paths)
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __getitem__(self, key):
+        proxy = self._proxies.get(key)
+        if proxy == None:
+            proxy = self._registry.interface(self._paths[key], self._interface)
+            self._proxies[key] = proxy
+        return proxy
+
 class Scanner:
     def __init__(self, adapter, new_device_cb):
         self._adapter = adapter
         self._path = '/org/bluez/{}'.format(adapter)
         self._logger = logging.getLogger(__name__)
         
-        self._sysbus = dbus.SystemBus()
-        self._bluez = dbus.Interface(self._sysbus.get_object(BLUEZ, '/'), DBUS_OBJ_MAN)
+        self._sysbus = SystemBus()
+        self._bluez = Proxies().interface('/', DBUS_OBJ_MAN)
 
-        self._adapterobj = dbus.Interface(self._sysbus.get_object(BLUEZ, self._path), BLUEZ_ADAPTER)
+        self._adapterobj = Proxies().interface(self._path, BLUEZ_ADAPTER)
         
         self._sig_recv_new = self._sysbus.add_signal_receiver(lambda *args: self._on_new_device(*args), dbus_interface=DBUS_OBJ_MAN, signal_name='InterfacesAdded')
         self._sig_recv_rem = self._sysbus.add_signal_receiver(lambda *args: self._on_rem_device(*args), dbus_interface=DBUS_OBJ_MAN, signal_name='InterfacesRemoved')
-        self._sig_prop_chg = self._sysbus.add_signal_receiver(lambda *args: self._on_prop_changed(*args), dbus_interface=DBUS_OBJ_MAN, signal_name = "PropertiesChanged",
-                                                              arg0 = "org.bluez.Device1", path_keyword = "path")
+        self._sig_prop_chg = self._sysbus.add_signal_receiver(lambda *args, **kwargs: self._on_prop_changed(*args, **kwargs), dbus_interface=DBUS_PROPS, signal_name = "PropertiesChanged",
+                                                              arg0 = BLUEZ_DEVICE, path_keyword = "path")
 
         self._new_device_cb = new_device_cb
         self._rem_dev_cb = None
 
+        self.nodes = {}
+        self._reported = set()
+        self._scanning = False
+
     def __enter__(self):
-        for path, interfaces in self._bluez.GetManagedObjects().items():
-            if BLUEZ_DEVICE in interfaces:
-                self._on_new_device(path, interfaces)
+        self.startScan()
 
     def __exit__(self, type, value, traceback):    
         self._sig_recv_new.remove()
         self._sig_recv_rem.remove()
+        self._sig_prop_chg.remove()
     
     def _on_new_device(self, path, interfaces):
-        #print(path);
-        if BLUEZ_DEVICE in interfaces:
+        if BLUEZ_DEVICE in interfaces and path.startswith(self._path + '/'):
             props = interfaces[BLUEZ_DEVICE]
-            if EDDYSTONE_UUID in props['UUIDs']:
-                data      = bytes(props['ServiceData'][EDDYSTONE_UUID])
-                frametype = data[0]
-                power     = data[1]
-                url       = data[2:]
-                if url[0] == 0:
-                    url = b'http://www.' + url[1:]
-                elif url[0] == 1:
-                    url = b'https://www.' + url[1:]
-                elif url[0] == 2:
-                    url = b'http://' + url[1:]
-                elif url[0] == 3:
-                    url = b'https://' + url[1:]
-                    
-                url = url.replace(b'\x03', b'.net/')
-                url = url.decode()
-                
-                self._new_device_cb(self._adapter, props['Address'], frametype, power, url)
+            rssi = int(props['RSSI']) if 'RSSI' in props else None
+            self.nodes[path] = {
+                'address': str(props['Address']),
+                'rssi': rssi,
+                'best_rssi': rssi,
+                'avg_rssi': float(rssi) if rssi != None else None,
+                'frames': {}
+                }
+            if 'ServiceData' in props and EDDYSTONE_UUID in props['ServiceData']:
+                self._on_service_data(path, props['ServiceData'][EDDYSTONE_UUID])
             
     def _on_rem_device(self, path, interfaces):
         if BLUEZ_DEVICE in interfaces:
+            self.nodes.pop(path, None)
             if self._rem_dev_cb != None:
                 self._rem_dev_cb(path)
     
-    def _on_prop_changed(self, properties, changed_props, invalidated_props):
-        self._logger.info('Changed properties: {}'.format(changed_props))
+    def _on_prop_changed(self, interface, changed_props, invalidated_props, path = None):
+        node = self.nodes.get(path)
+        if node == None:
+            return
+
+        if 'RSSI' in changed_props:
+            UpdateRssi(node, int(changed_props['RSSI']))
+        if 'ServiceData' in changed_props and EDDYSTONE_UUID in changed_props['ServiceData']:
+            self._on_service_data(path, changed_props['ServiceData'][EDDYSTONE_UUID])
+
+    def _on_service_data(self, path, data):
+        node = self.nodes[path]
+        try:
+            frame = DecodeEddystone(bytes(data))
+        except ValueError as e:
+            self._logger.debug('Ignoring advertisement of {}: {}'.format(node['address'], e))
+            return
+
+        node['frames'][frame.frametype] = frame
+        if frame.frametype == EDDYSTONE_TLM or (node['address'], frame.frametype) in self._reported:
+            return
+
+        self._reported.add((node['address'], frame.frametype))
+        self._new_device_cb(self._adapter, node['address'], frame.frametype, frame.power, frame.url)
+
+    def rssi(self, address):
+        node = self.nodes.get('{}/dev_{}'.format(self._path, address.replace(':', '_')))
+        if node == None:
+            return None
+        return node['rssi']
+
+    def bestRssi(self, address):
+        node = self.nodes.get('{}/dev_{}'.format(self._path, address.replace(':', '_')))
+        if node == None:
+            return None
+        return node['best_rssi']
+
+    def averageRssi(self, address):
+        node = self.nodes.get('{}/dev_{}'.format(self._path, address.replace(':', '_')))
+        if node == None:
+            return None
+        return node['avg_rssi']
+
+    def forget(self, address):
+        # the next advertisement reports the node again
+        self._reported = set(entry for entry in self._reported if entry[0] != address)
     
     def startScan(self):
+        self._reported = set()
         self._adapterobj.SetDiscoveryFilter({
             'Transport': 'le',
             'UUIDs': [EDDYSTONE_UUID]
             })
         self._adapterobj.StartDiscovery()
+        self._scanning = True
+
+        # devices already known to BlueZ do not trigger InterfacesAdded again,
+        # only report those that were seen recently (BlueZ drops RSSI otherwise)
+        for path, interfaces in self._bluez.GetManagedObjects().items():
+            if BLUEZ_DEVICE in interfaces and 'RSSI' not in interfaces[BLUEZ_DEVICE]:
+                props = dict(interfaces[BLUEZ_DEVICE])
+                props.pop('ServiceData', None)
+                interfaces = {BLUEZ_DEVICE: props}
+            self._on_new_device(path, interfaces)
         
     def stopScan(self):
-        self._adapterobj.StopDiscovery()
+        # the scan may already have been stopped at the end of the scan window
+        if self._scanning:
+            self._scanning = False
+            self._adapterobj.StopDiscovery()
+
+class MultiScanner:
+    # scans on several adapters at once, a node is reported once no matter
+    # how many adapters receive its advertisements
+    def __init__(self, adapters, new_device_cb):
+        self._new_device_cb = new_device_cb
+        self._reported = set()
+        self.scanners = {adapter: Scanner(adapter, self._on_new_device) for adapter in adapters}
+
+    def __enter__(self):
+        self.startScan()
+
+    def __exit__(self, type, value, traceback):
+        for scanner in self.scanners.values():
+            scanner.__exit__(type, value, traceback)
+
+    def _on_new_device(self, adapter, address, frametype, power, url):
+        if (address, frametype) in self._reported:
+            return
+        self._reported.add((address, frametype))
+        self._new_device_cb(adapter, address, frametype, power, url)
+
+    def reach(self, address):
+        return Reach(self.scanners, address)
+
+    def averageRssi(self, address):
+        return AverageRssi(self.scanners, address)
+
+    def forget(self, address):
+        self._reported = set(entry for entry in self._reported if entry[0] != address)
+        for scanner in self.scanners.values():
+            scanner.forget(address)
+
+    def startScan(self):
+        self._reported = set()
+        for scanner in self.scanners.values():
+            scanner.startScan()
+
+    def stopScan(self):
+        for scanner in self.scanners.values():
+            scanner.stopScan()
 
 class Device:
-    def __init__(self, adapter, address, frametype, power, url):
+    def __init__(self, adapter, address, frametype, power, url, connect_attempts = 3, connect_delay = 2, connect_timeout = 25):
         self._logger  = logging.getLogger('{}[{}]'.format(__name__, address))
         self._adapter = adapter
         self._address = address
@@ -122,14 +502,43 @@ class Device:
         self._url     = url
         self._sig_recv = None
         self._connect_time = 0
+
+        self._connect_attempts = connect_attempts
+        self._connect_delay = connect_delay
+        self._connect_timeout = connect_timeout
+        self._attempt = 0
+        self._connecting = False
+        self._cancelled = False
+        self._retry_timer = None
+        self._resolved = False
+        self.timing = {}
         
-        self._path = '/org/bluez/{}/dev_{}'.format(adapter, address.replace(':', '_'))
-        
-        self._sysbus = dbus.SystemBus()
-        self._bluez  = dbus.Interface(self._sysbus.get_object(BLUEZ, '/'), DBUS_OBJ_MAN)
-        self._adapterobj = dbus.Interface(self._sysbus.get_object(BLUEZ, '/org/bluez/{}'.format(self._adapter)), BLUEZ_ADAPTER)
+        self._proxies = Proxies()
+        self._bluez  = self._proxies.interface('/', DBUS_OBJ_MAN)
+        self.characteristics = ProxyMap(self._proxies, BLUEZ_GATTCHAR)
+        self.descriptors = ProxyMap(self._proxies, BLUEZ_GATTDESC)
+        self._bind(adapter)
+
+    def _bind(self, adapter):
+        self._adapter = adapter
+        self._path = '/org/bluez/{}/dev_{}'.format(adapter, self._address.replace(':', '_'))
+        self._adapterobj = self._proxies.interface('/org/bluez/{}'.format(adapter), BLUEZ_ADAPTER)
+        self._device = self._proxies.interface(self._path, BLUEZ_DEVICE)
+
+    def setAdapter(self, adapter):
+        # BlueZ has a device object per adapter, only switch between sessions
+        if adapter == self._adapter:
+            return
+        if self._connecting:
+            raise RuntimeError('Cannot change the adapter of {} while connecting'.format(self._address))
+        if self._sig_recv != None:
+            self._sig_recv.remove()
+            self._sig_recv = None
+        self._logger.debug('Using adapter {}'.format(adapter))
+        self._bind(adapter)
 
-        self._device = dbus.Interface(self._sysbus.get_object(BLUEZ, self._path), BLUEZ_DEVICE)
+    def getAdapter(self):
+        return self._adapter
         
     def __del__(self):
         self._logger.debug('device {} deleted'.format(self._path))
@@ -142,30 +551,37 @@ class Device:
             is_connected = bool(changed_props['Connected'])
             self._logger.debug('Connect property changed: {}'.format(is_connected))
             if is_connected == False:
+                if self._connecting:
+                    # a failed attempt, handled by the Connect error handler
+                    return
                 self._disconnect_cb(bool(changed_props['Connected']))
                 return
 
-        if 'ServicesResolved' in changed_props:
+        if 'ServicesResolved' in changed_props and bool(changed_props['ServicesResolved']):
             self._probe_services()
 
     def _probe_services(self):
-        man_objs = self._bluez.GetManagedObjects()
-
-        self.characteristics = {}
-        self.descriptors = {}
-        for path, interfaces in man_objs.items():
-            if path.startswith(self._path) and BLUEZ_GATTSERV in interfaces:
-                props = interfaces[BLUEZ_GATTSERV]
-                for c_path, c_ifaces in man_objs.items():
-                    if not c_path.startswith(path):
-                        continue
-                    if BLUEZ_GATTCHAR in c_ifaces:
-                        c_props = c_ifaces[BLUEZ_GATTCHAR]
-                        self.characteristics[c_props['UUID']] = dbus.Interface(self._sysbus.get_object(BLUEZ, c_path), BLUEZ_GATTCHAR)
-                    elif BLUEZ_GATTDESC in c_ifaces:
-                        c_props = c_ifaces[BLUEZ_GATTDESC]
-                        self.descriptors[c_path] = dbus.Interface(self._sysbus.get_object(BLUEZ, c_path), BLUEZ_GATTDESC)              
-        
+        if self._resolved or self._cancelled:
+            return
+        self._resolved = True
+        self.timing['resolved'] = time.time()
+        self._bluez.GetManagedObjects(reply_handler=self._on_managed_objects, error_handler=self._on_probe_error)
+
+    def _on_probe_error(self, e):
+        if self._cancelled:
+            return
+        self._logger.error('Error while reading the GATT tree: {}'.format(e))
+        self._disconnect_cb(False)
+
+    def _on_managed_objects(self, objects):
+        if self._cancelled:
+            return
+        characteristics, self.characteristic_flags, self.descriptor_uuids, self.layout_fingerprint = \
+            IndexGattObjects(self._path, objects)
+
+        self.characteristics.update(characteristics)
+        self.descriptors.update({path: path for path in self.descriptor_uuids.keys()})
+
         if self._discovery_cb != None:
             self._discovery_cb()
 
@@ -173,24 +589,97 @@ class Device:
         self._logger.debug('Connecting')
         self._discovery_cb = services_discovered_cb
         self._disconnect_cb = disconnect_cb
-        for x in range(0, 3):
-            try:
-                self._device.Connect()
-                device_props = dbus.Interface(self._device, DBUS_PROPS)
-                self._sig_recv = device_props.connect_to_signal('PropertiesChanged', lambda *args: self._on_prop_changed(*args))
-                self._connect_time = time.time()
-                return
-            except Exception as e:
-                self._logger.error('Error while connecting: {}'.format(e))
-                time.sleep(5)
-        self._logger.error('Error connecting 3 consequitve times. Aborting..')
-        self._disconnect_cb(False)
+        self._attempt = 0
+        self._connecting = True
+        self._cancelled = False
+        self._resolved = False
+        self.timing = {}
+
+        if self._sig_recv == None:
+            device_props = dbus.Interface(self._device, DBUS_PROPS)
+            self._sig_recv = device_props.connect_to_signal('PropertiesChanged', lambda *args: self._on_prop_changed(*args))
+        self._try_connect()
+
+    def _try_connect(self):
+        self._retry_timer = None
+        if self._cancelled:
+            return False
+        self._attempt = self._attempt + 1
+        self._device.Connect(reply_handler=self._on_connect_reply, error_handler=self._on_connect_error,
+                             timeout=self._connect_timeout)
+        return False
 
-    def disconnect(self):
+    def _on_connect_reply(self):
+        if self._cancelled:
+            return
+        self._connecting = False
+        self._connect_time = time.time()
+        self.timing['connected'] = self._connect_time
+        self._logger.debug('Connected after {} attempt(s)'.format(self._attempt))
+
+        # no PropertiesChanged is sent if BlueZ had already resolved the services
+        device_props = dbus.Interface(self._device, DBUS_PROPS)
+        device_props.Get(BLUEZ_DEVICE, 'ServicesResolved', reply_handler=self._on_services_resolved,
+                         error_handler=lambda e: self._logger.debug('Could not read ServicesResolved: {}'.format(e)))
+
+    def _on_services_resolved(self, resolved):
+        if bool(resolved):
+            self._probe_services()
+
+    def _on_connect_error(self, e):
+        if self._cancelled:
+            return
+        self._logger.error('Error while connecting: {}'.format(e))
+        if self._attempt >= self._connect_attempts:
+            self._logger.error('Error connecting {} consecutive times. Aborting..'.format(self._attempt))
+            self._connecting = False
+            self._disconnect_cb(False)
+            return
+
+        delay = self._connect_delay * 2 ** (self._attempt - 1)
+        self._logger.debug('Retrying in {} s'.format(delay))
+        self._retry_timer = GLib.timeout_add(int(delay * 1000), self._try_connect)
+
+    def connecting(self):
+        return self._connecting
+
+    def attempts(self):
+        return self._attempt
+
+    def setConnectAttempts(self, attempts):
+        self._connect_attempts = attempts
+
+    def cancel(self):
+        if not self._connecting:
+            return
+        self._logger.info('Cancelling connection attempt')
+        self._cancelled = True
+        self._connecting = False
+        if self._retry_timer != None:
+            GLib.source_remove(self._retry_timer)
+            self._retry_timer = None
+        if self._sig_recv != None:
+            self._sig_recv.remove()
+            self._sig_recv = None
+        # aborts a pending Connect() in BlueZ
+        self._device.Disconnect(reply_handler=lambda: None, error_handler=lambda e: None)
+
+    def disconnect(self, done_cb = None):
         self._logger.debug('Disconnecting')
         if self._sig_recv != None:
             self._sig_recv.remove()
-        self._device.Disconnect()
+            self._sig_recv = None
+
+        def on_reply():
+            self.timing['disconnected'] = time.time()
+            if done_cb != None:
+                done_cb()
+
+        def on_error(e):
+            self._logger.error('Error disconnecting: {}'.format(e))
+            on_reply()
+
+        self._device.Disconnect(reply_handler=on_reply, error_handler=on_error)
         if self._connect_time > 0:
             self._logger.info('Disconnected. Connected time: {} s'.format(time.time() - self._connect_time))
         
@@ -9,13 +9,35 @@ from gi.repository import GLib
 
 import dbluez
 import parser
+import spool
+import state
+import sink
+import metrics
+import capture
 
 import threading
 from threading import Lock
 import time
 
 import getopt, sys
-import pickle
+import os
+import socket
+import signal
+import random
+import heapq
+import asyncio
+from collections import deque, OrderedDict
+from threading import Condition
+
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:
+    mqtt = None
+
+try:
+    import abluez
+except ImportError:
+    abluez = None
 
 DBUS_OBJ_MAN = 'org.freedesktop.DBus.ObjectManager'
 DBUS_PROPS = 'org.freedesktop.DBus.Properties'
@@ -26,36 +48,174 @@ BLUEZ_DEVICE = 'org.bluez.Device1'
 BLUEZ_GATTSERV = 'org.bluez.GattService1'
 BLUEZ_GATTCHAR = 'org.bluez.GattCharacteristic1'
 
+TB_GATEWAY_TELEMETRY_TOPIC = 'v1/gateway/telemetry'
+# longest time an acknowledged message waits for the spool cursor write
+COMMIT_DELAY = 0.5
+
+AFC_URL = 'http://www.afarcloud.eu/'
+
 loop      = None
-timer     = None
 scanner   = None
 log_level = None
 daemon    = False
+bulk      = False
+pool      = None
+max_sessions = 3
+publisher = None
+mqtt_host = None
+mqtt_port = 1883
+mqtt_topic = TB_GATEWAY_TELEMETRY_TOPIC
+mqtt_user = None
+mqtt_window = 20
+mqtt_backlog = 1000
+queue_path = None
+queue_size = 64
+layout_cache = None
+scheduler = None
+sync_interval = 3600
+sync_jitter = 60
+retry_delay = 60
+device_intervals = {}
+connect_attempts = 3
+connect_delay = 2
+connect_timeout = 25
+backend = 'glib'
+output = None
+output_path = None
+batch_records = sink.DEFAULT_MAX_RECORDS
+batch_bytes = sink.DEFAULT_MAX_BYTES
+batch_latency = sink.DEFAULT_MAX_LATENCY
+collector = None
+metrics_path = None
+metrics_telemetry = False
+metrics_interval = metrics.DEFAULT_WRITE_INTERVAL
+timers = None
+worker = None
+decode_queue = parser.DEFAULT_DECODE_QUEUE
+recorder = None
+capture_path = None
+window = None
+scan_time = 5
+scan_min = 1
+scan_max = 15
+scan_lost = 3
+admission = None
+min_rssi = -90
+breaker_failures = 3
+breaker_cooldown = 3600
+breaker_max_cooldown = 86400
+devices = None
+max_devices = 1000
+device_ttl = 86400
 
 def usage():
     print('Usage:')
     print('  gateway.py [options]')
     print('Options:')
     print('  -h, --help                Show help')
-    print('  -i, --adapter=hciX        Specify local adapter interface')
+    print('  -i, --adapter=hciX[,hciY] Local adapter interface(s), sessions are spread over all of them (default: hci0)')
     print('  -d, --daemon              Enable daemonized mode')
     print('  -V, --verbose             Be verbose and show debug log')
     print('  -p, --device_path=<path>  Specify path to store temp. device information')
+    print('  -b, --bulk                Buffer a session and decode it at once (uses NumPy if available)')
+    print('      --decode_queue=N      Indications queued for the decode thread, 0 decodes on the BLE event loop (default: {})'.format(decode_queue))
+    print('      --capture=<path>      Append the raw indications of every session to a capture file (see capture.py)')
+    print('  -c, --connections=N       Maximum number of concurrent BLE connections per adapter (default: {})'.format(max_sessions))
+    print('  -B, --backend=<backend>   BLE backend: glib (dbus-python) or asyncio (dbus-next) (default: {})'.format(backend))
+    print('  -o, --output=<path>       Append the JSON output to a file instead of stdout')
+    print('      --batch_records=N     Maximum number of records per output message (default: {})'.format(batch_records))
+    print('      --batch_bytes=N       Maximum size of an output message in bytes (default: {})'.format(batch_bytes))
+    print('      --batch_latency=SECONDS  Maximum time a record is held back for batching (default: {})'.format(batch_latency))
+    print('      --metrics=<path>      Write session metrics in the Prometheus text format to a file')
+    print('      --metrics_interval=SECONDS  Minimum time between two writes of the metrics file (default: {})'.format(metrics_interval))
+    print('      --metrics_telemetry   Send the metrics of every session as telemetry of the node')
+    print('  -m, --mqtt=host[:port]    Publish directly to a MQTT broker instead of stdout (env: MQTT_PORT)')
+    print('  -t, --topic=<topic>       MQTT topic (env: MQTT_TOPIC, default: {})'.format(TB_GATEWAY_TELEMETRY_TOPIC))
+    print('  -u, --user=<user>         MQTT user name/access token (env: MQTT_USER, password: MQTT_PASSWORD)')
+    print('  -w, --window=N            Maximum number of unacknowledged QoS 1 messages (default: {})'.format(mqtt_window))
+    print('      --backlog=N           Messages held in memory without -q while the broker is unreachable, the oldest are dropped (default: {})'.format(mqtt_backlog))
+    print('  -q, --queue=<dir>         Spool MQTT messages in a durable on-disk queue')
+    print('      --queue_size=MiB      Maximum size of the on-disk queue (default: {})'.format(queue_size))
+    print('  -l, --layout_cache=<path> Cache resolved GATT layouts and node names between sessions, names are read again once a day')
+    print('  -I, --interval=SECONDS    Synchronization interval per device (default: {})'.format(sync_interval))
+    print('      --max_devices=N       Devices kept in memory, the least recently used idle ones are dropped (default: {})'.format(max_devices))
+    print('      --device_ttl=SECONDS  Drop idle devices after this time, they return with their next advertisement (default: {})'.format(device_ttl))
+    print('      --device_interval=<address>=SECONDS  Override the interval of a single device (persisted), default removes the override')
+    print('      --scan_time=SECONDS   Scan time of a single run if no known device is due (default: {})'.format(scan_time))
+    print('      --scan_min=SECONDS    Minimum scan time of a single run once all due devices were seen (default: {})'.format(scan_min))
+    print('      --scan_max=SECONDS    Maximum scan time of a single run while due devices are missing (default: {})'.format(scan_max))
+    print('      --scan_lost=N         Do not wait for devices without a session for N intervals, 0 waits for all (default: {})'.format(scan_lost))
+    print('      --jitter=SECONDS      Random delay added to scheduled synchronizations in daemon mode (default: {})'.format(sync_jitter))
+    print('      --retry=SECONDS       Initial retry delay after a failed synchronization, doubled per failure (default: {})'.format(retry_delay))
+    print('      --min_rssi=DBM        Devices with a weaker average signal only get a connection after all others (default: {})'.format(min_rssi))
+    print('      --breaker_failures=N  Quarantine a device after N failed synchronizations in a row, 0 disables (default: {})'.format(breaker_failures))
+    print('      --breaker_cooldown=SECONDS  Quarantine before the first probe, doubled per failed probe (default: {}, at most {})'.format(breaker_cooldown, breaker_max_cooldown))
+    print('      --connect_attempts=N  Connection attempts per synchronization (default: {})'.format(connect_attempts))
+    print('      --connect_delay=SECONDS  Delay before the first reconnect, doubled per attempt (default: {})'.format(connect_delay))
+    print('      --connect_timeout=SECONDS  D-Bus timeout of a single connection attempt (default: {})'.format(connect_timeout))
 
 def parse_options():
-    global adapter
+    global adapters
     global daemon
     global log_level
     global device_path
+    global bulk
+    global max_sessions
+    global mqtt_host
+    global mqtt_port
+    global mqtt_topic
+    global mqtt_user
+    global mqtt_window
+    global mqtt_backlog
+    global queue_path
+    global queue_size
+    global layout_cache
+    global sync_interval
+    global sync_jitter
+    global retry_delay
+    global device_intervals
+    global connect_attempts
+    global connect_delay
+    global connect_timeout
+    global backend
+    global output_path
+    global batch_records
+    global batch_bytes
+    global batch_latency
+    global metrics_path
+    global metrics_telemetry
+    global metrics_interval
+    global max_devices
+    global device_ttl
+    global decode_queue
+    global capture_path
+    global scan_time
+    global scan_min
+    global scan_max
+    global scan_lost
+    global min_rssi
+    global breaker_failures
+    global breaker_cooldown
     
+    mqtt_port = int(os.environ.get('MQTT_PORT', mqtt_port))
+    mqtt_topic = os.environ.get('MQTT_TOPIC', mqtt_topic)
+    mqtt_user = os.environ.get('MQTT_USER')
+
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "dhi:Vp:", ["help", "adapter="])
+        opts, args = getopt.getopt(sys.argv[1:], "dhi:Vp:bc:m:t:u:w:q:l:I:B:o:", ["help", "adapter=", "bulk", "decode_queue=", "capture=", "connections=", "backend=",
+                                                                          "output=", "batch_records=", "batch_bytes=", "batch_latency=",
+                                                                          "metrics=", "metrics_interval=", "metrics_telemetry",
+                                                                          "mqtt=", "topic=", "user=", "window=", "backlog=", "queue=", "queue_size=",
+                                                                          "layout_cache=", "interval=", "device_interval=", "jitter=", "retry=",
+                                                                          "scan_time=", "scan_min=", "scan_max=", "scan_lost=", "min_rssi=", "breaker_failures=", "breaker_cooldown=",
+                                                                          "max_devices=", "device_ttl=",
+                                                                          "connect_attempts=", "connect_delay=", "connect_timeout="])
     except getopt.GetoptError as err:
         # print help information and exit:
         print(err)  # will print something like "option -a not recognized"
         usage()
         sys.exit(2)
-    adapter = 'hci0'
+    adapters = []
     log_level = logging.INFO
     for o, a in opts:
         if o in ('-h', '--help'):
@@ -64,99 +224,1049 @@ def parse_options():
         elif o in ('-d', '--daemon'):
             daemon = True
         elif o in ('-i', '--adapter'):
-            adapter = a
+            for name in a.split(','):
+                if name != '' and name not in adapters:
+                    adapters.append(name)
         elif o in ('-V', '--verbose'):
             log_level = logging.DEBUG
         elif o in ('-p', '--device_path'):
             device_path = a
+        elif o in ('-b', '--bulk'):
+            bulk = True
+        elif o == '--decode_queue':
+            decode_queue = max(0, int(a))
+        elif o == '--capture':
+            capture_path = a
+        elif o in ('-c', '--connections'):
+            max_sessions = int(a)
+            if max_sessions < 1:
+                print('Number of connections must be at least 1')
+                usage()
+                sys.exit(2)
+        elif o in ('-o', '--output'):
+            output_path = a
+        elif o == '--batch_records':
+            batch_records = max(1, int(a))
+        elif o == '--batch_bytes':
+            batch_bytes = int(a)
+        elif o == '--batch_latency':
+            batch_latency = float(a)
+        elif o == '--metrics':
+            metrics_path = a
+        elif o == '--metrics_interval':
+            metrics_interval = float(a)
+        elif o == '--metrics_telemetry':
+            metrics_telemetry = True
+        elif o in ('-m', '--mqtt'):
+            mqtt_host = a
+            if ':' in a:
+                mqtt_host, port = a.rsplit(':', 1)
+                mqtt_port = int(port)
+        elif o in ('-t', '--topic'):
+            mqtt_topic = a
+        elif o in ('-u', '--user'):
+            mqtt_user = a
+        elif o in ('-w', '--window'):
+            mqtt_window = max(1, int(a))
+        elif o == '--backlog':
+            mqtt_backlog = max(1, int(a))
+        elif o in ('-q', '--queue'):
+            queue_path = a
+        elif o == '--queue_size':
+            queue_size = int(a)
+        elif o in ('-l', '--layout_cache'):
+            layout_cache = parser.LayoutCache(a)
+        elif o in ('-I', '--interval'):
+            sync_interval = int(a)
+        elif o == '--max_devices':
+            max_devices = max(1, int(a))
+        elif o == '--device_ttl':
+            device_ttl = int(a)
+        elif o == '--device_interval':
+            address, interval = a.rsplit('=', 1)
+            device_intervals[address.upper()] = None if interval == 'default' else int(interval)
+        elif o == '--jitter':
+            sync_jitter = int(a)
+        elif o == '--scan_time':
+            scan_time = float(a)
+        elif o == '--scan_min':
+            scan_min = float(a)
+        elif o == '--scan_max':
+            scan_max = float(a)
+        elif o == '--scan_lost':
+            scan_lost = max(0, int(a))
+        elif o == '--min_rssi':
+            min_rssi = int(a)
+        elif o == '--breaker_failures':
+            breaker_failures = int(a)
+        elif o == '--breaker_cooldown':
+            breaker_cooldown = int(a)
+        elif o == '--retry':
+            retry_delay = int(a)
+        elif o == '--connect_attempts':
+            connect_attempts = max(1, int(a))
+        elif o == '--connect_delay':
+            connect_delay = float(a)
+        elif o == '--connect_timeout':
+            connect_timeout = float(a)
+        elif o in ('-B', '--backend'):
+            backend = a
+            if backend not in ('glib', 'asyncio'):
+                print('Unknown backend: {}'.format(a))
+                usage()
+                sys.exit(2)
         else:
             assert False, "unhandled option"
 
+    if len(adapters) == 0:
+        adapters = ['hci0']
+
+    if backend == 'asyncio' and daemon == True:
+        print('Daemon mode is only supported by the glib backend')
+        sys.exit(2)
+
+class MqttPublisher:
+
+    def __init__(self, host, port, topic, user = None, password = None, window = 20, spool = None, backlog = 1000):
+        self._logger = logging.getLogger('{}.mqtt'.format(__name__))
+        self._host = host
+        self._port = port
+        self._topic = topic
+        self._window = window
+        self._spool = spool
+        self._backlog = backlog
+
+        self._cv = Condition()
+        self._queue = deque()
+        self._dropped = 0
+        self._inflight = {}
+        self._acked = set()
+        self._sent = deque()
+        self._offsets = {}
+        self._commit_offset = None
+        self._commit_count = 0
+        self._commit_since = 0
+        self._connected = False
+        self._running = False
+        self._thread = None
+
+        self._client = mqtt.Client(client_id='tb-gateway-{}'.format(socket.gethostname()), clean_session=False)
+        if user != None:
+            self._client.username_pw_set(user, password)
+        self._client.max_inflight_messages_set(window)
+        self._client.reconnect_delay_set(1, 120)
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        self._client.on_publish = self._on_publish
+
+    def start(self):
+        self._logger.info('Connecting to {}:{}'.format(self._host, self._port))
+        self._running = True
+        self._client.connect_async(self._host, self._port, keepalive=60)
+        self._client.loop_start()
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, payload):
+        with self._cv:
+            if self._spool != None:
+                self._spool.append(payload)
+            else:
+                if len(self._queue) >= self._backlog:
+                    # without a spool an outage must not grow memory without bounds
+                    self._queue.popleft()
+                    self._dropped = self._dropped + 1
+                    self._logger.warning('Backlog full, dropped the oldest message ({} dropped so far)'.format(self._dropped))
+                self._queue.append(payload)
+            self._cv.notify()
+
+    def close(self, timeout = 30):
+        deadline = time.time() + timeout
+        with self._cv:
+            while (self._pending() or len(self._inflight) > 0) and time.time() < deadline:
+                self._cv.wait(deadline - time.time())
+            if self._pending() or len(self._inflight) > 0:
+                self._logger.error('Closing with queued and {} unacknowledged messages'.format(len(self._inflight)))
+            self._running = False
+            self._cv.notify_all()
+
+        # the publish thread commits the last acks on its way out
+        self._thread.join()
+        self._client.disconnect()
+        self._client.loop_stop()
+        if self._spool != None:
+            self._spool.close()
+
+    def _pending(self):
+        if self._spool != None:
+            return self._spool.pending()
+        return len(self._queue) > 0
+
+    def _next_batch(self, size):
+        if self._spool != None:
+            return self._spool.read(size)
+        batch = []
+        while len(self._queue) > 0 and len(batch) < size:
+            batch.append((None, self._queue.popleft()))
+        return batch
+
+    def _commit(self):
+        # acks are committed in publish order, the spool cursor never skips a gap.
+        # Writing the cursor is left to the publish thread, see _take_commit
+        while len(self._sent) > 0 and self._sent[0] not in self._inflight:
+            if self._commit_offset == None:
+                self._commit_since = time.time()
+            self._commit_offset = self._offsets.pop(self._sent.popleft())
+            self._commit_count = self._commit_count + 1
+
+    def _commit_due(self):
+        return self._commit_offset != None and (self._commit_count >= self._window or not self._running or
+                                                time.time() - self._commit_since >= COMMIT_DELAY)
+
+    def _commit_wait(self):
+        if self._commit_offset == None:
+            return None
+        return max(0, self._commit_since + COMMIT_DELAY - time.time())
+
+    def _take_commit(self):
+        # one cursor write per ack window or COMMIT_DELAY, whatever comes first
+        if not self._commit_due():
+            return None
+        offset = self._commit_offset
+        self._commit_offset = None
+        self._commit_count = 0
+        return offset
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            self._logger.error('Connection refused: {}'.format(mqtt.connack_string(rc)))
+            return
+        self._logger.info('Connected to {}:{}'.format(self._host, self._port))
+        with self._cv:
+            self._connected = True
+            self._cv.notify_all()
+
+    def _on_disconnect(self, client, userdata, rc):
+        if rc != 0:
+            self._logger.warning('Connection lost ({}), reconnecting'.format(mqtt.error_string(rc)))
+        with self._cv:
+            self._connected = False
+
+    def _on_publish(self, client, userdata, mid):
+        with self._cv:
+            if mid in self._inflight:
+                del self._inflight[mid]
+                if self._spool != None:
+                    self._commit()
+            else:
+                self._acked.add(mid)
+            self._cv.notify_all()
+
+    def _run(self):
+        while True:
+            batch = []
+            with self._cv:
+                while self._running and not self._commit_due() and (not self._connected or not self._pending() or len(self._inflight) >= self._window):
+                    self._cv.wait(self._commit_wait())
+                offset = self._take_commit()
+                running = self._running
+                if running and self._connected and len(self._inflight) < self._window:
+                    batch = self._next_batch(self._window - len(self._inflight))
+
+            if offset != None:
+                self._spool.commit(offset)
+            if not running:
+                return
+
+            for offset, payload in batch:
+                # the broker ack may arrive before publish() returns, see _on_publish
+                info = self._client.publish(self._topic, bytes(payload), qos=1)
+                with self._cv:
+                    if self._spool != None:
+                        self._sent.append(info.mid)
+                        self._offsets[info.mid] = offset
+                    if info.mid in self._acked:
+                        self._acked.discard(info.mid)
+                        if self._spool != None:
+                            self._commit()
+                    else:
+                        self._inflight[info.mid] = offset
+            if len(batch) > 0:
+                self._logger.debug('Published {} messages, {} unacknowledged'.format(len(batch), len(self._inflight)))
+
+class Timers:
+
+    # deferred work of all devices (synchronizations, backoff, cleanup and
+    # expiry) on a single GLib timeout, keyed so that it can be replaced or
+    # cancelled
+    def __init__(self):
+        self._logger = logging.getLogger('{}.timers'.format(__name__))
+        self._mutex = Lock()
+        self._heap = []
+        self._entries = {}
+        self._seq = 0
+        self._timer = None
+        self._armed = None
+        self._running = True
+
+    def schedule(self, key, due, callback, *args):
+        with self._mutex:
+            if not self._running:
+                return
+            self._seq = self._seq + 1
+            self._entries[key] = (due, self._seq, callback, args)
+            heapq.heappush(self._heap, (due, self._seq, key))
+            # replaced and cancelled entries are skipped lazily, compact once
+            # they dominate the heap
+            if len(self._heap) > 2 * len(self._entries) + 64:
+                self._heap = [(entry[0], entry[1], key) for key, entry in self._entries.items()]
+                heapq.heapify(self._heap)
+            if self._timer == None or due < self._armed:
+                self._arm()
+
+    def cancel(self, key):
+        with self._mutex:
+            self._entries.pop(key, None)
+
+    def due(self, key):
+        entry = self._entries.get(key)
+        return entry[0] if entry != None else None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stop(self):
+        with self._mutex:
+            self._running = False
+            self._entries = {}
+            self._heap = []
+            if self._timer != None:
+                GLib.source_remove(self._timer)
+                self._timer = None
+
+    def _arm(self):
+        if self._timer != None:
+            GLib.source_remove(self._timer)
+            self._timer = None
+        while len(self._heap) > 0 and self._entries.get(self._heap[0][2], (None, None))[1] != self._heap[0][1]:
+            heapq.heappop(self._heap)
+        if not self._running or len(self._heap) == 0:
+            return
+        self._armed = self._heap[0][0]
+        delay = max(0, self._armed - time.time())
+        self._timer = GLib.timeout_add(int(min(delay, 3600) * 1000), self._fire)
+
+    def _fire(self):
+        ready = []
+        with self._mutex:
+            self._timer = None
+            now = time.time()
+            while len(self._heap) > 0 and self._heap[0][0] <= now:
+                due, seq, key = heapq.heappop(self._heap)
+                entry = self._entries.get(key)
+                if entry == None or entry[1] != seq:
+                    continue
+                del self._entries[key]
+                ready.append((key, entry[2], entry[3]))
+            self._arm()
+
+        for key, callback, args in ready:
+            try:
+                callback(*args)
+            except Exception as e:
+                self._logger.error('Error running {}: {}'.format(key, e))
+        return False
+
+class DeviceRegistry:
+
+    # the devices known to the glib backend, bounded in number (least
+    # recently used first) and in idle time. A dropped device is forgotten by the
+    # scanner and comes back with its next advertisement
+    def __init__(self, timers, max_devices, ttl, busy_cb, evict_cb):
+        self._logger = logging.getLogger('{}.devices'.format(__name__))
+        self._timers = timers
+        self._max_devices = max_devices
+        self._ttl = ttl
+        self._busy_cb = busy_cb
+        self._evict_cb = evict_cb
+        self._mutex = Lock()
+        self._devices = OrderedDict()
+
+    def __contains__(self, address):
+        return address in self._devices
+
+    def __getitem__(self, address):
+        return self._devices[address]
+
+    def __len__(self):
+        return len(self._devices)
+
+    def keys(self):
+        with self._mutex:
+            return list(self._devices.keys())
+
+    def add(self, address, device):
+        with self._mutex:
+            self._devices[address] = device
+        self.touch(address)
+        self._shrink()
+
+    def touch(self, address):
+        with self._mutex:
+            if address not in self._devices:
+                return
+            self._devices.move_to_end(address)
+        self._timers.schedule(('expire', address), time.time() + self._ttl, self._expire, address)
+
+    def _expire(self, address):
+        if self._busy_cb(address):
+            self.touch(address)
+            return
+        self._logger.debug('Dropping {}, idle for {} s'.format(address, self._ttl))
+        self.remove(address)
+
+    def _shrink(self):
+        while len(self._devices) > self._max_devices:
+            with self._mutex:
+                idle = next((address for address in self._devices.keys() if not self._busy_cb(address)), None)
+            if idle == None:
+                return
+            self._logger.debug('Dropping least recently used device {}'.format(idle))
+            self.remove(idle)
+
+    def remove(self, address):
+        with self._mutex:
+            device = self._devices.pop(address, None)
+        self._timers.cancel(('expire', address))
+        if device != None:
+            self._evict_cb(address, device)
+
+class ScanWindow:
+    # scan time of a single run: it ends once all devices that are due were
+    # seen (after min_time, so unknown nodes get a chance to show up), while
+    # due devices are missing it is extended up to max_time, without any
+    # known due devices it lasts scan_time
+    def __init__(self, expected, scan_time, min_time, max_time):
+        self._missing = set(expected)
+        self._expected = len(self._missing)
+        self._scan_time = scan_time
+        self._min_time = min(min_time, scan_time)
+        self._max_time = max(max_time, scan_time)
+        self.started = time.time()
+        self.closed = False
+        # weak devices, they only get a slot once the scan is over
+        self.deferred = []
+
+    def seen(self, address):
+        self._missing.discard(address)
+
+    def expected(self):
+        return self._expected
+
+    def missing(self):
+        return len(self._missing)
+
+    def deadline(self):
+        if len(self._missing) > 0:
+            return self.started + self._max_time
+        if self._expected > 0:
+            return self.started + self._min_time
+        return self.started + self._scan_time
+
+    def close(self):
+        self.closed = True
+        return time.time() - self.started
+
+def expected_devices(now):
+    global store
+    global admission
+    global sync_interval
+    global scan_lost
+
+    # devices a run waits for: due ones that were around lately and are not quarantined
+    expected = []
+    for address in store.synced_before(now, sync_interval, scan_lost):
+        reopens = admission.reopens(address)
+        if reopens == None or reopens <= now:
+            expected.append(address)
+    return expected
+
+ADMIT = 'admit'
+DEFER = 'defer'
+PROBE = 'probe'
+QUARANTINE = 'quarantine'
+
+class Admission:
+    # decides who gets a connection slot. After breaker_failures failed
+    # sessions in a row the breaker of a device opens: it is quarantined for
+    # cooldown seconds, doubled with every failed probe up to max_cooldown.
+    # Then one probe with a single connection attempt is let through
+    # (half-open), a success closes the breaker. The state follows from the
+    # failures and last_sync of the device store, so it survives restarts.
+    # Devices with an average RSSI below min_rssi are deferred
+    def __init__(self, store, failures, cooldown, max_cooldown, min_rssi):
+        self._store = store
+        self._failures = failures
+        self._cooldown = cooldown
+        self._max_cooldown = max_cooldown
+        self._min_rssi = min_rssi
+
+    def reopens(self, address, entry = None):
+        if self._failures <= 0:
+            return None
+        if entry == None:
+            entry = self._store.get(address)
+        if entry == None or entry['failures'] < self._failures:
+            return None
+        return entry['last_sync'] + min(self._cooldown * 2 ** (entry['failures'] - self._failures), self._max_cooldown)
+
+    def decide(self, address, rssi):
+        entry = self._store.get(address)
+        reopens = self.reopens(address, entry)
+        if reopens != None:
+            decision = QUARANTINE if time.time() < reopens else PROBE
+        elif rssi != None and rssi < self._min_rssi:
+            decision = DEFER
+        else:
+            decision = ADMIT
+
+        # likely successes first: by success rate, then by signal
+        rate = 1.0
+        if entry != None:
+            rate = entry['success_rate'] if entry['success_rate'] != None else rate
+            rssi = rssi if rssi != None else entry['rssi']
+        return decision, (decision != DEFER, rate, rssi if rssi != None else self._min_rssi)
+
+class Scheduler:
+
+    def __init__(self, store, timers, submit_cb, interval, jitter, retry, admission = None):
+        self._logger = logging.getLogger('{}.scheduler'.format(__name__))
+        self._store = store
+        self._admission = admission
+        self._timers = timers
+        self._submit_cb = submit_cb
+        self._interval = interval
+        self._jitter = jitter
+        self._retry = retry
+        self._running = True
+
+    def add(self, address):
+        if self._timers.due(('sync', address)) == None:
+            self._push(address, self.nextDue(address))
+
+    def remove(self, address):
+        self._timers.cancel(('sync', address))
+
+    def reschedule(self, address):
+        # sessions may finish on a connection thread, the store is only read on the main loop
+        GLib.idle_add(self._reschedule, address)
+
+    def _reschedule(self, address):
+        if self._running:
+            self._push(address, self.nextDue(address))
+        return False
+
+    def nextDue(self, address):
+        now = time.time()
+        entry = self._store.get(address)
+        if entry == None:
+            return now
+
+        interval = entry['interval'] or self._interval
+        if entry['failures'] > 0:
+            due = entry['last_sync'] + min(self._retry * 2 ** (entry['failures'] - 1), interval)
+        else:
+            due = entry['last_success'] + interval
+        if self._admission != None:
+            reopens = self._admission.reopens(address, entry)
+            if reopens != None:
+                due = max(due, reopens)
+        return max(now, due + random.uniform(0, self._jitter))
+
+    def stop(self):
+        self._running = False
+
+    def _push(self, address, due):
+        self._timers.schedule(('sync', address), due, self._submit_cb, address)
+        self._logger.debug('Next synchronization of {} in {:.0f} s'.format(address, due - time.time()))
+
+def pick_adapter(reach, load, size):
+    # least loaded adapter with a free connection slot, the best signal
+    # breaks ties
+    best = None
+    for adapter, rssi in reach:
+        if load.get(adapter, 0) >= size:
+            continue
+        key = (load.get(adapter, 0), -rssi if rssi != None else 1000)
+        if best == None or key < best[0]:
+            best = (key, adapter)
+    return best[1] if best != None else None
+
+class SyncPool:
+
+    def __init__(self, size, finished_cb = None, reach_cb = None, timers = None):
+        self._logger = logging.getLogger('{}.pool'.format(__name__))
+        self._size = size
+        self._finished_cb = finished_cb
+        self._reach_cb = reach_cb
+        self._timers = timers
+        self._mutex = Lock()
+        self._pending = []
+        self._active = {}
+        self._load = {}
+        self._idle_cb = None
+
+    def submit(self, device, cleanup = 0, priority = ()):
+        # higher priorities start first, equal ones in order of submission
+        address = device.getAddress()
+        with self._mutex:
+            if address in self._active or address in [d.getAddress() for d, c, p in self._pending]:
+                return False
+            index = len(self._pending)
+            while index > 0 and self._pending[index - 1][2] < priority:
+                index = index - 1
+            self._pending.insert(index, (device, cleanup, priority))
+        self._start_next()
+        return True
+
+    def close(self, idle_cb):
+        with self._mutex:
+            self._idle_cb = idle_cb
+        self._start_next()
+
+    def active(self):
+        return len(self._active)
+
+    def busy(self, address):
+        with self._mutex:
+            return address in self._active or address in [d.getAddress() for d, c, p in self._pending]
+
+    def cancel(self):
+        with self._mutex:
+            self._pending = []
+            active = [device for device, adapter, cleanup in self._active.values()]
+        for device in active:
+            device.cancelSynchronization()
+
+    def _reach(self, device):
+        reach = []
+        if self._reach_cb != None:
+            reach = self._reach_cb(device.getAddress())
+        if len(reach) == 0:
+            reach = [(device.getAdapter(), None)]
+        return reach
+
+    def _start_next(self):
+        idle_cb = None
+        with self._mutex:
+            # a node waits for an adapter in its range, the nodes behind it
+            # may still start on other adapters
+            index = 0
+            while index < len(self._pending):
+                device, cleanup, priority = self._pending[index]
+                adapter = pick_adapter(self._reach(device), self._load, self._size)
+                if adapter == None:
+                    index = index + 1
+                    continue
+
+                del self._pending[index]
+                if self._timers != None:
+                    self._timers.cancel(('cleanup', device.getAddress()))
+                device.setAdapter(adapter)
+                self._active[device.getAddress()] = (device, adapter, cleanup)
+                self._load[adapter] = self._load.get(adapter, 0) + 1
+                self._logger.info('Start synchronization of {} on {} ({}/{} sessions)'.format(
+                    device.getAddress(), adapter, self._load[adapter], self._size))
+
+                # connection setup is asynchronous and has to run on the main loop
+                GLib.idle_add(device.startSynchronization, self._on_done)
+
+            if len(self._pending) == 0 and len(self._active) == 0 and self._idle_cb != None:
+                idle_cb = self._idle_cb
+                self._idle_cb = None
+
+        if idle_cb != None:
+            idle_cb()
+
+    def _on_done(self, device):
+        address = device.getAddress()
+        with self._mutex:
+            device, adapter, cleanup = self._active.pop(address, (device, None, 0))
+            if adapter != None:
+                self._load[adapter] = self._load[adapter] - 1
+        self._logger.info('Synchronization of {} finished ({})'.format(
+            address, 'success' if device.syncedSuccessfully() else 'failed'))
+        if self._finished_cb != None:
+            try:
+                self._finished_cb(device)
+            except Exception as e:
+                self._logger.error('Error finishing synchronization of {}: {}'.format(address, e))
+        if cleanup > 0 and device.syncedSuccessfully() and self._timers != None:
+            # BlueZ forgets the device unless it is synchronized again before
+            self._timers.schedule(('cleanup', address), time.time() + cleanup, self._cleanup, device)
+        self._start_next()
+
+    def _cleanup(self, device):
+        if self.busy(device.getAddress()):
+            return
+        self._logger.debug('Removing {} from BlueZ'.format(device.getAddress()))
+        try:
+            device.removeDevice()
+        except Exception as e:
+            self._logger.warning('Error removing {}: {}'.format(device.getAddress(), e))
+
+def sync_finished(device):
+    global store
+    global t_started
+    global daemon
+    global scheduler
+    global collector
+    global output
+    global metrics_telemetry
+    global devices
+    global timers
+
+    stats = device.sessionStats()
+    summary = collector.record(stats)
+    if timers != None and collector.write_due() != None:
+        timers.schedule('metrics', collector.write_due(), collector.flush)
+    if metrics_telemetry:
+        output.write(device.nodeName() if device.nodeName() != None else device.getAddress(), [collector.telemetry(stats, summary)])
+
+    started = t_started if daemon == False else int(time.time())
+    store.record(device.getAddress(), started, device.syncedSuccessfully(), device.nodeName(), device.lastRecordTimestamp(), stats['rssi'])
+    if devices != None:
+        devices.touch(device.getAddress())
+    if scheduler != None:
+        scheduler.reschedule(device.getAddress())
+
+def admit(device, rssi):
+    global logger
+    global admission
+    global connect_attempts
+
+    decision, priority = admission.decide(device.getAddress(), rssi)
+    device.setRssi(rssi)
+    device.setConnectAttempts(1 if decision == PROBE else connect_attempts)
+    if decision != ADMIT:
+        logger.info('{} {} (average RSSI {})'.format(
+            {DEFER: 'Deferring', PROBE: 'Probing', QUARANTINE: 'Quarantined:'}[decision], device.getAddress(),
+            '{:.0f} dBm'.format(rssi) if rssi != None else 'unknown'))
+    return decision, priority
+
+def sync_due(address):
+    global devices
+    global pool
+    global scanner
+    global scheduler
+
+    if address in devices:
+        decision, priority = admit(devices[address], scanner.averageRssi(address))
+        if decision == QUARANTINE:
+            scheduler.reschedule(address)
+            return
+        pool.submit(devices[address], 900, priority)
+
+def device_busy(address):
+    global pool
+
+    return pool != None and pool.busy(address)
+
+def forget_device(address, device):
+    global logger
+    global scheduler
+    global scanner
+    global timers
+    global collector
+
+    if scheduler != None:
+        scheduler.remove(address)
+    timers.cancel(('cleanup', address))
+    scanner.forget(address)
+    collector.forget(address)
+    try:
+        device.removeDevice()
+    except Exception as e:
+        logger.debug('Could not remove {} from BlueZ: {}'.format(address, e))
+
+def shutdown():
+    global logger
+    global loop
+    global pool
+    global scheduler
+    global timers
+
+    logger.info('Shutting down, waiting for {} running sessions'.format(pool.active()))
+    if scheduler != None:
+        scheduler.stop()
+    timers.stop()
+    pool.cancel()
+
+    def finished():
+        logger.info('Finished')
+        GLib.idle_add(loop.quit)
+
+    pool.close(finished)
+    return False
+
 def new_device_cb(adapter, address, frametype, power, url):
     global logger
-    global addresses
-    global addresses_to_process
+    global store
+    global window
+    global pool
+    global timers
     global devices
     global t_started
     global daemon
+    global bulk
+    global publisher
+    global output
+    global layout_cache
+    global scheduler
+    global sync_interval
+    global connect_attempts
+    global connect_delay
+    global connect_timeout
+    global worker
+    global recorder
 
     logger.info('Found new device: {} with \'{}\''.format(address, url))
-    if url == 'http://www.afarcloud.eu/':
-        device = dbluez.Device(adapter, address, frametype, power, url)
-        afcdev = parser.Thingsboard(device)
-        if address in addresses:
-            if addresses[address]['last_sync'] + 3600 > t_started:
-                logger.debug('Device {} was synced within last {} seconds.'.format(address, 3600))
-                return
-        if address not in addresses_to_process:
-            addresses_to_process.append(address)
-        if address not in devices.keys():
-            devices[address] = afcdev
+    if url == AFC_URL:
+        if address not in devices:
+            device = dbluez.Device(adapter, address, frametype, power, url, connect_attempts, connect_delay, connect_timeout)
+            devices.add(address, parser.Thingsboard(device, bulk, output, layout_cache, worker, recorder))
+        else:
+            devices.touch(address)
+        devices[address].markSeen()
 
         if daemon == True:
-            if devices[address].locked() != None and devices[address].locked() == True:
-                return
-            logger.info('Start synchronization of {} in background'.format(address))
-            lock = Lock()
-            lock.acquire()
-            devices[address].startSynchronization(lock, 900)
+            scheduler.add(address)
+            return
+
+        if window.closed:
+            return
+        window.seen(address)
+        timers.schedule('scan', window.deadline(), quit)
+
+        if store.synced_since(address, t_started, sync_interval):
+            logger.debug('Device {} was synced within its interval.'.format(address))
+            return
+
+        decision, priority = admit(devices[address], scanner.averageRssi(address))
+        if decision == DEFER:
+            window.deferred.append(address)
+        elif decision != QUARANTINE:
+            # synchronized right away, not only after the scan
+            pool.submit(devices[address], 0, priority)
 
 def quit():
     global logger
     global loop
     global scanner
-    global timer
+    global window
+    global pool
     global devices
-    global addresses_to_process
-    global lock
-    global addresses
+
+    logger.info('Scan finished after {:.1f} s, {} of {} due devices not seen'.format(window.close(), window.missing(), window.expected()))
+    for address in window.deferred:
+        if address in devices:
+            decision, priority = admit(devices[address], scanner.averageRssi(address))
+            pool.submit(devices[address], 0, priority)
+    scanner.stopScan()
+
+    def finished():
+        logger.info('Finished')
+        GLib.idle_add(loop.quit)
+
+    pool.close(finished)
+
+async def run_async():
+    global logger
+    global adapters
+    global store
     global t_started
+    global bulk
+    global publisher
+    global output
+    global layout_cache
+    global sync_interval
+    global max_sessions
+    global worker
+    global recorder
+    global scan_time
+    global scan_min
+    global scan_max
+
+    bus = await abluez.Bus.connect()
+
+    window = ScanWindow(expected_devices(t_started), scan_time, scan_min, scan_max)
+    changed = asyncio.Event()
+    stop = asyncio.Event()
+    sightings = set()
+    sessions = []
+    deferred = []
+
+    def found(adapter, address, frametype, power, url):
+        if address in sightings or window.closed:
+            return
+        sightings.add(address)
+        logger.info('Found new device: {} with \'{}\''.format(address, url))
+        if url != AFC_URL:
+            return
+        window.seen(address)
+        changed.set()
+
+        if store.synced_since(address, t_started, sync_interval):
+            logger.debug('Device {} was synced within its interval.'.format(address))
+            return
+        device = abluez.Device(bus, adapter, address, frametype, power, url, connect_attempts, connect_delay, connect_timeout)
+        afcdev = parser.AsyncThingsboard(device, bulk, output, layout_cache, worker, recorder)
+        afcdev.markSeen()
+        decision, priority = admit(afcdev, dbluez.AverageRssi(scanners, address))
+        if decision == DEFER:
+            deferred.append((afcdev, adapter))
+        elif decision != QUARANTINE:
+            # synchronized right away, not only after the scan
+            sessions.append(asyncio.ensure_future(synchronize(afcdev, dbluez.Reach(scanners, address) or [(adapter, None)])))
+
+    async def close_window():
+        while time.time() < window.deadline():
+            changed.clear()
+            try:
+                await asyncio.wait_for(changed.wait(), window.deadline() - time.time())
+            except asyncio.TimeoutError:
+                None
+        stop.set()
+
+    load = {}
+    slots = asyncio.Condition()
+
+    async def synchronize(afcdev, reach):
+        async with slots:
+            await slots.wait_for(lambda: pick_adapter(reach, load, max_sessions) != None)
+            adapter = pick_adapter(reach, load, max_sessions)
+            load[adapter] = load.get(adapter, 0) + 1
+        logger.info('Start synchronization of {} on {} ({}/{} sessions)'.format(
+            afcdev.getAddress(), adapter, load[adapter], max_sessions))
+        afcdev.setAdapter(adapter)
+        try:
+            await afcdev.synchronize()
+        finally:
+            async with slots:
+                load[adapter] = load[adapter] - 1
+                slots.notify_all()
+        sync_finished(afcdev)
+        try:
+            await afcdev.removeDevice()
+        except Exception as e:
+            None
 
-    def sync():
+    scanners = {adapter: abluez.Scanner(bus, adapter, found) for adapter in adapters}
+    try:
+        await asyncio.gather(close_window(), *[scanner.scan(scan_max, stop) for scanner in scanners.values()])
+        logger.info('Scan finished after {:.1f} s, {} of {} due devices not seen'.format(window.close(), window.missing(), window.expected()))
+        queued = []
+        for afcdev, adapter in deferred:
+            decision, priority = admit(afcdev, dbluez.AverageRssi(scanners, afcdev.getAddress()))
+            queued.append((priority, afcdev, dbluez.Reach(scanners, afcdev.getAddress()) or [(adapter, None)]))
+        for priority, afcdev, reach in sorted(queued, key=lambda entry: entry[0], reverse=True):
+            sessions.append(asyncio.ensure_future(synchronize(afcdev, reach)))
+        await asyncio.gather(*sessions)
+    finally:
+        for session in sessions:
+            session.cancel()
+    logger.info('Finished')
 
-        if len(addresses_to_process) > 0:
-            address = addresses_to_process.pop()
-            lock.acquire()
-            devices[address].startSynchronization(lock)
+def main_async():
+    global logger
 
-            thread = threading.Thread(target=sync)
-            thread.daemon = True
-            thread.start()
+    if abluez == None:
+        logger.error('The asyncio backend requires the dbus-next package')
+        sys.exit(1)
 
-        elif len(devices) > 0:
-            logger.info('Waiting for last device to finish')
-            lock.acquire()
-            logger.info('Finished')
-            lock.release()
+    # asyncio.run needs Python 3.7, the loop is set up the same way by hand
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    task = loop.create_task(run_async())
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, task.cancel)
+    try:
+        loop.run_until_complete(task)
+    except asyncio.CancelledError:
+        logger.info('Interrupted')
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        asyncio.set_event_loop(None)
+        loop.close()
 
-            loop.quit()
+def main_glib():
+    global adapters
+    global loop
+    global scanner
+    global window
+    global logger
+    global daemon
+    global pool
+    global scheduler
+    global devices
+    global timers
+    global store
 
-        elif len(devices) == 0:
-            loop.quit()
+    timers = Timers()
+    devices = DeviceRegistry(timers, max_devices, device_ttl, device_busy, forget_device)
+    scanner = dbluez.MultiScanner(adapters, new_device_cb)
+    pool = SyncPool(max_sessions, sync_finished, scanner.reach, timers)
+    if daemon == True:
+        scheduler = Scheduler(store, timers, sync_due, sync_interval, sync_jitter, retry_delay, admission)
+    else:
+        window = ScanWindow(expected_devices(t_started), scan_time, scan_min, scan_max)
+        timers.schedule('scan', window.deadline(), quit)
 
-    lock = Lock()
-    logger.info('Scan timeout')
+    scanner.startScan()
+    
+    GLib.threads_init()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        GLib.unix_signal_add(GLib.PRIORITY_HIGH, signum, shutdown)
+    loop = GLib.MainLoop()
+    try:
+        loop.run()
+    except KeyboardInterrupt:
+        logger.info('Interrupted via keyboard')
 
-    GLib.source_remove(timer)
+    timers.stop()
+    scanner.stopScan()
+    for address in devices.keys():
+        try:
+            devices[address].removeDevice()
+        except Exception as e:
+            None
 
-    thread = threading.Thread(target=sync)
-    thread.daemon = True
-    thread.start()
+    proxies = dbluez.Proxies()
+    logger.debug('D-Bus proxies: {} alive, {} created, {} reused'.format(len(proxies), proxies.created, proxies.reused))
 
 def main():
     global args
-    global adapter
+    global adapters
     global devices
-    global addresses_to_process
-    global addresses
+    global store
     global loop
     global scanner
-    global timer
     global logger
     global log_level
     global t_started
     global device_path
     global daemon
+    global pool
+    global max_sessions
+    global publisher
+    global output
+    global collector
+    global scheduler
+    global worker
+    global recorder
+    global admission
     
     device_path = ''
 
@@ -170,44 +1280,55 @@ def main():
     
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
     
-    addresses = {}
-    addresses_to_process = []
-    devices = {}
 
-    try:
-        if device_path != '':
-            with open(device_path, 'rb') as config_dictionary_file:
-                addresses = pickle.load(config_dictionary_file)
-                logger.debug(addresses)
-    except Exception:
-        logger.debug('{} not found')
-
-    scanner = dbluez.Scanner(adapter, new_device_cb)
-    scanner.startScan()
-    
-    GLib.threads_init()
-    if daemon == False:
-        timer = GLib.timeout_add(5000, quit)
-    loop = GLib.MainLoop()
-    try:
-        loop.run()
-    except KeyboardInterrupt:
-        logger.info('Interrupted via keyboard')
+    store = state.DeviceStore(device_path)
+    for address, interval in device_intervals.items():
+        store.set_interval(address, interval)
+    admission = Admission(store, breaker_failures, breaker_cooldown, breaker_max_cooldown, min_rssi)
 
-    scanner.stopScan()
-    for address in devices.keys():
-        try:
-            devices[address].removeDevice()
-            if devices[address].syncedSuccessfully() == True:
-                addresses[address] = { 'last_sync': t_started }
-            else:
-                addresses[address] = { 'last_sync': 0 }
-        except Exception as e:
-            None
+    if mqtt_host != None:
+        if mqtt == None:
+            logger.error('MQTT publishing requires the paho-mqtt package')
+            sys.exit(1)
+        publisher_spool = None
+        if queue_path != None:
+            publisher_spool = spool.Spool(queue_path, max_bytes=queue_size * 1024 * 1024)
+        publisher = MqttPublisher(mqtt_host, mqtt_port, mqtt_topic, mqtt_user, os.environ.get('MQTT_PASSWORD'), mqtt_window, publisher_spool, mqtt_backlog)
+        publisher.start()
+    elif queue_path != None:
+        logger.warning('The on-disk queue is only used for MQTT publishing, ignoring --queue')
+
+    collector = metrics.Collector(metrics_path, metrics_interval)
+
+    batching = {'max_records': batch_records, 'max_bytes': batch_bytes, 'max_latency': batch_latency}
+    if publisher != None:
+        output = sink.QueueSink(publisher, **batching)
+    elif output_path != None:
+        output = sink.FileSink(output_path, **batching)
+    else:
+        output = sink.StreamSink(sys.stdout, **batching)
+
+    if decode_queue > 0:
+        worker = parser.DecodeWorker(decode_queue)
+
+    if capture_path != None:
+        recorder = capture.CaptureWriter(capture_path)
+
+    if backend == 'asyncio':
+        main_async()
+    else:
+        main_glib()
+
+    if worker != None:
+        worker.close()
+    if recorder != None:
+        recorder.close()
+    collector.flush()
+    store.close()
+    output.close()
 
-    if device_path != '':
-        with open(device_path, 'wb') as device_dict_file:
-            pickle.dump(addresses, device_dict_file)
+    if publisher != None:
+        publisher.close()
 
     logger.info('Exit')
 
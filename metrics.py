@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+# Synchronization session metrics.
+#
+# Every finished session is split into its phases (see PHASES) from the
+# timestamps taken by Thingsboard and the BLE device, and aggregated into
+# fleet wide histograms and per device counters. The result is written in
+# the Prometheus text format, e.g. for the textfile collector of the node
+# exporter, and can be sent as Thingsboard telemetry of the node.
+
+import os
+import time
+import logging
+
+from threading import Lock
+
+PREFIX = 'afc_gateway'
+
+# phase name, start mark, end mark
+PHASES = (
+    ('scan_to_connect', 'seen', 'connect'),
+    ('connect', 'connect', 'connected'),
+    ('resolve', 'connected', 'resolved'),
+    ('discovery', 'resolved', 'notify'),
+    ('notify_start', 'notify', 'first_indication'),
+    ('transfer', 'first_indication', 'end'),
+    ('cts', 'end', 'cts'),
+    ('disconnect', 'disconnect', 'disconnected')
+)
+
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, 120, 300)
+BYTES_RATE_BUCKETS = (100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+RECORDS_RATE_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# seconds between two writes of the textfile
+DEFAULT_WRITE_INTERVAL = 15
+
+def Phases(marks):
+    phases = {}
+    for phase, start, end in PHASES:
+        if start in marks and end in marks and marks[end] >= marks[start]:
+            phases[phase] = marks[end] - marks[start]
+    return phases
+
+def Labels(**labels):
+    return ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                    for name, value in sorted(labels.items()))
+
+def Sample(name, labels, value):
+    if labels == '':
+        return '{} {}'.format(name, value)
+    return '{}{{{}}} {}'.format(name, labels, value)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] = self.counts[index] + 1
+        self.sum = self.sum + value
+        self.count = self.count + 1
+
+    def lines(self, name, **labels):
+        lines = []
+        for bound, count in zip(self.buckets, self.counts):
+            lines.append(Sample(name + '_bucket', Labels(le=bound, **labels), count))
+        lines.append(Sample(name + '_bucket', Labels(le='+Inf', **labels), self.count))
+        lines.append(Sample(name + '_sum', Labels(**labels), self.sum))
+        lines.append(Sample(name + '_count', Labels(**labels), self.count))
+        return lines
+
+class Collector:
+
+    def __init__(self, path = None, write_interval = DEFAULT_WRITE_INTERVAL):
+        self._logger = logging.getLogger(__name__)
+        self._path = path
+        self._write_interval = write_interval
+        self._written = 0
+        self._dirty = False
+        self._mutex = Lock()
+        # serializes the writes of the textfile, the series are under _mutex
+        self._write_mutex = Lock()
+
+        self._phases = {phase: Histogram(DURATION_BUCKETS) for phase, start, end in PHASES}
+        self._sessions = Histogram(DURATION_BUCKETS)
+        self._bytes_rate = Histogram(BYTES_RATE_BUCKETS)
+        self._records_rate = Histogram(RECORDS_RATE_BUCKETS)
+        self._devices = {}
+        self._adapters = {}
+        self._backpressure = 0
+
+    def record(self, stats):
+        marks = stats['marks']
+        phases = Phases(marks)
+        summary = {
+            'duration': max(marks.values()) - marks['connect'] if 'connect' in marks else 0,
+            'phases': phases,
+            'bytes_per_s': None,
+            'records_per_s': None
+            }
+        if phases.get('transfer', 0) > 0:
+            summary['bytes_per_s'] = stats['bytes'] / phases['transfer']
+            summary['records_per_s'] = stats['records'] / phases['transfer']
+
+        with self._mutex:
+            for phase, value in phases.items():
+                self._phases[phase].observe(value)
+            self._sessions.observe(summary['duration'])
+            if summary['bytes_per_s'] != None:
+                self._bytes_rate.observe(summary['bytes_per_s'])
+                self._records_rate.observe(summary['records_per_s'])
+
+            device = self._devices.setdefault(stats['address'], {
+                'node_name': stats['address'],
+                'sessions': 0,
+                'failures': 0,
+                'retries': 0,
+                'bytes': 0,
+                'records': 0,
+                'last_duration': 0,
+                'last_bytes_per_s': 0,
+                'last_success': 0
+                })
+            if stats['node_name'] != None:
+                device['node_name'] = stats['node_name']
+            device['sessions'] = device['sessions'] + 1
+            device['retries'] = device['retries'] + stats['retries']
+            device['bytes'] = device['bytes'] + stats['bytes']
+            device['records'] = device['records'] + stats['records']
+            device['last_duration'] = summary['duration']
+            if stats['success']:
+                device['last_success'] = time.time()
+                device['last_bytes_per_s'] = summary['bytes_per_s'] or 0
+            else:
+                device['failures'] = device['failures'] + 1
+
+            self._backpressure = self._backpressure + stats['backpressure']
+
+            adapter = self._adapters.setdefault(stats['adapter'], {'sessions': 0, 'failures': 0, 'bytes': 0, 'records': 0})
+            adapter['sessions'] = adapter['sessions'] + 1
+            adapter['failures'] = adapter['failures'] + (0 if stats['success'] else 1)
+            adapter['bytes'] = adapter['bytes'] + stats['bytes']
+            adapter['records'] = adapter['records'] + stats['records']
+
+            due = False
+            if self._path != None:
+                self._dirty = True
+                due = time.time() >= self._written + self._write_interval
+
+        self._logger.info('Session of {} on {} {}: {:.3f} s, {}{}'.format(
+            stats['address'], stats['adapter'], 'succeeded' if stats['success'] else 'failed', summary['duration'],
+            ', '.join('{} {:.3f} s'.format(phase, phases[phase]) for phase, start, end in PHASES if phase in phases),
+            ', {:.0f} B/s, {:.0f} records/s'.format(summary['bytes_per_s'], summary['records_per_s']) if summary['bytes_per_s'] != None else ''))
+
+        if due:
+            self.write()
+        return summary
+
+    def write_due(self):
+        # time of the write that the last sessions are waiting for
+        with self._mutex:
+            if not self._dirty:
+                return None
+            return self._written + self._write_interval
+
+    def flush(self):
+        with self._mutex:
+            dirty = self._dirty
+        if dirty:
+            self.write()
+
+    def forget(self, address):
+        # the series of a device are gone with its next write
+        with self._mutex:
+            if self._devices.pop(address, None) == None:
+                return
+            if self._path != None:
+                self._dirty = True
+
+    def telemetry(self, stats, summary):
+        values = {
+            'sync_success': stats['success'],
+            'sync_retries': stats['retries'],
+            'sync_bytes': stats['bytes'],
+            'sync_records': stats['records'],
+            'sync_duration': round(summary['duration'], 3),
+            'sync_backpressure': round(stats['backpressure'], 3)
+            }
+        if stats['rssi'] != None:
+            values['sync_rssi'] = round(stats['rssi'], 1)
+        for phase, value in summary['phases'].items():
+            values['sync_{}'.format(phase)] = round(value, 3)
+        if summary['bytes_per_s'] != None:
+            values['sync_bytes_per_s'] = round(summary['bytes_per_s'], 1)
+            values['sync_records_per_s'] = round(summary['records_per_s'], 1)
+        return {'ts': int(round(time.time() * 1000)), 'values': values}
+
+    def lines(self):
+        with self._mutex:
+            return self._lines()
+
+    def _lines(self):
+        lines = []
+        name = '{}_phase_seconds'.format(PREFIX)
+        lines.append('# HELP {} Duration of the phases of a synchronization session'.format(name))
+        lines.append('# TYPE {} histogram'.format(name))
+        for phase, start, end in PHASES:
+            lines.extend(self._phases[phase].lines(name, phase=phase))
+
+        for name, histogram, help in (('session_seconds', self._sessions, 'Duration of a synchronization session'),
+                                      ('transfer_bytes_per_second', self._bytes_rate, 'Transfer rate of a session'),
+                                      ('transfer_records_per_second', self._records_rate, 'Records per second of a session')):
+            name = '{}_{}'.format(PREFIX, name)
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} histogram'.format(name))
+            lines.extend(histogram.lines(name))
+
+        name = '{}_decode_backpressure_seconds_total'.format(PREFIX)
+        lines.append('# HELP {} Time the BLE event loop waited for the decode thread'.format(name))
+        lines.append('# TYPE {} counter'.format(name))
+        lines.append(Sample(name, '', self._backpressure))
+
+        for key, name, kind, help in (('sessions', 'sessions_total', 'counter', 'Synchronization sessions'),
+                                      ('failures', 'failures_total', 'counter', 'Failed synchronization sessions'),
+                                      ('retries', 'retries_total', 'counter', 'Connection retries'),
+                                      ('bytes', 'received_bytes_total', 'counter', 'Bytes received'),
+                                      ('records', 'received_records_total', 'counter', 'Records received'),
+                                      ('last_duration', 'last_session_seconds', 'gauge', 'Duration of the last session'),
+                                      ('last_bytes_per_s', 'last_transfer_bytes_per_second', 'gauge', 'Transfer rate of the last successful session'),
+                                      ('last_success', 'last_success_timestamp_seconds', 'gauge', 'Time of the last successful session')):
+            name = '{}_device_{}'.format(PREFIX, name)
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for address, device in sorted(self._devices.items()):
+                lines.append(Sample(name, Labels(address=address, node=device['node_name']), device[key]))
+
+        for key, help in (('sessions', 'Synchronization sessions'),
+                          ('failures', 'Failed synchronization sessions'),
+                          ('bytes', 'Bytes received'),
+                          ('records', 'Records received')):
+            name = '{}_adapter_{}_total'.format(PREFIX, key)
+            lines.append('# HELP {} {} per adapter'.format(name, help))
+            lines.append('# TYPE {} counter'.format(name))
+            for adapter, counters in sorted(self._adapters.items()):
+                lines.append(Sample(name, Labels(adapter=adapter), counters[key]))
+        return lines
+
+    def write(self):
+        with self._write_mutex:
+            with self._mutex:
+                # a session recorded from now on marks the file dirty again
+                self._written = time.time()
+                self._dirty = False
+                lines = self._lines()
+            tmp = self._path + '.tmp'
+            try:
+                with open(tmp, 'w') as f:
+                    f.write('\n'.join(lines) + '\n')
+                os.replace(tmp, self._path)
+            except Exception as e:
+                self._logger.error('Could not write metrics to {}: {}'.format(self._path, e))
@@ -1,16 +1,29 @@
 import sys
-import dbus
+import os
 import time
 
 import logging
 import json
-
+import queue
 import threading
+
 from threading import Condition, Lock
 from datetime import datetime
 
-import dbluez
+import sink
 import struct
+import asyncio
+
+# decoding and replay work without D-Bus, only sessions need it
+try:
+    import dbluez
+except ImportError:
+    dbluez = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 AFC_GSS_UUID                = '8fee1801-3c17-4189-8556-a293fa6b2739'
 AFC_GSC_UUID                = '8fee2a01-3c17-4189-8556-a293fa6b2739'
@@ -42,6 +55,8 @@ AFC_ANS_NNC_UUID            = '8fee2a31-3c17-4189-8556-a293fa6b2739'
 GEN_CTS_UUID                = '00001805-0000-1000-8000-00805f9b34fb'
 GEN_CTS_CT_UUID             = '00002a2b-0000-1000-8000-00805f9b34fb'
 
+GEN_CCCD_UUID               = '00002902-0000-1000-8000-00805f9b34fb'
+
 AFC_SYNC_DATA = {
     AFC_TIMESTAMP_UUID: {
         'name': 'timestamp',
@@ -178,24 +193,292 @@ AFC_SYNC_DATA = {
     }
 }
 
+NUMPY_TYPES = {
+    'B': 'u1',
+    'b': 'i1',
+    'H': '<u2',
+    'h': '<i2',
+    'I': '<u4',
+    'i': '<i4'
+}
+
+class BulkRecords:
+
+    def __init__(self, ts, columns):
+        self._ts = ts
+        self._columns = columns
+
+    def __len__(self):
+        return len(self._ts)
+
+    def __iter__(self):
+        if len(self._columns) == 0:
+            for ts in self._ts:
+                yield {'ts': ts, 'values': {}}
+            return
+
+        names = [name for name, values in self._columns]
+        for ts, row in zip(self._ts, zip(*[values for name, values in self._columns])):
+            yield {'ts': ts, 'values': dict(zip(names, row))}
+
+class RecordDecoder:
+
+    _cache = {}
+    _cache_lock = Lock()
+
+    def __init__(self, descriptors):
+        self.descriptors = tuple(descriptors)
+        self.calibration = AFC_SOIL_HUMIDITY_L_UUID in self.descriptors
+
+        fmt = '<'
+        self._ts_index = None
+        self._fields = []
+        index = 0
+        for desc in self.descriptors:
+            if desc == GEN_CCCD_UUID:
+                continue
+
+            fmt = fmt + AFC_SYNC_DATA[desc]['type'].lstrip('<')
+            if desc == AFC_TIMESTAMP_UUID:
+                self._ts_index = index
+            else:
+                self._fields.append((index, AFC_SYNC_DATA[desc]['name'],
+                                     AFC_SYNC_DATA[desc]['multiplicator'], AFC_SYNC_DATA[desc]['precision']))
+            index = index + 1
+
+        self._format = fmt
+        self._struct = struct.Struct(fmt)
+        self.size = self._struct.size
+        self._dtype = None
+
+    @classmethod
+    def compile(cls, descriptors):
+        key = tuple(descriptors)
+        decoder = cls._cache.get(key)
+        if decoder == None:
+            with cls._cache_lock:
+                decoder = cls._cache.get(key)
+                if decoder == None:
+                    decoder = cls(key)
+                    cls._cache[key] = decoder
+        return decoder
+
+    def decode(self, data, ts):
+        count = data[0]
+        if self.size == 0:
+            return [{'ts': ts, 'values': {}} for x in range(0, count)]
+        if len(data) - 1 < count * self.size:
+            raise struct.error('payload too short for {} records of {} bytes'.format(count, self.size))
+
+        records = []
+        ts_index = self._ts_index
+        fields = self._fields
+        for raw in self._struct.iter_unpack(memoryview(data)[1:1 + count * self.size]):
+            if ts_index != None:
+                ts = raw[ts_index] * 1000
+            values = {}
+            for index, name, multiplicator, precision in fields:
+                values[name] = round(raw[index] * multiplicator, precision)
+            records.append({'ts': ts, 'values': values})
+        return records
+
+    def decode_bulk(self, payloads, timestamps):
+        if numpy == None:
+            records = []
+            for data, ts in zip(payloads, timestamps):
+                records.extend(self.decode(data, ts))
+            return records
+
+        if self._dtype == None:
+            self._dtype = numpy.dtype([('f{}'.format(x), NUMPY_TYPES[c]) for x, c in enumerate(self._format.lstrip('<'))])
+
+        counts = numpy.fromiter((data[0] for data in payloads), dtype=numpy.int64, count=len(payloads))
+        if self.size == 0:
+            return BulkRecords(numpy.repeat(numpy.asarray(timestamps, dtype=numpy.int64), counts).tolist(), [])
+
+        body = b''.join(data[1:1 + data[0] * self.size] for data in payloads)
+        if len(body) != int(counts.sum()) * self.size:
+            raise struct.error('bulk payload too short for {} records of {} bytes'.format(int(counts.sum()), self.size))
+        raw = numpy.frombuffer(body, dtype=self._dtype)
+
+        if self._ts_index != None:
+            ts = (raw['f{}'.format(self._ts_index)].astype(numpy.int64) * 1000).tolist()
+        else:
+            ts = numpy.repeat(numpy.asarray(timestamps, dtype=numpy.int64), counts).tolist()
+
+        columns = []
+        for index, name, multiplicator, precision in self._fields:
+            column = raw['f{}'.format(index)]
+            if precision == 0 and isinstance(multiplicator, int):
+                values = (column.astype(numpy.int64) * multiplicator).tolist()
+            elif isinstance(multiplicator, float) and multiplicator == 10 ** -precision:
+                # raw / 10^p is the correctly rounded double of the decimal
+                # that round(raw * 10^-p, p) yields, so both paths agree bit for bit
+                values = (column.astype(numpy.float64) / 10 ** precision).tolist()
+            else:
+                values = [round(value * multiplicator, precision) for value in column.tolist()]
+            columns.append((name, values))
+
+        return BulkRecords(ts, columns)
+
+def CurrentTimePayload():
+    utctime = datetime.utcnow()
+    return struct.pack('<HBBBBBBBB',
+                       utctime.year, utctime.month, utctime.day,
+                       utctime.hour, utctime.minute, utctime.second,
+                       0, int(utctime.microsecond/3906.25), 0)
+
+# seconds a cached node name is used before it is read from the node again
+DEFAULT_NAME_TTL = 86400
+
+class LayoutCache:
+    # GATT layouts by address. GetManagedObjects is needed for the
+    # fingerprint anyway, a hit saves the node name read: a rename does not
+    # change the fingerprint, so the name is only read again after name_ttl
+    def __init__(self, path, name_ttl = DEFAULT_NAME_TTL):
+        self._logger = logging.getLogger('{}.layout'.format(__name__))
+        self._path = path
+        self._name_ttl = name_ttl
+        self._mutex = Lock()
+        self._layouts = {}
+
+        try:
+            with open(path, 'r') as f:
+                self._layouts = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            self._logger.warning('Ignoring unreadable layout cache {}: {}'.format(path, e))
+
+    def get(self, address, fingerprint):
+        with self._mutex:
+            layout = self._layouts.get(address)
+        if layout == None:
+            return None
+        if layout['fingerprint'] != fingerprint:
+            self._logger.info('GATT layout of {} changed, invalidating cache entry'.format(address))
+            self.invalidate(address)
+            return None
+        return layout
+
+    def name_due(self, layout):
+        return time.time() >= layout.get('named', 0) + self._name_ttl
+
+    def put(self, address, layout):
+        with self._mutex:
+            self._layouts[address] = layout
+            self._save()
+
+    def invalidate(self, address):
+        with self._mutex:
+            if self._layouts.pop(address, None) != None:
+                self._save()
+
+    def _save(self):
+        tmp = self._path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self._layouts, f)
+            os.replace(tmp, self._path)
+        except Exception as e:
+            self._logger.error('Could not write layout cache {}: {}'.format(self._path, e))
+
+DEFAULT_DECODE_QUEUE = 1024
+
+class DecodeWorker:
+    # decodes and emits indications off the BLE event loop. Work is queued
+    # as calls and run in order by one thread, so a call queued after the
+    # payloads of a session runs after all of them. The queue is bounded: a
+    # full queue blocks the producer, the time it waited is accounted
+    def __init__(self, max_queue = DEFAULT_DECODE_QUEUE):
+        self._logger = logging.getLogger('{}.worker'.format(__name__))
+        self._queue = queue.Queue(max_queue)
+        self._mutex = Lock()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+        self.calls = 0
+        self.max_depth = 0
+        self.waits = 0
+        self.wait_time = 0
+
+    def call(self, fn, *args):
+        wait = 0
+        try:
+            self._queue.put_nowait((fn, args))
+        except queue.Full:
+            started = time.time()
+            self._queue.put((fn, args))
+            wait = time.time() - started
+        with self._mutex:
+            self.calls = self.calls + 1
+            self.max_depth = max(self.max_depth, self._queue.qsize())
+            if wait > 0:
+                self.waits = self.waits + 1
+                self.wait_time = self.wait_time + wait
+        return wait
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item == None:
+                return
+            fn, args = item
+            try:
+                fn(*args)
+            except Exception as e:
+                self._logger.error('Error in {}: {}'.format(getattr(fn, '__name__', fn), e))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._logger.debug('Processed {} calls, queue depth up to {}, producers waited {} times for {:.3f} s'.format(
+            self.calls, self.max_depth, self.waits, self.wait_time))
+
 class Thingsboard:
     
     mutex = Lock()
     
-    def __init__(self, device):
+    def __init__(self, device, bulk = False, output = None, layout_cache = None, worker = None, capture = None):
         self._logger = logging.getLogger('{}[{}]'.format(__name__, device.getAddress()))
         self._device = device
+        self._bulk = bulk
+        # without a shared sink every indication is written out right away
+        self._output = output if output != None else sink.StreamSink(max_records=1)
+        self._layout_cache = layout_cache
+        # decodes on the caller's thread without a worker
+        self._worker = worker
+        # raw indications are appended to the capture before they are decoded
+        self._capture = capture
+        self._capture_id = None
+        self._decoder = None
+        self._payloads = []
+        self._timestamps = []
         self._cv  = Condition()
         
         self._ccv = False
         
         self._node_name = None
         self._jdata = []
+        self._last_ts = 0
 
         self._sync_success = False
 
-        self._lock = None
-        self._cleanup = 0
+        self._done_cb = None
+        self._syncing = False
+
+        self._seen = None
+        self._rssi = None
+        self._marks = {}
+        self._sync_cnt = 0
+        self._byte_cnt = 0
+        self._ind_cnt  = 0
+        self._backpressure = 0
+        self._steps = 0
         
     def __enter__(self):
         None
@@ -203,61 +486,145 @@ class Thingsboard:
     def __exit__(self):
         None
         
-    def startSynchronization(self, lock = None, cleanup = 0):
+    def startSynchronization(self, done_cb = None):
         self._logger.info('Start synchronization')
-        self._lock = lock
-        self._cleanup = cleanup
+        self._done_cb = done_cb
+        self._syncing = True
+        self._sync_success = False
+        self.markSession()
+        self.resetValues()
         self._device.connect(self.disconnect_cb, self.discoveryComplete)
         self._sync_cnt = 0
         self._byte_cnt = 0
         self._ind_cnt  = 0
+        self._backpressure = 0
+
+    def resetValues(self):
+        # values left over by a failed session must not go out with this one
+        if self._worker != None:
+            self._worker.call(self.clearValues)
+        else:
+            self.clearValues()
+
+    def clearValues(self):
+        self._payloads = []
+        self._timestamps = []
+        self._jdata = []
 
     def endSynchronization(self):
-        dis_time = time.time()
+        self._marks['end'] = time.time()
         self._logger.debug('End synchronization')
-        self.synchronizeTime()
-        cts_time = time.time()
         self._char_sig_rcv.remove()
+        if self._cts == None:
+            self.timeSynchronized()
+            return
 
-        self._device.disconnect()
+        # ATT round trips are never waited for on the main loop, other sessions share it
+        self._logger.debug('Writing time info to remote CTS')
+        self._cts.WriteValue(CurrentTimePayload(), {}, reply_handler=self.timeSynchronized, error_handler=self.timeSyncFailed)
+
+    def timeSyncFailed(self, e):
+        self._logger.error('Writing time info to remote CTS failed: {}'.format(e))
+        self.timeSynchronized()
+
+    def timeSynchronized(self):
+        if not self._syncing:
+            # the link was lost during the write
+            return
+        self._marks['cts'] = time.time()
+
+        # the session only ends once the link is down, so a new connection
+        # never overlaps with this one, and once all of its records are out
+        with self._cv:
+            self._steps = 2
+        self._marks['disconnect'] = time.time()
+        self._device.disconnect(self.stepDone)
+
+        if self._worker != None:
+            # queued behind the payloads of this session
+            self._worker.call(self.completeSynchronization)
+        else:
+            self.completeSynchronization()
+
+    def completeSynchronization(self):
+        started = time.time()
+        try:
+            self.flushValues()
+            self._sync_success = True
+        except Exception as e:
+            self._logger.error('Processing the received data failed: {}'.format(e))
+
+        self._logger.info('Received {} data sets ({} bytes) with {} indications in {:.3f} s (CTS write {:.3f} s, output {:.3f} s, decode backpressure {:.3f} s)'.format(
+            self._sync_cnt, self._byte_cnt, self._ind_cnt, self._marks['end'] - self._marks['notify'], self._marks['cts'] - self._marks['end'],
+            time.time() - started, self._backpressure))
+        self.stepDone()
+
+    def stepDone(self):
+        with self._cv:
+            self._steps = self._steps - 1
+            done = self._steps == 0
+        if done:
+            self.finishSynchronization()
+
+    def flushValues(self):
+        if self._bulk and self._decoder != None:
+            self.emitBulk()
 
         if len(self._jdata) > 0:
-            print('{}'.format(json.dumps({self._node_name: self._jdata})), flush=True)
+            self.emit()
 
-        self._logger.info('Received {} data sets ({} bytes) with {} indications in {} s ({} {})'.format(self._sync_cnt, self._byte_cnt, self._ind_cnt, dis_time - self._indication_started, cts_time - dis_time, time.time() - dis_time))
-        
-        self._lock.release()
-        self._lock = None
-
-        self._sync_success = True
-
-        def cleanup():
-            self._logger.debug('Cleaning up in {} s'.format(self._cleanup))
-            time.sleep(self._cleanup)
-            self._logger.debug('Cleaning up'.format(self._cleanup))
-            self._device.remove()
-
-        if self._cleanup > 0:
-            thread = threading.Thread(target=cleanup)
-            thread.daemon = True
-            thread.start()
-
-    def synchronizeTime(self):
-        utctime = datetime.utcnow()
-        bt_date_time = struct.pack('<HBBBBBBBB',
-                                   utctime.year, utctime.month, utctime.day,
-                                   utctime.hour, utctime.minute, utctime.second,
-                                   0, int(utctime.microsecond/3906.25), 0)
-        self._logger.debug('Writing time info to remote CTS')
-        self._cts.WriteValue(bt_date_time, {})
+    def emit(self):
+        self._last_ts = max(self._last_ts, self._jdata[-1]['ts'])
+        self._output.write(self._node_name, self._jdata)
+        self._jdata = []
+
+    def emitBulk(self):
+        try:
+            records = self._decoder.decode_bulk(self._payloads, self._timestamps)
+        except struct.error:
+            if self._layout_cache != None:
+                self._layout_cache.invalidate(self.getAddress())
+            raise
+        self._payloads = []
+        self._timestamps = []
+        self._logger.debug('Decoded {} buffered records'.format(len(records)))
+
+        self._jdata.extend(records)
+        if len(self._jdata) > 0:
+            self.emit()
 
-    def getNodeName(self):
+    def cancelSynchronization(self):
+        if self._device.connecting():
+            self._device.cancel()
+            self.finishSynchronization()
+
+    def finishSynchronization(self):
+        self.endCapture()
+        self._syncing = False
+        done_cb = self._done_cb
+        self._done_cb = None
+        if done_cb != None:
+            done_cb(self)
+
+    def readNodeName(self, named_cb):
+        # the session goes on with the notifications once the name is known
         if self._nnc == None:
-            return self._device._address
+            named_cb(self.getAddress())
+            self.startNotifications()
+            return
+
+        def on_reply(value):
+            if self._syncing:
+                named_cb(bytes(value).decode('utf-8'))
+                self.startNotifications()
+
+        def on_error(e):
+            if self._syncing:
+                self._logger.error('Getting remote device name failed: {}'.format(e))
+                self.abortSynchronization()
 
         self._logger.info('Getting remote device name')
-        return bytes(self._nnc.ReadValue({})).decode("utf-8")
-        
+        self._nnc.ReadValue({}, reply_handler=on_reply, error_handler=on_error)
 
     def removeDevice(self):
         self._device.remove()
@@ -271,11 +638,13 @@ class Thingsboard:
             except Exception as e:
                 self._logger.error('Error disconnecting from device: {}'.format(e))
 
-            if self._lock != None:
-                self._lock.release()
-                self._lock = None
+            if self._worker != None:
+                # records of the session that are still queued go out first
+                self._worker.call(self.finishSynchronization)
+            else:
+                self.finishSynchronization()
 
-    def discoveryComplete(self):        
+    def discoveryComplete(self):
         self._logger.info('Discovery completed')
         self._ccv = True
         self._afc_descriptors = {}
@@ -283,93 +652,374 @@ class Thingsboard:
         self._nnc = None
         self._cts = None
 
+        if AFC_GSC_UUID not in self._device.characteristics:
+            self._logger.warning('No service found to synchronize, disconnecting')
+            self.abortSynchronization()
+            return
+
+        layout = None
+        if self._layout_cache != None:
+            layout = self._layout_cache.get(self.getAddress(), self._device.layout_fingerprint)
+
+        if layout != None:
+            self._logger.info('Using cached GATT layout')
+            if AFC_ANS_NNC_UUID in self._device.characteristics:
+                self._nnc = self._device.characteristics[AFC_ANS_NNC_UUID]
+            if layout['cts']:
+                self._cts = self._device.characteristics[GEN_CTS_CT_UUID]
+            self._sc_cccd = layout['cccd']
+            self._afc_descriptors = dict(layout['descriptors'])
+            if self._layout_cache.name_due(layout):
+                self.readNodeName(lambda node_name: self.validateNodeName(layout, node_name))
+            else:
+                self._node_name = layout['node_name']
+                self.startNotifications()
+        else:
+            self.resolveLayout()
+
+    def startNotifications(self):
+        if self._sc_cccd == None:
+            self._logger.warning('Synchronization characteristic has no CCCD, disconnecting')
+            self.abortSynchronization()
+            return
+        if not self.compileDecoder():
+            self.abortSynchronization()
+            return
+
+        characteristic = self._device.characteristics[AFC_GSC_UUID]
+        self._logger.info('Start notifications/indications')
+        self._marks['notify'] = time.time()
+        self.beginCapture()
+        # notifications are streamed through a socket if BlueZ hands one out
+        self._char_sig_rcv = None
+        if 'notify' in self._device.characteristic_flags.get(AFC_GSC_UUID, []):
+            self._char_sig_rcv = dbluez.AcquireNotifyCb(characteristic, self.value_cb)
+        if self._char_sig_rcv == None:
+            self._char_sig_rcv = dbluez.GetPropertiesChangedCb(characteristic, self.indication_cb)
+            characteristic.StartNotify()
+
+    def abortSynchronization(self):
+        self._device.disconnect()
+        self.finishSynchronization()
+
+    def compileDecoder(self):
+        try:
+            self._decoder = RecordDecoder.compile(self._afc_descriptors.values())
+        except KeyError as e:
+            self._decoder = None
+            if self._capture == None:
+                self._logger.error('Unknown descriptor {}, disconnecting'.format(e))
+                return False
+            # the session is still captured, it can be replayed once the descriptor is known
+            self._logger.error('Unknown descriptor {}, capturing without decoding'.format(e))
+        self._calibration = self._decoder != None and self._decoder.calibration
+        return True
+
+    def beginCapture(self):
+        if self._capture != None:
+            self._capture_id = self._capture.begin(self.getAddress(), self._node_name, tuple(self._afc_descriptors.values()))
+
+    def endCapture(self):
+        if self._capture_id != None:
+            self._capture.end(self._capture_id, self._sync_success)
+            self._capture_id = None
+
+    def validateNodeName(self, layout, node_name):
+        self._node_name = node_name
+        if node_name != layout['node_name']:
+            self._logger.info('Node renamed from {} to {}, updating cache entry'.format(layout['node_name'], node_name))
+        layout = dict(layout)
+        layout['node_name'] = node_name
+        layout['named'] = time.time()
+        self._layout_cache.put(self.getAddress(), layout)
+
+    def resolveLayout(self):
         if AFC_ANS_NNC_UUID in self._device.characteristics:
             self._logger.info('Found AFC node name characteristics')
             self._nnc = self._device.characteristics[AFC_ANS_NNC_UUID]
 
-        self._node_name = self.getNodeName()
-
         if GEN_CTS_CT_UUID in self._device.characteristics: 
             self._logger.info('Found CTS')
             self._cts = self._device.characteristics[GEN_CTS_CT_UUID]
-        
-        if AFC_GSC_UUID in self._device.characteristics:
-            characteristic = self._device.characteristics[AFC_GSC_UUID]
-            for key in sorted(self._device.descriptors.keys()):
-                if key.startswith(characteristic.object_path):
-                    uuid = dbluez.GetDescriptorProperty(self._device.descriptors[key], 'UUID')
-                    if uuid == dbluez.BLE_GATT_CCCD:
-                        self._sc_cccd = self._device.descriptors[key]
-                    else:
-                        self._afc_descriptors[key] = uuid
-                        
-            if self._sc_cccd != None:
-                self._char_sig_rcv = dbluez.GetPropertiesChangedCb(characteristic, self.indication_cb)
-                self._logger.info('Start notifications/indications')
-                self._indication_started = time.time()
-                characteristic.StartNotify()
-            
-        else:
-            self._logger.warning('No service found to synchronize, disconnecting')
-            self._device.disconnect()
-            self._logger.debug('Release lock')
-            if self._lock != None:
-                self._lock.release()
-                self._lock = None
+
+        def named(node_name):
+            # the cache entry is only stored with the name
+            self._node_name = node_name
+            self.resolveDescriptors(self._device.characteristics.path(AFC_GSC_UUID))
+        self.readNodeName(named)
+
+    def resolveDescriptors(self, characteristic_path):
+        prefix = characteristic_path + '/'
+        for key in sorted(self._device.descriptor_uuids.keys()):
+            if key.startswith(prefix):
+                uuid = self._device.descriptor_uuids[key]
+                if uuid == GEN_CCCD_UUID:
+                    self._sc_cccd = key
+                else:
+                    self._afc_descriptors[key] = uuid
+
+        if self._sc_cccd != None and self._layout_cache != None:
+            self._layout_cache.put(self.getAddress(), {
+                'fingerprint': self._device.layout_fingerprint,
+                'node_name': self._node_name,
+                'named': time.time(),
+                'nnc': self._nnc != None,
+                'cts': self._cts != None,
+                'cccd': self._sc_cccd,
+                'descriptors': list(self._afc_descriptors.items())
+                })
     
     def indication_cb(self, properties, changed_props, invalidated_props):
         if 'Value' in changed_props:
-            data = bytes(changed_props['Value'])
-            self._logger.debug('Received {} bytes of data'.format(len(data), data))
-            
-            if data == b'\x00':
-                self.endSynchronization()
-                return
-            
-            self._ind_cnt = self._ind_cnt + 1
-            ts = int(round(time.time() * 1000))
-            
-            offset = 1
-            dataset_cnt = data[0]
-            self._sync_cnt = self._sync_cnt + dataset_cnt
-            self._byte_cnt = self._byte_cnt + len(data)
-            for x in range(0, dataset_cnt):
-                jdata = {}
-                for desc in self._afc_descriptors.values():
-                    if desc == dbluez.BLE_GATT_CCCD:
-                        continue
-                    
-                    if desc == AFC_TIMESTAMP_UUID:
-                        ts = (struct.unpack_from('<I', data, offset)[0] * 1000)
-                        offset = offset + 4;
-                        continue
-                    
-                    if desc == AFC_SOIL_HUMIDITY_L_UUID:
-                        self._calibration = True
-                    
-                    raw = struct.unpack_from(AFC_SYNC_DATA[desc]['type'], data, offset)[0]
-                    self._logger.debug('Received raw data: {}'.format(raw))
-                    jdata[AFC_SYNC_DATA[desc]['name']] = round( raw \
-                        * AFC_SYNC_DATA[desc]['multiplicator'], AFC_SYNC_DATA[desc]['precision'])
-                    offset = offset + AFC_SYNC_DATA[desc]['size']
-
-                self._jdata.append({'ts': ts, 'values': jdata})
-
-                self._logger.debug('Data count in JSON: {}'.format(len(self._jdata)))
-                if len(self._jdata) > 4:
-                    print('{}'.format(json.dumps({self._node_name: self._jdata})), flush=True)
-                    self._jdata = []
+            self.value_cb(bytes(changed_props['Value']))
                 
         if 'Notifying' in changed_props:
             self._logger.debug('Received notifying')
 
         if 'Value' not in changed_props and 'Notifying' not in changed_props:
             self._logger.warning('Unknown changed properties: {}'.format(changed_props))
+
+    def value_cb(self, data):
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug('Received {} bytes of data'.format(len(data)))
+
+        if data == b'\x00':
+            self.endSynchronization()
+            return
+
+        self.handleValue(data)
+
+    def handleValue(self, data):
+        self._ind_cnt = self._ind_cnt + 1
+        now = time.time()
+        ts = int(round(now * 1000))
+        if self._ind_cnt == 1:
+            self._marks['first_indication'] = now
+
+        self._sync_cnt = self._sync_cnt + data[0]
+        self._byte_cnt = self._byte_cnt + len(data)
+        if self._capture_id != None:
+            self._capture.indication(self._capture_id, ts, data)
+        # data may be a view into a receive buffer (see dbluez.NotifySocket),
+        # it is only copied where it is kept
+        if self._worker != None:
+            self._backpressure = self._backpressure + self._worker.call(self.processValue, bytes(data), ts)
+            return
+        self.processValue(data, ts)
+
+    def processValue(self, data, ts):
+        if self._decoder == None:
+            return
+
+        if self._bulk:
+            self._payloads.append(bytes(data))
+            self._timestamps.append(ts)
+            return
+
+        try:
+            records = self._decoder.decode(data, ts)
+        except struct.error:
+            if self._layout_cache != None:
+                self._layout_cache.invalidate(self.getAddress())
+            raise
+
+        if self._logger.isEnabledFor(logging.DEBUG):
+            for record in records:
+                self._logger.debug('Received record: {}'.format(record))
+
+        # batching is up to the output sink, hand over whole indications
+        self._jdata.extend(records)
+        if len(self._jdata) > 0:
+            self.emit()
     
+    def getAddress(self):
+        return self._device.getAddress()
+
+    def getAdapter(self):
+        return self._device.getAdapter()
+
+    def setAdapter(self, adapter):
+        self._device.setAdapter(adapter)
+
+    def nodeName(self):
+        return self._node_name
+
+    def setLayout(self, node_name, descriptors):
+        # decodes without discovery, e.g. a replayed capture
+        self._node_name = node_name
+        self._decoder = RecordDecoder.compile(descriptors)
+
+    def lastRecordTimestamp(self):
+        return self._last_ts
+
     def syncedSuccessfully(self):
         return self._sync_success
 
-    def locked(self):
-        if self._lock != None:
-            return self._lock.locked()
-        return None
+    def syncing(self):
+        return self._syncing
+
+    def markSeen(self, ts = None):
+        self._seen = ts if ts != None else time.time()
+
+    def setRssi(self, rssi):
+        self._rssi = rssi
+
+    def setConnectAttempts(self, attempts):
+        self._device.setConnectAttempts(attempts)
+
+    def markSession(self):
+        self._marks = {'connect': time.time()}
+        # only the first session after an advertisement has a scan latency
+        if self._seen != None:
+            self._marks['seen'] = self._seen
+            self._seen = None
+
+    def sessionStats(self):
+        marks = dict(self._marks)
+        marks.update(self._device.timing)
+        return {
+            'address': self.getAddress(),
+            'adapter': self.getAdapter(),
+            'node_name': self._node_name,
+            'success': self._sync_success,
+            'retries': max(0, self._device.attempts() - 1),
+            'bytes': self._byte_cnt,
+            'records': self._sync_cnt,
+            'indications': self._ind_cnt,
+            'backpressure': self._backpressure,
+            'rssi': self._rssi,
+            'marks': marks
+            }
+
+class AsyncThingsboard(Thingsboard):
+
+    async def synchronize(self, timeout = 60):
+        self._logger.info('Start synchronization')
+        self._syncing = True
+        self._sync_success = False
+        self._sync_cnt = 0
+        self._byte_cnt = 0
+        self._ind_cnt  = 0
+        self._backpressure = 0
+        self.markSession()
+        self.resetValues()
+        values = asyncio.Queue()
+        try:
+            await self._device.connect()
+            await self._device.discover()
+            self._logger.info('Discovery completed')
+            if AFC_GSC_UUID not in self._device.characteristics:
+                self._logger.warning('No service found to synchronize, disconnecting')
+                return
+
+            await self.resolveLayoutAsync()
+            if self._sc_cccd == None:
+                self._logger.warning('Synchronization characteristic has no CCCD, disconnecting')
+                return
+
+            if not self.compileDecoder():
+                return
+            self._logger.info('Start notifications/indications')
+            self._marks['notify'] = time.time()
+            self.beginCapture()
+            await self._device.start_notify(self._device.characteristics[AFC_GSC_UUID], values.put_nowait)
+
+            while True:
+                data = await asyncio.wait_for(values.get(), timeout)
+                if data == b'\x00':
+                    break
+                self.handleValue(data)
+
+            dis_time = time.time()
+            self._marks['end'] = dis_time
+            self._logger.debug('End synchronization')
+            if self._cts != None:
+                self._logger.debug('Writing time info to remote CTS')
+                await self._device.write(self._cts, CurrentTimePayload())
+            cts_time = time.time()
+            self._marks['cts'] = cts_time
+
+            await self.drainValues(True)
+
+            self._logger.info('Received {} data sets ({} bytes) with {} indications in {:.3f} s (CTS write {:.3f} s, output {:.3f} s, decode backpressure {:.3f} s)'.format(
+                self._sync_cnt, self._byte_cnt, self._ind_cnt, dis_time - self._marks['notify'], cts_time - dis_time, time.time() - cts_time, self._backpressure))
+            self._sync_success = True
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            self._logger.error('Synchronization timed out')
+        except Exception as e:
+            self._logger.error('Synchronization failed: {}'.format(e))
+        finally:
+            self._marks['disconnect'] = time.time()
+            try:
+                await self._device.disconnect()
+            except Exception as e:
+                self._logger.error('Error disconnecting from device: {}'.format(e))
+            if not self._sync_success:
+                await self.drainValues()
+            self.endCapture()
+            self._syncing = False
+
+    async def drainValues(self, flush = False):
+        # waits until the worker processed everything queued so far
+        if self._worker == None:
+            if flush:
+                self.flushValues()
+            return
+
+        loop = asyncio.get_event_loop()
+        drained = loop.create_future()
+
+        def done():
+            error = None
+            if flush:
+                try:
+                    self.flushValues()
+                except Exception as e:
+                    error = e
+            loop.call_soon_threadsafe(drained.set_result, error)
+
+        self._worker.call(done)
+        error = await drained
+        if error != None:
+            raise error
+
+    async def resolveLayoutAsync(self):
+        self._afc_descriptors = {}
+        self._sc_cccd = None
+        self._nnc = None
+        self._cts = None
+
+        layout = None
+        if self._layout_cache != None:
+            layout = self._layout_cache.get(self.getAddress(), self._device.layout_fingerprint)
+
+        if layout != None:
+            self._logger.info('Using cached GATT layout')
+            self._nnc = self._device.characteristics.get(AFC_ANS_NNC_UUID)
+            if not self._layout_cache.name_due(layout):
+                self._node_name = layout['node_name']
+            elif self._nnc != None:
+                self._logger.info('Getting remote device name')
+                self.validateNodeName(layout, (await self._device.read(self._nnc)).decode('utf-8'))
+            else:
+                self.validateNodeName(layout, self.getAddress())
+            if layout['cts']:
+                self._cts = self._device.characteristics[GEN_CTS_CT_UUID]
+            self._sc_cccd = layout['cccd']
+            self._afc_descriptors = dict(layout['descriptors'])
+            return
+
+        self._nnc = self._device.characteristics.get(AFC_ANS_NNC_UUID)
+        if self._nnc != None:
+            self._logger.info('Getting remote device name')
+            self._node_name = (await self._device.read(self._nnc)).decode('utf-8')
+        else:
+            self._node_name = self.getAddress()
+
+        self._cts = self._device.characteristics.get(GEN_CTS_CT_UUID)
+        self.resolveDescriptors(self._device.characteristics[AFC_GSC_UUID])
+
+    async def removeDevice(self):
+        await self._device.remove()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+# Batched telemetry output.
+#
+# A sink collects the records of all nodes and writes them as one compact
+# Thingsboard gateway document ({"node A": [...], "node B": [...]}) once the
+# batch reaches max_records records or max_bytes bytes, or when its oldest
+# record is max_latency seconds old. A write that does not fit fills up the
+# current batch and continues in the next one. Records are encoded when they
+# are added, so a flush only joins strings.
+
+import sys
+import json
+import time
+import logging
+import threading
+
+from threading import Condition
+
+ENCODER = json.JSONEncoder(separators=(',', ':'), check_circular=False)
+
+# Thingsboard rejects MQTT messages above 64 KiB by default
+DEFAULT_MAX_RECORDS = 1000
+DEFAULT_MAX_BYTES = 60000
+DEFAULT_MAX_LATENCY = 5.0
+
+class Sink:
+
+    def __init__(self, max_records = DEFAULT_MAX_RECORDS, max_bytes = DEFAULT_MAX_BYTES, max_latency = DEFAULT_MAX_LATENCY):
+        self._logger = logging.getLogger('{}.{}'.format(__name__, type(self).__name__))
+        self._max_records = max_records
+        self._max_bytes = max_bytes
+        self._max_latency = max_latency
+
+        self._cv = Condition()
+        self._nodes = {}
+        self._records = 0
+        self._bytes = 2
+        self._deadline = None
+        self._closed = False
+        self._thread = None
+
+        self.batches = 0
+        self.records = 0
+
+    def write(self, node_name, records):
+        if len(records) == 0:
+            return
+        chunk = ENCODER.encode(records)[1:-1]
+        with self._cv:
+            self._add(node_name, records, chunk)
+
+    def _size(self, node_name, chunk):
+        size = len(chunk) + 1
+        if node_name not in self._nodes:
+            size = size + len(ENCODER.encode(node_name)) + 4
+        return size
+
+    def _add(self, node_name, records, chunk):
+        while True:
+            size = self._size(node_name, chunk)
+            if self._records + len(records) <= self._max_records and self._bytes + size <= self._max_bytes:
+                self._append(node_name, len(records), chunk, size)
+                break
+
+            # fill the current batch up to its limits and carry the rest over
+            # to the next one, the records of a node stay in order
+            encoded = [ENCODER.encode(record) for record in records]
+            room = self._max_bytes - self._bytes - self._size(node_name, '') + 1
+            limit = min(len(records), self._max_records - self._records)
+            count = 0
+            used = 0
+            while count < limit and used + len(encoded[count]) + 1 <= room:
+                used = used + len(encoded[count]) + 1
+                count = count + 1
+            if count == 0 and self._records == 0:
+                # a record larger than a whole batch is sent on its own
+                count = 1
+            if count > 0:
+                part = ','.join(encoded[:count])
+                self._append(node_name, count, part, self._size(node_name, part))
+            self._flush()
+
+            records = records[count:]
+            if len(records) == 0:
+                return
+            chunk = ','.join(encoded[count:])
+
+        if self._records >= self._max_records or self._bytes >= self._max_bytes:
+            self._flush()
+        elif self._deadline == None and self._max_latency > 0:
+            self._deadline = time.time() + self._max_latency
+            if self._thread == None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._cv.notify()
+
+    def _append(self, node_name, count, chunk, size):
+        self._nodes.setdefault(node_name, []).append(chunk)
+        self._records = self._records + count
+        self._bytes = self._bytes + size
+
+    def _flush(self):
+        if self._records == 0:
+            return
+        payload = '{' + ','.join('{}:[{}]'.format(ENCODER.encode(node_name), ','.join(chunks))
+                                 for node_name, chunks in self._nodes.items()) + '}'
+        records = self._records
+        self._nodes = {}
+        self._records = 0
+        self._bytes = 2
+        self._deadline = None
+
+        try:
+            self._deliver(payload)
+            self.batches = self.batches + 1
+            self.records = self.records + records
+        except Exception as e:
+            self._logger.error('Dropping batch of {} records: {}'.format(records, e))
+
+    def flush(self):
+        with self._cv:
+            self._flush()
+
+    def _run(self):
+        with self._cv:
+            while not self._closed:
+                if self._deadline == None:
+                    self._cv.wait()
+                elif time.time() >= self._deadline:
+                    self._flush()
+                else:
+                    self._cv.wait(self._deadline - time.time())
+
+    def close(self):
+        with self._cv:
+            self._flush()
+            self._closed = True
+            self._cv.notify_all()
+        self._logger.debug('Wrote {} records in {} batches'.format(self.records, self.batches))
+
+    def _deliver(self, payload):
+        raise NotImplementedError()
+
+class StreamSink(Sink):
+    # one document per line, as expected by 'mosquitto_pub -l'
+    def __init__(self, stream = None, **kwargs):
+        Sink.__init__(self, **kwargs)
+        self._stream = stream if stream != None else sys.stdout
+
+    def _deliver(self, payload):
+        self._stream.write(payload + '\n')
+        self._stream.flush()
+
+class FileSink(StreamSink):
+    def __init__(self, path, **kwargs):
+        StreamSink.__init__(self, open(path, 'a', buffering=64 * 1024), **kwargs)
+
+    def close(self):
+        StreamSink.close(self)
+        self._stream.close()
+
+class QueueSink(Sink):
+    # hands encoded documents to anything with a put() method, e.g. a
+    # queue.Queue or the MQTT publisher
+    def __init__(self, queue, **kwargs):
+        Sink.__init__(self, **kwargs)
+        self._queue = queue
+
+    def _deliver(self, payload):
+        self._queue.put(payload.encode())
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+# Append-only, segmented on-disk queue for telemetry records.
+#
+# Every segment is a preallocated, memory-mapped file named after the logical
+# offset of its first byte. Records are framed as <length, crc32, payload>, a
+# zero length marks the end of the written data. The committed offset is kept
+# in a separate cursor file and only advanced once a batch has been
+# acknowledged, so after a crash or a failed upload only the tail after the
+# cursor is sent again.
+
+import os
+import mmap
+import struct
+import zlib
+import logging
+
+from threading import Lock
+
+RECORD_HEADER = struct.Struct('<II')
+CURSOR        = struct.Struct('<QI')
+
+SEGMENT_SUFFIX = '.seg'
+CURSOR_NAME    = 'cursor'
+
+class Segment:
+    def __init__(self, path, base, size = None):
+        self.path = path
+        self.base = base
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if size != None and os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self.size = os.fstat(fd).st_size
+            self._mm = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+
+        self.end = 0
+
+    def recover(self):
+        pos = 0
+        while pos + RECORD_HEADER.size <= self.size:
+            length, crc = RECORD_HEADER.unpack_from(self._mm, pos)
+            if length == 0 or pos + RECORD_HEADER.size + length > self.size:
+                break
+            payload = self._mm[pos + RECORD_HEADER.size:pos + RECORD_HEADER.size + length]
+            if zlib.crc32(payload) != crc:
+                break
+            pos = pos + RECORD_HEADER.size + length
+
+        if pos < self.size and any(self._mm[pos:min(pos + RECORD_HEADER.size, self.size)]):
+            # torn write, wipe the tail so it can not be mistaken for data later on
+            self._mm[pos:self.size] = bytes(self.size - pos)
+        self.end = pos
+        return pos
+
+    def free(self):
+        return self.size - self.end - RECORD_HEADER.size
+
+    def append(self, payload):
+        pos = self.end
+        self._mm[pos + RECORD_HEADER.size:pos + RECORD_HEADER.size + len(payload)] = payload
+        RECORD_HEADER.pack_into(self._mm, pos, len(payload), zlib.crc32(payload))
+        self.end = pos + RECORD_HEADER.size + len(payload)
+        return self.base + self.end
+
+    def read(self, pos):
+        if pos + RECORD_HEADER.size > self.end:
+            return None
+        length, crc = RECORD_HEADER.unpack_from(self._mm, pos)
+        if length == 0:
+            return None
+        return self._mm[pos + RECORD_HEADER.size:pos + RECORD_HEADER.size + length]
+
+    def flush(self):
+        self._mm.flush()
+
+    def close(self):
+        self._mm.close()
+
+class Spool:
+    def __init__(self, path, segment_size = 4 * 1024 * 1024, max_bytes = 64 * 1024 * 1024):
+        self._logger = logging.getLogger(__name__)
+        self._path = path
+        self._segment_size = segment_size
+        self._max_bytes = max(max_bytes, 2 * segment_size)
+        self._mutex = Lock()
+        self._segments = []
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        for name in sorted(os.listdir(path)):
+            if name.endswith(SEGMENT_SUFFIX):
+                if os.path.getsize(os.path.join(path, name)) == 0:
+                    os.remove(os.path.join(path, name))
+                    continue
+                base = int(name[:-len(SEGMENT_SUFFIX)])
+                self._segments.append(Segment(os.path.join(path, name), base))
+
+        for segment in self._segments:
+            segment.recover()
+        if len(self._segments) == 0:
+            self._segments.append(self._new_segment(0, segment_size))
+
+        self._committed = self._load_cursor()
+        if self._committed < self._segments[0].base or self._committed > self.end():
+            self._logger.warning('Committed offset {} outside of spool, resetting to {}'.format(self._committed, self._segments[0].base))
+            self._committed = self._segments[0].base
+        self._read = self._committed
+
+        self._logger.info('Opened spool {} ({} segments, {} bytes pending)'.format(path, len(self._segments), self.end() - self._committed))
+
+    def _new_segment(self, base, size):
+        return Segment(os.path.join(self._path, '{:020d}{}'.format(base, SEGMENT_SUFFIX)), base, size)
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self._path, CURSOR_NAME), 'rb') as f:
+                offset, crc = CURSOR.unpack(f.read(CURSOR.size))
+            if zlib.crc32(struct.pack('<Q', offset)) == crc:
+                return offset
+            self._logger.warning('Corrupt cursor file, replaying spool')
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            self._logger.warning('Could not read cursor: {}'.format(e))
+        return self._segments[0].base
+
+    def _store_cursor(self, offset):
+        tmp = os.path.join(self._path, CURSOR_NAME + '.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(CURSOR.pack(offset, zlib.crc32(struct.pack('<Q', offset))))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self._path, CURSOR_NAME))
+
+    def _locate(self, offset):
+        for segment in reversed(self._segments):
+            if segment.base <= offset:
+                return segment
+        return None
+
+    def end(self):
+        return self._segments[-1].base + self._segments[-1].end
+
+    def size(self):
+        return sum(segment.size for segment in self._segments)
+
+    def pending(self):
+        with self._mutex:
+            return self._read < self.end()
+
+    def append(self, payload, sync = True):
+        with self._mutex:
+            active = self._segments[-1]
+            if len(payload) > active.free():
+                base = active.base + active.end
+                if active.end == 0:
+                    # an empty segment keeps its base, replace it by a larger one
+                    self._segments.pop()
+                    active.close()
+                    os.remove(active.path)
+                else:
+                    active.flush()
+                active = self._new_segment(base, max(self._segment_size, len(payload) + 2 * RECORD_HEADER.size))
+                self._segments.append(active)
+                self._enforce_retention()
+
+            offset = active.append(payload)
+            if sync:
+                active.flush()
+            return offset
+
+    def read(self, max_records = 100):
+        records = []
+        with self._mutex:
+            offset = self._read
+            while len(records) < max_records:
+                segment = self._locate(offset)
+                payload = segment.read(offset - segment.base)
+                if payload == None:
+                    index = self._segments.index(segment)
+                    if index + 1 >= len(self._segments):
+                        break
+                    offset = self._segments[index + 1].base
+                    continue
+                offset = offset + RECORD_HEADER.size + len(payload)
+                records.append((offset, payload))
+            self._read = offset
+        return records
+
+    def rewind(self):
+        with self._mutex:
+            self._read = self._committed
+
+    def commit(self, offset):
+        with self._mutex:
+            if offset <= self._committed:
+                return
+            self._committed = offset
+            self._store_cursor(offset)
+
+            while len(self._segments) > 1 and self._segments[1].base <= offset:
+                self._drop_segment()
+
+    def _drop_segment(self):
+        segment = self._segments.pop(0)
+        segment.close()
+        os.remove(segment.path)
+
+    def _enforce_retention(self):
+        while len(self._segments) > 1 and self.size() > self._max_bytes:
+            segment = self._segments[0]
+            lost = min(segment.base + segment.end, self.end()) - max(self._committed, segment.base)
+            if lost > 0:
+                self._logger.warning('Spool full, dropping {} unacknowledged bytes'.format(lost))
+            self._drop_segment()
+            base = self._segments[0].base
+            if self._committed < base:
+                self._committed = base
+                self._store_cursor(base)
+            if self._read < base:
+                self._read = base
+
+    def close(self):
+        with self._mutex:
+            for segment in self._segments:
+                segment.flush()
+                segment.close()
+            self._segments = []
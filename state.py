@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+# Persistent per-device synchronization state.
+#
+# The state is kept in a SQLite database in WAL mode and updated row by row
+# as soon as a synchronization finishes, so a killed process only loses the
+# sessions that were still running. Files written by older versions (a
+# pickled dict of {address: {'last_sync': t}}) are imported on first use.
+
+import os
+import sqlite3
+import pickle
+import logging
+
+from threading import Lock
+
+SQLITE_HEADER = b'SQLite format 3\x00'
+
+# weight of the latest session in the success rate of a device
+SUCCESS_ALPHA = 0.3
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS devices (
+    address      TEXT PRIMARY KEY,
+    node_name    TEXT,
+    last_sync    INTEGER NOT NULL DEFAULT 0,
+    last_success INTEGER NOT NULL DEFAULT 0,
+    failures     INTEGER NOT NULL DEFAULT 0,
+    last_record  INTEGER NOT NULL DEFAULT 0,
+    interval     INTEGER,
+    success_rate REAL,
+    rssi         REAL
+);
+CREATE INDEX IF NOT EXISTS devices_last_success ON devices (last_success);
+'''
+
+class DeviceStore:
+    def __init__(self, path = ''):
+        self._logger = logging.getLogger(__name__)
+        self._mutex = Lock()
+
+        legacy = None
+        if path == '':
+            path = ':memory:'
+        elif os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'rb') as f:
+                header = f.read(len(SQLITE_HEADER))
+            if header != SQLITE_HEADER:
+                legacy = self._load_legacy(path)
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        if path != ':memory:':
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+        self._migrate()
+
+        if legacy != None:
+            with self._mutex, self._db:
+                self._db.executemany('INSERT OR REPLACE INTO devices (address, last_sync, last_success) VALUES (?, ?, ?)',
+                                     [(address, entry.get('last_sync', 0), entry.get('last_sync', 0)) for address, entry in legacy.items()])
+            self._logger.info('Imported {} devices from legacy device file'.format(len(legacy)))
+
+    def _migrate(self):
+        columns = [row['name'] for row in self._db.execute('PRAGMA table_info(devices)')]
+        if 'interval' not in columns:
+            self._db.execute('ALTER TABLE devices ADD COLUMN interval INTEGER')
+        if 'success_rate' not in columns:
+            self._db.execute('ALTER TABLE devices ADD COLUMN success_rate REAL')
+            self._db.execute('ALTER TABLE devices ADD COLUMN rssi REAL')
+
+    def _load_legacy(self, path):
+        addresses = {}
+        try:
+            with open(path, 'rb') as f:
+                addresses = pickle.load(f)
+            os.rename(path, path + '.pickle')
+        except Exception as e:
+            self._logger.warning('Could not read legacy device file {}: {}'.format(path, e))
+            os.rename(path, path + '.corrupt')
+        return addresses
+
+    def get(self, address):
+        with self._mutex:
+            row = self._db.execute('SELECT * FROM devices WHERE address = ?', (address,)).fetchone()
+        if row == None:
+            return None
+        return dict(row)
+
+    def synced_since(self, address, now, interval):
+        with self._mutex:
+            row = self._db.execute('SELECT 1 FROM devices WHERE address = ? AND last_success > ? - COALESCE(interval, ?)',
+                                   (address, now, interval)).fetchone()
+        return row != None
+
+    def synced_before(self, now, interval, lost_intervals = 0):
+        # devices without a session within lost_intervals intervals are left out
+        query = 'SELECT address FROM devices WHERE last_success > 0 AND last_success <= ? - COALESCE(interval, ?)'
+        args = (now, interval)
+        if lost_intervals > 0:
+            query = query + ' AND last_sync > ? - ? * COALESCE(interval, ?)'
+            args = args + (now, lost_intervals, interval)
+        with self._mutex:
+            rows = self._db.execute(query, args).fetchall()
+        return [row['address'] for row in rows]
+
+    def record(self, address, started, success, node_name = None, last_record = 0, rssi = None):
+        with self._mutex, self._db:
+            self._db.execute('INSERT OR IGNORE INTO devices (address) VALUES (?)', (address,))
+            # moving average of the outcome, a new device starts with its first one
+            self._db.execute('UPDATE devices SET success_rate = COALESCE(success_rate + ? * (? - success_rate), ?), '
+                             'rssi = COALESCE(?, rssi) WHERE address = ?',
+                             (SUCCESS_ALPHA, 1.0 if success else 0.0, 1.0 if success else 0.0, rssi, address))
+            if success:
+                self._db.execute('UPDATE devices SET last_sync = ?, last_success = ?, failures = 0, '
+                                 'node_name = COALESCE(?, node_name), last_record = MAX(last_record, ?) WHERE address = ?',
+                                 (started, started, node_name, last_record, address))
+            else:
+                self._db.execute('UPDATE devices SET last_sync = ?, failures = failures + 1, '
+                                 'node_name = COALESCE(?, node_name) WHERE address = ?',
+                                 (started, node_name, address))
+
+    def set_interval(self, address, interval):
+        # None returns the device to the default interval
+        with self._mutex, self._db:
+            self._db.execute('INSERT OR IGNORE INTO devices (address) VALUES (?)', (address,))
+            self._db.execute('UPDATE devices SET interval = ? WHERE address = ?', (interval, address))
+
+    def close(self):
+        with self._mutex:
+            self._db.close()
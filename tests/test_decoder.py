@@ -0,0 +1,33 @@
+import struct
+
+import pytest
+
+import parser
+
+LAYOUT = (parser.AFC_TIMESTAMP_UUID, parser.AFC_SOIL_TEMPERATURE_UUID, parser.AFC_SOIL_HUMIDITY_UUID)
+
+def payload(*records):
+    return bytes([len(records)]) + b''.join(struct.pack('<IhH', *record) for record in records)
+
+def test_decode():
+    decoder = parser.RecordDecoder.compile(LAYOUT)
+    records = decoder.decode(payload((100, 2150, 4012), (101, -5, 0)), 0)
+    assert records == [
+        {'ts': 100000, 'values': {'temperature': 21.5, 'moisture': 40.12}},
+        {'ts': 101000, 'values': {'temperature': -0.05, 'moisture': 0.0}}
+        ]
+
+def test_decode_short_payload():
+    decoder = parser.RecordDecoder.compile(LAYOUT)
+    data = payload((100, 2150, 4012), (101, 2160, 4013), (102, 2170, 4014))
+    # one record missing, the rest is still a multiple of the record size
+    with pytest.raises(struct.error):
+        decoder.decode(data[:1 + 2 * decoder.size], 0)
+    with pytest.raises(struct.error):
+        decoder.decode(data[:-1], 0)
+
+def test_decode_bulk_matches_decode():
+    decoder = parser.RecordDecoder.compile(LAYOUT)
+    payloads = [payload((100, 2150, 4012), (101, 2160, 4013)), payload((102, -2170, 1))]
+    expected = decoder.decode(payloads[0], 0) + decoder.decode(payloads[1], 0)
+    assert list(decoder.decode_bulk(payloads, [0, 0])) == expected
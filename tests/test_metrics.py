@@ -0,0 +1,53 @@
+import threading
+
+import metrics
+
+def stats(address, success = True):
+    return {'address': address, 'adapter': 'hci0', 'node_name': None, 'success': success, 'retries': 0,
+            'bytes': 100, 'records': 10, 'indications': 1, 'backpressure': 0, 'rssi': None,
+            'marks': {'connect': 1.0, 'connected': 1.5, 'notify': 2.0, 'first_indication': 2.1, 'end': 3.0}}
+
+def read(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+def test_writes_are_throttled(tmp_path):
+    path = str(tmp_path / 'gateway.prom')
+    collector = metrics.Collector(path, write_interval=3600)
+    collector.record(stats('A'))
+    assert 'address="A"' in read(path)
+
+    collector.record(stats('B'))
+    assert 'address="B"' not in read(path)
+    assert collector.write_due() != None
+
+    collector.flush()
+    assert 'address="B"' in read(path)
+    assert collector.write_due() == None
+
+def test_forget_drops_device_series(tmp_path):
+    path = str(tmp_path / 'gateway.prom')
+    collector = metrics.Collector(path, write_interval=0)
+    collector.record(stats('A'))
+    collector.record(stats('B', False))
+    collector.forget('A')
+    collector.flush()
+
+    content = read(path)
+    assert 'address="A"' not in content
+    assert 'address="B"' in content
+    # fleet wide figures keep the sessions of forgotten devices
+    assert 'afc_gateway_session_seconds_count 2' in content
+
+def test_concurrent_sessions_are_written(tmp_path):
+    path = str(tmp_path / 'gateway.prom')
+    collector = metrics.Collector(path, write_interval=0)
+    threads = [threading.Thread(target=lambda n=n: [collector.record(stats(str(n))) for i in range(50)]) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    collector.flush()
+
+    assert 'afc_gateway_session_seconds_count 200' in read(path)
+    assert collector.write_due() == None
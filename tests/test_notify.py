@@ -0,0 +1,172 @@
+import json
+import socket
+import struct
+
+import pytest
+
+pytest.importorskip('dbus')
+pytest.importorskip('gi')
+
+import dbus
+
+import dbluez
+import parser
+import sink
+
+from gi.repository import GLib
+
+ADDRESS = 'AA:BB:CC:DD:EE:FF'
+SYNC = '/org/bluez/hci0/dev_AA_BB_CC_DD_EE_FF/service0010/char0011'
+
+class Fd:
+    def __init__(self, fd):
+        self._fd = fd
+
+    def take(self):
+        return self._fd
+
+class SignalMatch:
+    def remove(self):
+        None
+
+class Characteristic:
+    # AcquireNotify hands out one end of a socketpair, like BlueZ does
+    def __init__(self, acquire = True):
+        self.acquire = acquire
+        self.remote = None
+        self.notifying = False
+        self.signals = []
+
+    def AcquireNotify(self, options):
+        if not self.acquire:
+            raise dbus.DBusException('org.bluez.Error.NotSupported')
+        self.remote, local = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        return Fd(local.detach()), 23
+
+    def StartNotify(self):
+        self.notifying = True
+
+    def connect_to_signal(self, name, handler, dbus_interface = None):
+        self.signals.append(handler)
+        return SignalMatch()
+
+    def WriteValue(self, value, options, reply_handler, error_handler):
+        self.written = value
+        reply_handler()
+
+class Device:
+    def __init__(self, characteristic, flags):
+        self._address = ADDRESS
+        self.characteristics = {parser.AFC_GSC_UUID: characteristic, parser.GEN_CTS_CT_UUID: Characteristic()}
+        self.characteristic_flags = {parser.AFC_GSC_UUID: flags}
+        self.layout_fingerprint = 'fingerprint'
+        self.timing = {}
+
+    def getAddress(self):
+        return self._address
+
+    def connect(self, disconnect_cb, discovery_cb):
+        None
+
+    def disconnect(self, done_cb = None):
+        if done_cb != None:
+            done_cb()
+
+class Stream:
+    def __init__(self):
+        self.records = []
+
+    def write(self, data):
+        for line in data.splitlines():
+            self.records.extend(json.loads(line)[ADDRESS])
+
+    def flush(self):
+        None
+
+def payload(*records):
+    return bytes([len(records)]) + b''.join(struct.pack('<Ih', *record) for record in records)
+
+def session(tmp_path, characteristic, flags, cts = True, **kwargs):
+    cache = parser.LayoutCache(str(tmp_path / 'layouts.json'))
+    cache.put(ADDRESS, {'fingerprint': 'fingerprint', 'node_name': ADDRESS, 'nnc': False, 'cts': cts, 'cccd': SYNC + '/desc0014',
+                        'descriptors': [[SYNC + '/desc0012', parser.AFC_TIMESTAMP_UUID], [SYNC + '/desc0013', parser.AFC_SOIL_TEMPERATURE_UUID]]})
+    stream = Stream()
+    tb = parser.Thingsboard(Device(characteristic, flags), output=sink.StreamSink(stream, max_latency=0), layout_cache=cache, **kwargs)
+    done = []
+    tb.startSynchronization(done.append)
+    tb.discoveryComplete()
+    return tb, stream, done
+
+def test_values_are_drained_into_one_buffer():
+    remote, local = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    values = []
+    notify = dbluez.NotifySocket(local.detach(), 23, lambda value: values.append((type(value), bytes(value))))
+    for value in (b'\x01abc', b'\x02de', b'\x03f'):
+        remote.send(value)
+
+    assert notify._on_io(None, GLib.IO_IN)
+    assert values == [(memoryview, b'\x01abc'), (memoryview, b'\x02de'), (memoryview, b'\x03f')]
+    assert notify.values == 3 and notify.reads == 1
+    notify.remove()
+
+def test_pending_values_are_read_before_hangup():
+    remote, local = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    values = []
+    notify = dbluez.NotifySocket(local.detach(), 23, lambda value: values.append(bytes(value)))
+    remote.send(b'\x01a')
+    remote.close()
+
+    assert not notify._on_io(None, GLib.IO_IN | GLib.IO_HUP)
+    assert values == [b'\x01a']
+
+@pytest.mark.parametrize('bulk', [False, True])
+@pytest.mark.parametrize('decode_worker', [False, True])
+def test_session_over_notify_socket(tmp_path, bulk, decode_worker):
+    characteristic = Characteristic()
+    worker = parser.DecodeWorker() if decode_worker else None
+    tb, stream, done = session(tmp_path, characteristic, ['notify'], bulk=bulk, worker=worker)
+    assert isinstance(tb._char_sig_rcv, dbluez.NotifySocket)
+    assert not characteristic.notifying
+
+    # all values arrive in one read, through the same receive buffer
+    for x in range(0, 10):
+        characteristic.remote.send(payload((x, 100 * x), (x + 100, -100 * x)))
+    characteristic.remote.send(b'\x00')
+    tb._char_sig_rcv._on_io(None, GLib.IO_IN)
+    if worker != None:
+        worker.close()
+    tb._output.close()
+
+    assert done == [tb] and tb.syncedSuccessfully()
+    expected = [[{'ts': x * 1000, 'values': {'temperature': x}}, {'ts': (x + 100) * 1000, 'values': {'temperature': -x}}] for x in range(0, 10)]
+    assert stream.records == sum(expected, [])
+
+def test_start_notify_fallback(tmp_path):
+    characteristic = Characteristic(acquire=False)
+    tb, stream, done = session(tmp_path, characteristic, ['notify'])
+    assert characteristic.notifying
+    assert len(characteristic.signals) == 1
+
+    characteristic.signals[0](dbluez.BLUEZ_GATTCHAR, {'Value': dbus.Array(payload((1, 250)))}, [])
+    characteristic.signals[0](dbluez.BLUEZ_GATTCHAR, {'Value': dbus.Array(b'\x00')}, [])
+    tb._output.close()
+    assert done == [tb]
+    assert stream.records == [{'ts': 1000, 'values': {'temperature': 2.5}}]
+
+def test_indications_use_start_notify(tmp_path):
+    characteristic = Characteristic()
+    tb, stream, done = session(tmp_path, characteristic, ['indicate'])
+    assert characteristic.notifying
+    assert characteristic.remote == None
+
+@pytest.mark.parametrize('cts', [False, True])
+def test_time_update(tmp_path, cts):
+    characteristic = Characteristic()
+    tb, stream, done = session(tmp_path, characteristic, ['notify'], cts=cts)
+    characteristic.remote.send(payload((1, 250)))
+    characteristic.remote.send(b'\x00')
+    tb._char_sig_rcv._on_io(None, GLib.IO_IN)
+    tb._output.close()
+
+    assert done == [tb] and tb.syncedSuccessfully()
+    assert hasattr(tb._device.characteristics[parser.GEN_CTS_CT_UUID], 'written') == cts
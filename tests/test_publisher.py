@@ -0,0 +1,180 @@
+import time
+import threading
+
+import pytest
+
+pytest.importorskip('dbus')
+pytest.importorskip('gi')
+
+import gateway
+import spool
+
+class Info:
+    def __init__(self, mid):
+        self.mid = mid
+
+class Client:
+    # broker stand-in, acks are sent by the test
+    def __init__(self, client_id = None, clean_session = True):
+        self.published = []
+        self.auto_ack = False
+        self._mid = 0
+        self._mutex = threading.Lock()
+
+    def username_pw_set(self, user, password):
+        None
+
+    def max_inflight_messages_set(self, window):
+        None
+
+    def reconnect_delay_set(self, min_delay, max_delay):
+        None
+
+    def connect_async(self, host, port, keepalive):
+        None
+
+    def loop_start(self):
+        None
+
+    def loop_stop(self):
+        None
+
+    def disconnect(self):
+        None
+
+    def publish(self, topic, payload, qos):
+        with self._mutex:
+            self._mid = self._mid + 1
+            mid = self._mid
+            self.published.append((mid, payload))
+        if self.auto_ack:
+            # acked before publish() returns, as paho does on a fast link
+            self.on_publish(self, None, mid)
+        return Info(mid)
+
+class Mqtt:
+    Client = Client
+
+    @staticmethod
+    def connack_string(rc):
+        return str(rc)
+
+    @staticmethod
+    def error_string(rc):
+        return str(rc)
+
+def wait(condition, timeout = 5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'timed out'
+        time.sleep(0.005)
+
+@pytest.fixture
+def publisher(monkeypatch):
+    monkeypatch.setattr(gateway, 'mqtt', Mqtt)
+    publishers = []
+
+    def create(**kwargs):
+        publisher = gateway.MqttPublisher('localhost', 1883, 'topic', **kwargs)
+        publisher.start()
+        publishers.append(publisher)
+        return publisher
+    yield create
+    for publisher in publishers:
+        if publisher._running:
+            publisher.close(timeout=0)
+
+def payloads(publisher):
+    return [payload for mid, payload in publisher._client.published]
+
+def ack(publisher, count = None):
+    for mid, payload in list(publisher._client.published)[:count]:
+        publisher._on_publish(publisher._client, None, mid)
+
+def test_window(publisher):
+    p = publisher(window=2)
+    for x in range(0, 5):
+        p.put('{}'.format(x).encode())
+    p._on_connect(p._client, None, None, 0)
+
+    wait(lambda: len(p._client.published) == 2)
+    time.sleep(0.05)
+    assert len(p._client.published) == 2
+
+    ack(p, 1)
+    wait(lambda: len(p._client.published) == 3)
+    ack(p)
+    wait(lambda: len(p._client.published) == 5)
+    assert payloads(p) == [b'0', b'1', b'2', b'3', b'4']
+
+def test_reconnect(publisher):
+    p = publisher(window=10)
+    p._client.auto_ack = True
+    p._on_connect(p._client, None, None, 0)
+    p.put(b'a')
+    wait(lambda: len(p._client.published) == 1)
+
+    p._on_disconnect(p._client, None, 1)
+    p.put(b'b')
+    p.put(b'c')
+    time.sleep(0.05)
+    assert payloads(p) == [b'a']
+
+    p._on_connect(p._client, None, None, 0)
+    wait(lambda: len(p._client.published) == 3)
+    assert payloads(p) == [b'a', b'b', b'c']
+
+def test_backlog_drops_oldest(publisher):
+    p = publisher(backlog=3)
+    p._client.auto_ack = True
+    for x in range(0, 5):
+        p.put('{}'.format(x).encode())
+    p._on_connect(p._client, None, None, 0)
+    wait(lambda: len(p._client.published) == 3)
+    time.sleep(0.05)
+    assert payloads(p) == [b'2', b'3', b'4']
+
+@pytest.fixture
+def cursor(monkeypatch, tmp_path):
+    queue = spool.Spool(str(tmp_path / 'spool'))
+    writes = []
+    store = queue._store_cursor
+
+    def counted(offset):
+        writes.append(offset)
+        store(offset)
+    monkeypatch.setattr(queue, '_store_cursor', counted)
+    return queue, writes
+
+def test_commit_in_publish_order(publisher, cursor):
+    queue, writes = cursor
+    p = publisher(window=3, spool=queue)
+    for x in range(0, 3):
+        p.put('{}'.format(x).encode())
+    p._on_connect(p._client, None, None, 0)
+    wait(lambda: len(p._client.published) == 3)
+
+    # acks of later messages do not move the cursor past an unacknowledged one
+    mids = [mid for mid, payload in p._client.published]
+    p._on_publish(p._client, None, mids[2])
+    p._on_publish(p._client, None, mids[1])
+    time.sleep(gateway.COMMIT_DELAY * 2)
+    assert writes == []
+
+    p._on_publish(p._client, None, mids[0])
+    wait(lambda: len(writes) == 1)
+    assert writes == [queue.end()]
+
+def test_commit_coalesced(publisher, cursor):
+    queue, writes = cursor
+    p = publisher(window=5, spool=queue)
+    p._client.auto_ack = True
+    for x in range(0, 50):
+        p.put('{}'.format(x).encode())
+    p._on_connect(p._client, None, None, 0)
+    wait(lambda: len(p._client.published) == 50)
+    end = queue.end()
+    p.close()
+
+    assert writes[-1] == end
+    assert len(writes) <= 50 // 5 + 1
@@ -0,0 +1,78 @@
+import os
+
+import spool
+
+def payloads(records):
+    return [bytes(payload) for offset, payload in records]
+
+def test_reopen_resumes_after_cursor(tmp_path):
+    path = str(tmp_path / 'spool')
+    queue = spool.Spool(path)
+    for x in range(0, 5):
+        queue.append('message {}'.format(x).encode())
+    records = queue.read(3)
+    queue.commit(records[1][0])
+    queue.close()
+
+    # only what was not acknowledged is sent again
+    queue = spool.Spool(path)
+    assert payloads(queue.read()) == [b'message 2', b'message 3', b'message 4']
+    assert not queue.pending()
+    queue.close()
+
+def test_torn_write_is_cut_off(tmp_path):
+    path = str(tmp_path / 'spool')
+    queue = spool.Spool(path)
+    queue.append(b'complete')
+    end = queue.append(b'torn')
+    queue.close()
+
+    # a crash in the middle of the second record, the payload did not make it
+    segment = os.path.join(path, sorted(os.listdir(path))[0])
+    with open(segment, 'r+b') as f:
+        f.seek(end - len(b'torn'))
+        f.write(b'xxxx')
+
+    queue = spool.Spool(path)
+    assert payloads(queue.read()) == [b'complete']
+    # new records go where the torn one was
+    queue.append(b'next')
+    assert payloads(queue.read()) == [b'next']
+    queue.close()
+
+    queue = spool.Spool(path)
+    assert payloads(queue.read()) == [b'complete', b'next']
+    queue.close()
+
+def test_corrupt_cursor_replays(tmp_path):
+    path = str(tmp_path / 'spool')
+    queue = spool.Spool(path)
+    queue.append(b'a')
+    queue.append(b'b')
+    queue.commit(queue.read()[-1][0])
+    queue.close()
+
+    with open(os.path.join(path, spool.CURSOR_NAME), 'r+b') as f:
+        f.write(b'\xff')
+
+    queue = spool.Spool(path)
+    assert payloads(queue.read()) == [b'a', b'b']
+    queue.close()
+
+def test_commit_drops_segments(tmp_path):
+    path = str(tmp_path / 'spool')
+    queue = spool.Spool(path, segment_size=64)
+    for x in range(0, 10):
+        queue.append(bytes(40))
+    segments = len([name for name in os.listdir(path) if name.endswith(spool.SEGMENT_SUFFIX)])
+    assert segments > 1
+
+    records = queue.read()
+    assert len(records) == 10
+    queue.commit(records[-1][0])
+    assert len([name for name in os.listdir(path) if name.endswith(spool.SEGMENT_SUFFIX)]) == 1
+    queue.close()
+
+    queue = spool.Spool(path, segment_size=64)
+    assert not queue.pending()
+    queue.close()
@@ -0,0 +1,40 @@
+import state
+
+def test_device_interval_overrides_default():
+    store = state.DeviceStore()
+    store.record('A', 1000, True)
+    store.record('B', 1000, True)
+    store.set_interval('B', 100)
+
+    # A follows the default interval of 3600 s, B its own
+    assert store.synced_since('A', 1500, 3600)
+    assert not store.synced_since('B', 1500, 3600)
+    assert store.synced_before(1500, 3600) == ['B']
+    assert sorted(store.synced_before(5000, 3600)) == ['A', 'B']
+
+def test_never_synced_is_not_due():
+    store = state.DeviceStore()
+    store.record('A', 1000000, False)
+    assert not store.synced_since('A', 1000500, 3600)
+    assert store.synced_before(1005000, 3600) == []
+
+def test_lost_devices_are_not_expected():
+    store = state.DeviceStore()
+    now = 1000000
+    store.record('present', now - 4000, True)
+    store.record('failing', now - 5000, True)
+    store.record('failing', now - 1000, False)
+    store.record('gone', now - 4 * 3600, True)
+
+    assert sorted(store.synced_before(now, 3600)) == ['failing', 'gone', 'present']
+    assert sorted(store.synced_before(now, 3600, 3)) == ['failing', 'present']
+
+def test_device_interval_can_be_reset():
+    store = state.DeviceStore()
+    store.record('A', 1000, True)
+    store.set_interval('A', 100)
+    assert not store.synced_since('A', 1500, 3600)
+
+    store.set_interval('A', None)
+    assert store.synced_since('A', 1500, 3600)
+    assert store.get('A')['interval'] == None
@@ -0,0 +1,135 @@
+import json
+import time
+import struct
+
+import parser
+import sink
+
+LAYOUT = (parser.AFC_TIMESTAMP_UUID, parser.AFC_SOIL_TEMPERATURE_UUID)
+
+class Device:
+    def __init__(self, characteristics = {}):
+        self._address = 'AA:BB:CC:DD:EE:FF'
+        self.characteristics = characteristics
+        self.layout_fingerprint = 'fingerprint'
+
+    def getAddress(self):
+        return self._address
+
+    def connect(self, disconnect_cb, discovery_cb):
+        None
+
+    def disconnect(self, done_cb = None):
+        None
+
+class Characteristic:
+    def __init__(self, value):
+        self.value = value
+
+    def ReadValue(self, options, reply_handler, error_handler):
+        self.reads = getattr(self, 'reads', 0) + 1
+        reply_handler(list(self.value))
+
+class Stream:
+    def __init__(self):
+        self.documents = []
+
+    def write(self, data):
+        self.documents.extend(json.loads(line) for line in data.splitlines())
+
+    def flush(self):
+        None
+
+def payload(*records):
+    return bytes([len(records)]) + b''.join(struct.pack('<Ih', *record) for record in records)
+
+def board(stream, **kwargs):
+    tb = parser.Thingsboard(Device(), output=sink.StreamSink(stream, max_latency=0), **kwargs)
+    tb.setLayout('node', LAYOUT)
+    return tb
+
+def test_failed_session_values_are_dropped():
+    for bulk in (False, True):
+        stream = Stream()
+        tb = board(stream, bulk=bulk)
+        # buffered by a session that failed before it was flushed
+        tb._payloads.append(payload((1, 100)))
+        tb._timestamps.append(0)
+        tb._jdata.append({'ts': 1000, 'values': {'temperature': 1.0}})
+
+        tb.startSynchronization()
+        tb.processValue(payload((2, 200)), 0)
+        tb.flushValues()
+        tb._output.close()
+        assert stream.documents == [{'node': [{'ts': 2000, 'values': {'temperature': 2.0}}]}]
+
+def test_failed_session_values_are_dropped_on_worker():
+    stream = Stream()
+    worker = parser.DecodeWorker()
+    tb = board(stream, bulk=True, worker=worker)
+    worker.call(tb.processValue, payload((1, 100)), 0)
+
+    tb.startSynchronization()
+    worker.call(tb.processValue, payload((2, 200)), 0)
+    worker.call(tb.flushValues)
+    worker.close()
+    tb._output.close()
+    assert stream.documents == [{'node': [{'ts': 2000, 'values': {'temperature': 2.0}}]}]
+
+def test_cached_layout_picks_up_rename(tmp_path):
+    cache = parser.LayoutCache(str(tmp_path / 'layouts.json'), name_ttl=3600)
+    address = Device().getAddress()
+    entry = {'fingerprint': 'fingerprint', 'node_name': 'old', 'nnc': True, 'cts': False, 'cccd': None, 'descriptors': []}
+
+    for named, node_name, reads in ((time.time() - 60, 'old', 0), (time.time() - 7200, 'new', 1)):
+        entry['named'] = named
+        cache.put(address, entry)
+        nnc = Characteristic(b'new')
+        tb = parser.Thingsboard(Device({parser.AFC_GSC_UUID: Characteristic(b''), parser.AFC_ANS_NNC_UUID: nnc}), layout_cache=cache)
+        tb.startSynchronization()
+        tb.discoveryComplete()
+        # the name is only read once the cached one is older than name_ttl
+        assert tb.nodeName() == node_name
+        assert getattr(nnc, 'reads', 0) == reads
+        assert parser.LayoutCache(str(tmp_path / 'layouts.json')).get(address, 'fingerprint')['node_name'] == node_name
+
+class Link(Device):
+    def __init__(self, characteristics = {}):
+        Device.__init__(self, characteristics)
+        self.disconnects = 0
+
+    def disconnect(self, done_cb = None):
+        self.disconnects = self.disconnects + 1
+        if done_cb != None:
+            done_cb()
+
+def cached(tmp_path, **layout):
+    cache = parser.LayoutCache(str(tmp_path / 'layouts.json'))
+    entry = {'fingerprint': 'fingerprint', 'node_name': 'node', 'nnc': False, 'cts': False,
+             'cccd': '/cccd', 'descriptors': [['/timestamp', parser.AFC_TIMESTAMP_UUID]]}
+    entry.update(layout)
+    cache.put(Device().getAddress(), entry)
+    return cache
+
+def test_unknown_descriptor_ends_session(tmp_path):
+    device = Link({parser.AFC_GSC_UUID: Characteristic(b'')})
+    tb = parser.Thingsboard(device, layout_cache=cached(tmp_path, descriptors=[['/unknown', '8fee29ff-3c17-4189-8556-a293fa6b2739']]))
+    done = []
+    tb.startSynchronization(done.append)
+    tb.discoveryComplete()
+    assert device.disconnects == 1
+    assert done == [tb] and not tb.syncing()
+
+class Characteristics(dict):
+    def path(self, uuid):
+        return '/sync'
+
+def test_missing_cccd_ends_session():
+    device = Link(Characteristics({parser.AFC_GSC_UUID: Characteristic(b'')}))
+    device.descriptor_uuids = {'/sync/timestamp': parser.AFC_TIMESTAMP_UUID}
+    tb = parser.Thingsboard(device)
+    done = []
+    tb.startSynchronization(done.append)
+    tb.discoveryComplete()
+    assert device.disconnects == 1
+    assert done == [tb] and not tb.syncing()